@@ -0,0 +1,234 @@
+import argparse
+import itertools
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from evaluate_gaze import EvaluateGaze
+from gaze_session import file_mode
+from instrumentation import Instrumentation, JsonLinesSink
+from precalibrate_gaze import PrecalibrateGaze
+
+# Parameter tables shared read-only by the tasks (set once in each worker process)
+_tables = {}
+# Path of the metrics and the profile mode of the tasks (None without instrumentation)
+_metrics = None
+
+
+def _init_worker(tables: Dict[str, np.ndarray], metrics: Optional[Tuple[str, Optional[str]]] = None):
+    global _tables, _metrics
+    _tables = tables
+    _metrics = metrics
+    for table in tables.values():
+        table.flags.writeable = False
+
+
+def _run_task(task: dict) -> Tuple[dict, object, float]:
+    # Run a task in a worker process, instrumented as one run if metrics are recorded
+    if _metrics is None:
+        return _execute_task(task)
+    path, profile = _metrics
+    with Instrumentation(JsonLinesSink(path), run="%s %s %s" % (task["kind"], task["user"], task["output"]),
+                         memory=True, profile=profile):
+        return _execute_task(task)
+
+
+def _execute_task(task: dict) -> Tuple[dict, object, float]:
+    # Run a task and measure the elapsed time
+    start = time.perf_counter()
+    if task["kind"] == "precalibrate":
+        param_base = _tables[task["param_base"]]
+        os.makedirs(os.path.dirname(task["output"]) or ".", exist_ok=True)
+        PrecalibrateGaze(param_base).precalibrate_gaze(task["input"], task["output"], task["user_id"],
+                                                       task["param"], task.get("chunksize"))
+        result = task["output"]
+    else:
+        param_base = _tables[task["param_base"]][task["row"]]
+        alpha_beta = task["param"] if isinstance(task["param"], list) else _tables[task["param"]][task["index"]]
+        param = EvaluateGaze.get_rotation(alpha_beta).flatten()
+        result = EvaluateGaze.get_absolute_error(task["eval_data"], param_base, param)
+    return task, result, time.perf_counter() - start
+
+
+class BatchGaze:
+    """
+    Batch driver of the pre-calibration and the evaluation over users x scenes x methods (x runs).
+
+    The manifest is a JSON file with the sections "precalibrate" and "evaluate" (a section or a list of sections).
+    Each section gives the lists of users, scenes, methods and runs (a list or {"range": [start, stop]}) and path
+    templates formatted with {user}, {scene}, {method} and {run}; the paths are relative to the manifest.
+    The regression parameters (param_base) are a CSV file whose row user - 1 belongs to the user, a dictionary of
+    the rows keyed on the user, or the name of one of them in the top-level "tables". The methods of precalibrate are a dictionary of the parameters (alpha, beta).
+    The methods of evaluate are a list with the template of a CSV file of the estimated parameters (param, whose row i
+    belongs to the i-th user), or a dictionary of fixed parameters (alpha, beta). Each result file of evaluate has one
+    error per user.
+    """
+
+    def __init__(self, manifest_path: str):
+        """
+        :param manifest_path: Path of the manifest.
+        """
+        with open(manifest_path, encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.root = os.path.dirname(os.path.abspath(manifest_path))
+        self.tables = {}  # Parameter tables keyed on the path (or the section for inline tables)
+        self.tasks = self.precalibrate_tasks() + self.evaluate_tasks()
+
+    def path(self, template: str, **fields) -> str:
+        return os.path.normpath(os.path.join(self.root, template.format(**fields)))
+
+    @staticmethod
+    def values(spec) -> list:
+        if isinstance(spec, dict):
+            return list(range(*spec["range"]))
+        return list(spec)
+
+    def load_param_base(self, section: str, spec) -> Tuple[str, Dict[int, int]]:
+        """
+        Load the regression parameters of a section.
+
+        :return: Tuple containing the key of the table and the row of each user.
+        """
+        tables = self.manifest.get("tables", {})
+        if isinstance(spec, str) and spec in tables:
+            section, spec = "tables/%s" % spec, tables[spec]
+        if isinstance(spec, str):
+            key = self.path(spec)
+            if key not in self.tables:
+                self.tables[key] = pd.read_csv(key, encoding="utf_8_sig").to_numpy(dtype=np.float64)
+            return key, {user: user - 1 for user in range(1, self.tables[key].shape[0] + 1)}
+        key = section
+        users = sorted(spec, key=int)
+        self.tables[key] = np.array([spec[user] for user in users], dtype=np.float64)
+        return key, {int(user): row for row, user in enumerate(users)}
+
+    def sections(self, kind: str) -> List[dict]:
+        sections = self.manifest.get(kind, [])
+        return sections if isinstance(sections, list) else [sections]
+
+    def precalibrate_tasks(self) -> List[dict]:
+        tasks = []
+        for number, section in enumerate(self.sections("precalibrate")):
+            tasks += self.precalibrate_section(number, section)
+        return tasks
+
+    def evaluate_tasks(self) -> List[dict]:
+        tasks = []
+        for number, section in enumerate(self.sections("evaluate")):
+            tasks += self.evaluate_section(number, section)
+        return tasks
+
+    def precalibrate_section(self, number: int, section: dict) -> List[dict]:
+        key, rows = self.load_param_base("precalibrate/%d/param_base" % number, section["param_base"])
+        tasks = []
+        for scene, (method, param), run, user in itertools.product(
+                section.get("scenes", [""]), section["methods"].items(), self.values(section.get("runs", [""])),
+                self.values(section["users"])):
+            fields = {"user": user, "scene": scene, "method": method, "run": run}
+            tasks.append({"kind": "precalibrate", "param_base": key, "user": user, "user_id": rows[user] + 1,
+                          "input": self.path(section["input"], **fields),
+                          "output": self.path(section["output"], **fields),
+                          "param": list(param), "chunksize": section.get("chunksize")})
+        return tasks
+
+    def evaluate_section(self, number: int, section: dict) -> List[dict]:
+        key, rows = self.load_param_base("evaluate/%d/param_base" % number, section["param_base"])
+        methods = section["methods"]
+        if not isinstance(methods, dict):
+            methods = {method: None for method in methods}
+        users = self.values(section["users"])
+        tasks = []
+        for scene, (method, param), run in itertools.product(
+                section.get("scenes", [""]), methods.items(), self.values(section.get("runs", [""]))):
+            fields = {"scene": scene, "method": method, "run": run}
+            if param is None:
+                param = self.path(section["param"], **fields)
+                if param not in self.tables:
+                    self.tables[param] = pd.read_csv(param)[["alpha", "beta"]].to_numpy(dtype=np.float64)
+            else:
+                param = list(param)
+            output = self.path(section["output"], **fields)
+            for index, user in enumerate(users):
+                tasks.append({"kind": "evaluate", "param_base": key, "row": rows[user], "user": user,
+                              "index": index, "param": param, "output": output,
+                              "eval_data": self.path(section["eval_data"], user=user, **fields)})
+        return tasks
+
+    @staticmethod
+    def write_csv(path: str, df: pd.DataFrame):
+        """
+        Write a CSV file atomically.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", newline="") as f:
+                df.to_csv(f, index=False, header=True)
+            os.chmod(tmp, file_mode())
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def run(self, workers: int = 1, timings_path: str = None, metrics_path: str = None,
+            profile: str = None) -> pd.DataFrame:
+        """
+        Run the tasks over a process pool and write the results.
+
+        :param workers: Integer number of processes.
+        :param timings_path: Path of the CSV file of the elapsed time of each task (not written if None).
+        :param metrics_path: Path of the JSON lines file of the instrumentation of each task (not recorded if None).
+        :param profile: Capture mode of each task ("cprofile" or "tracemalloc", only with metrics_path).
+        :return: DataFrame of the tasks with the elapsed time.
+        """
+        metrics = None if metrics_path is None else (metrics_path, profile)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(self.tables, metrics)) as executor:
+                done = list(executor.map(_run_task, self.tasks, chunksize=max(1, len(self.tasks) // (workers * 8))))
+        else:
+            _init_worker(self.tables, metrics)
+            done = [_run_task(task) for task in self.tasks]
+
+        # Gather the errors of the users in each result file
+        errors = {}
+        for task, result, _ in done:
+            if task["kind"] == "evaluate":
+                errors.setdefault(task["output"], {})[task["index"]] = result
+        for output, error in errors.items():
+            self.write_csv(output, pd.Series([error[i] for i in range(len(error))], name="error").to_frame())
+
+        timings = pd.DataFrame([{"kind": task["kind"], "user": task["user"], "output": task["output"],
+                                 "seconds": seconds} for task, _, seconds in done])
+        if timings_path is not None:
+            self.write_csv(timings_path, timings)
+        return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the pre-calibration and the evaluation listed in a manifest.")
+    parser.add_argument("manifest", help="JSON manifest of users x scenes x methods")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes")
+    parser.add_argument("--timings", help="CSV file of the elapsed time of each task")
+    parser.add_argument("--metrics", help="JSON lines file of the timers, counters and memory of each task")
+    parser.add_argument("--profile", choices=Instrumentation.profiles, help="Capture each task (with --metrics)")
+    parser.add_argument("--dry-run", action="store_true", help="List the tasks without running them")
+    args = parser.parse_args()
+
+    batch = BatchGaze(args.manifest)
+    if args.dry_run:
+        for task in batch.tasks:
+            print(task["kind"], task["user"], task["output"])
+        return
+    start = time.perf_counter()
+    timings = batch.run(args.workers, args.timings, args.metrics, args.profile)
+    print(f"{len(timings)} tasks in {time.perf_counter() - start:.2f} s "
+          f"(task total {timings['seconds'].sum():.2f} s, workers {args.workers})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+import argparse
+import ctypes
+import ctypes.util
+import gc
+import os
+import tempfile
+import tracemalloc
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import pdist
+from evaluate_gaze import EvaluateGaze
+from extract_fixation import ExtractFixation
+from gaze_session import write_columns
+from optimize_gaze import OptimizeGaze
+from scene_geometry import HitPointProxy
+from synthetic_gaze import SyntheticGaze
+
+
+class BenchmarkGaze:
+    """
+    Benchmark of the stages of the self-calibration on synthetic sessions (SyntheticGaze) of several lengths.
+
+    Each stage is timed (the best of repeat runs) and its peak memory is measured in a separate run.
+    The scaling exponent of a stage is the slope of the log time (or memory) against the log number of frames.
+    Each stage also checks its result against the ground truth of the session, so that a change can be checked for
+    both speed and correctness. The sessions are generated once and kept in data_dir.
+    """
+
+    stages = ["formatting_csv", "formatting_gaze", "ivt", "ivt_world", "head_move", "features", "calibrate_3d",
+              "absolute_error", "objective", "pipeline"]
+    param_base = np.array([0.0, 1.0, 0.0, 0.0, 0.0, 1.0])  # Regression model of the synthetic data (identity)
+
+    def __init__(self, data_dir: str, sizes: Tuple[int, ...] = (10000, 100000, 1000000), repeat: int = 3,
+                 memory: bool = True, param: Tuple[float, float] = (2.0, -1.5), seed: int = 0):
+        """
+        :param data_dir: Directory of the synthetic sessions.
+        :param sizes: Numbers of frames of the sessions.
+        :param repeat: Integer number of timed runs of each stage.
+        :param memory: Whether to trace the peak memory of each stage.
+        :param param: Ground-truth parameters (alpha, beta) of the sessions.
+        :param seed: Random seed of the sessions.
+        """
+        self.data_dir = data_dir
+        self.sizes = sizes
+        self.repeat = repeat
+        self.memory = memory
+        self.generator = SyntheticGaze(param, seed=seed)
+        self.fix = None  # Formatted session of the current size
+        self.window = None  # Fixations detected by I-VT in the current session
+        os.makedirs(data_dir, exist_ok=True)
+
+    def prepare(self, frames: int) -> Tuple[Dict[str, str], Dict[str, np.ndarray]]:
+        """
+        Generate the sessions of a size unless they exist.
+
+        :param frames: Integer number of frames.
+        :return: Tuple containing the paths (csv, gaze and eval) and the ground truth of the session.
+        """
+        alpha, beta = self.generator.param
+        stem = os.path.join(self.data_dir, "synthetic_%d_%d_%g_%g" % (frames, self.generator.seed, alpha, beta))
+        paths = {"csv": stem + ".csv", "gaze": stem + ".gaze", "eval": stem + "_eval.gaze"}
+        data, truth = self.generator.session(frames)
+        for name in ("csv", "gaze"):
+            if not os.path.exists(paths[name]):
+                write_columns(paths[name], data)
+        if not os.path.exists(paths["eval"]):
+            self.generator.write(paths["eval"], frames, evaluation=True)
+        truth["closed"] = data["opennessl"] < 0.5
+
+        self.fix = ExtractFixation()
+        self.fix.formatting(paths["gaze"])
+        self.fix.calculate_th()
+        self.window = self.fix.get_fixation_by_ivt(self.fix.duration_frame).astype(np.int64)
+        return paths, truth
+
+    @staticmethod
+    def memory_status() -> Dict[str, int]:
+        # Current and peak resident set size in bytes (empty where /proc is not available)
+        try:
+            with open("/proc/self/status") as f:
+                return {line.split(":")[0]: int(line.split()[1]) * 1024 for line in f
+                        if line.startswith(("VmRSS:", "VmHWM:"))}
+        except OSError:
+            return {}
+
+    def trace_peak(self, func: Callable[[], object]) -> Tuple[float, object]:
+        """
+        Run a stage and get its peak memory above the memory before the run.
+
+        On Linux the freed memory is returned to the system and the peak resident set size is reset before the run
+        (/proc/self/clear_refs), which adds no overhead to the allocations. Elsewhere the allocations are traced by
+        tracemalloc.
+
+        :return: Tuple containing the peak memory (bytes) and the result.
+        """
+        try:
+            # Return the freed memory to the system so that its reuse is counted
+            ctypes.CDLL(ctypes.util.find_library("c")).malloc_trim(0)
+        except (OSError, AttributeError, TypeError):
+            pass
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            before = self.memory_status()["VmRSS"]
+        except (OSError, KeyError):
+            tracemalloc.start()
+            try:
+                result = func()
+                return tracemalloc.get_traced_memory()[1], result
+            finally:
+                tracemalloc.stop()
+        result = func()
+        return self.memory_status()["VmHWM"] - before, result
+
+    def measure(self, func: Callable[[], object]) -> Tuple[float, float, object]:
+        """
+        Time a stage and measure its peak memory.
+
+        :param func: Function running the stage.
+        :return: Tuple containing the best time (sec), the peak memory (bytes, nan if not measured) and the result.
+        """
+        seconds = np.inf
+        result = None
+        for _ in range(self.repeat):
+            # The result of the previous run is released before the next one
+            result = None
+            gc.collect()
+            start = perf_counter()
+            result = func()
+            seconds = min(seconds, perf_counter() - start)
+        peak = np.nan
+        if self.memory:
+            result = None
+            gc.collect()
+            peak, result = self.trace_peak(func)
+        return seconds, peak, result
+
+    def recall(self, window: np.ndarray, truth: Dict[str, np.ndarray]) -> Tuple[float, float]:
+        """
+        Compare detected fixations with the ground truth.
+
+        :return: Tuple containing the fraction of the true fixations (lasting the duration threshold without a blink)
+            overlapped by a detected one and the fraction of the detected fixations overlapping a true one.
+        """
+        fixation = truth["fixation"]
+        closed = np.concatenate([[0], np.cumsum(truth["closed"])])
+        long = (fixation[:, 1] - fixation[:, 0] >= self.fix.duration_frame) & (
+                closed[fixation[:, 1]] == closed[fixation[:, 0]])
+
+        def overlapped(a, b):
+            # Whether each interval of a overlaps an interval of b (b sorted)
+            last = np.searchsorted(b[:, 0], a[:, 1], side="left") - 1
+            return (last >= 0) & (b[np.maximum(last, 0), 1] > a[:, 0])
+
+        found = overlapped(fixation[long], window)
+        matched = overlapped(window, fixation)
+        return float(found.mean()) if found.size else np.nan, float(matched.mean()) if matched.size else np.nan
+
+    def stage_formatting_csv(self, paths, truth):
+        return self.stage_formatting(paths["csv"], truth)
+
+    def stage_formatting_gaze(self, paths, truth):
+        return self.stage_formatting(paths["gaze"], truth)
+
+    @staticmethod
+    def stage_formatting(path, truth):
+        def run():
+            fix = ExtractFixation()
+            fix.formatting(path)
+            return fix
+
+        def check(fix):
+            closed = np.isnan(fix.ray).any(axis=1)
+            return bool(np.array_equal(closed, truth["closed"])), "closed frames %d" % closed.sum()
+        return run, check
+
+    def stage_ivt(self, paths, truth):
+        return self.stage_velocity(self.fix.get_fixation_by_ivt, truth)
+
+    def stage_ivt_world(self, paths, truth):
+        return self.stage_velocity(self.fix.get_fixation_by_ivt_world, truth)
+
+    def stage_velocity(self, detector, truth):
+        def check(window):
+            recall, precision = self.recall(window.astype(np.int64), truth)
+            return recall >= 0.9 and precision >= 0.9, "fixations %d, recall %.3f, precision %.3f" % (
+                window.shape[0], recall, precision)
+        return lambda: detector(self.fix.duration_frame), check
+
+    def stage_head_move(self, paths, truth):
+        def run():
+            return np.array([self.fix.calculate_head_move(fix_on, fix_off) for fix_on, fix_off in self.window])
+
+        def check(dis):
+            expected = np.array([pdist(self.fix.EyeToWorldPos[fix_on:fix_off]).max()
+                                 for fix_on, fix_off in self.window[:100]])
+            diff = float(np.max(np.abs(dis[:100] - expected))) if expected.size else 0.0
+            return diff < 1e-9, "max displacement %.4f m, diff %.1e" % (float(dis.max()), diff)
+        return run, check
+
+    def stage_features(self, paths, truth):
+        def check(features):
+            expected = np.array([pdist(self.fix.EyeToWorldPos[fix_on:fix_off]).max()
+                                 for fix_on, fix_off in self.window[:100]])
+            diff = float(np.max(np.abs(features["eye_move"][:100] - expected))) if expected.size else 0.0
+            return diff < 1e-9, "fixations %d, max dispersion %.2f deg, diff %.1e" % (
+                features.shape[0], float(np.nanmax(features["dispersion"])), diff)
+        return lambda: self.fix.get_fixation_features(self.window), check
+
+    def stage_calibrate_3d(self, paths, truth):
+        param = EvaluateGaze.get_rotation(self.generator.param).flatten()
+
+        def check(calib_ray):
+            # Angle from the true directions in the middle frames of the true fixations
+            fixation = truth["fixation"]
+            frame = (fixation[:, 0] + fixation[:, 1]) // 2
+            frame = frame[~truth["closed"][frame]]
+            target = truth["target"][np.searchsorted(fixation[:, 0], frame, side="right") - 1]
+            direction = np.matmul(np.swapaxes(self.fix.CamToWorldMat[frame], 1, 2),
+                                  (target - self.fix.EyeToWorldPos[frame])[:, :, np.newaxis])[:, :, 0]
+            angle = np.mean([self.fix.calculate_angle(a, b) for a, b in zip(calib_ray[frame], direction)])
+            return angle < 3.0 * self.generator.noise, "mean angular error %.3f deg" % angle
+        return lambda: EvaluateGaze.calibrate_3d(param, self.fix.base_ray), check
+
+    def stage_absolute_error(self, paths, truth):
+        param = EvaluateGaze.get_rotation(self.generator.param).flatten()
+
+        def check(error):
+            return error < 3.0 * self.generator.noise, "absolute error %.3f deg" % error
+        return lambda: EvaluateGaze.get_absolute_error(paths["eval"], self.param_base, param), check
+
+    def stage_objective(self, paths, truth):
+        optimizer = OptimizeGaze(self.raycaster(self.fix))
+        optimizer.set_fixation(self.fix, self.window)
+        optimizer.remove_fixation([0.0, 0.0])
+        # Ground truth and its neighbours 1 degree apart
+        offset = np.array([[0, 0], [1, 0], [-1, 0], [0, 1], [0, -1], [1, 1], [1, -1], [-1, 1], [-1, -1]])
+        candidates = self.generator.param + offset
+
+        def check(error):
+            return int(np.argmin(error)) == 0, "objective %.5f at the ground truth, %.5f at the best neighbour" % (
+                error[0], np.min(error[1:]))
+        return lambda: optimizer.error_func_batch(candidates.T), check
+
+    def stage_pipeline(self, paths, truth):
+        def run():
+            fix = ExtractFixation()
+            fix.formatting(paths["gaze"])
+            fix.calculate_th()
+            window = fix.get_fixation_by_ivt(fix.duration_frame)
+            optimizer = OptimizeGaze(self.raycaster(fix))
+            optimizer.set_fixation(fix, window)
+
+            # Coarse-to-fine search over +-5 degrees on a 1 degree grid
+            estimate, _ = optimizer.optimize_coarse_to_fine([0.0, 0.0], grid=11)
+            param = EvaluateGaze.get_rotation(estimate).flatten()
+            return estimate, EvaluateGaze.get_absolute_error(paths["eval"], self.param_base, param), optimizer.stats
+
+        def check(result):
+            param, error, stats = result
+            diff = float(np.max(np.abs(param - self.generator.param)))
+            return diff < 0.5, "estimate (%.2f, %.2f), absolute error %.3f deg, %d evaluations" % (
+                param[0], param[1], error, stats["evaluations"])
+        return run, check
+
+    @staticmethod
+    def raycaster(fix: ExtractFixation) -> HitPointProxy:
+        ray_world = np.matmul(fix.CamToWorldMat, fix.ray[:, :, np.newaxis])[:, :, 0]
+        return HitPointProxy(fix.PoR, ray_world)
+
+    def run(self, stages: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Run the stages at every session length.
+
+        :param stages: List of the stages (all stages if None).
+        :return: DataFrame of the time, the peak memory and the check of each stage and length.
+        """
+        stages = self.stages if stages is None else stages
+        rows = []
+        for frames in self.sizes:
+            paths, truth = self.prepare(frames)
+            for stage in stages:
+                func, check = getattr(self, "stage_" + stage)(paths, truth)
+                seconds, peak, result = self.measure(func)
+                passed, detail = check(result)
+                rows.append({"stage": stage, "frames": frames, "seconds": seconds, "peak_mb": peak / (1 << 20),
+                             "frames_per_sec": frames / seconds, "passed": bool(passed), "check": detail})
+                print("%-16s %8d frames %10.4f s %10.1f MB  %s  %s" % (
+                    stage, frames, seconds, peak / (1 << 20), "ok  " if passed else "FAIL", detail), flush=True)
+        return pd.DataFrame(rows)
+
+    @staticmethod
+    def scaling(results: pd.DataFrame) -> pd.DataFrame:
+        """
+        Estimate the scaling exponents (slopes of log time and log memory against log frames).
+
+        :param results: DataFrame returned by run.
+        :return: DataFrame of the exponents of each stage.
+        """
+        rows = []
+        for stage, group in results.groupby("stage", sort=False):
+            row = {"stage": stage, "time_exponent": np.nan, "memory_exponent": np.nan}
+            if group["frames"].nunique() > 1:
+                frames = np.log(group["frames"].to_numpy(dtype=np.float64))
+                row["time_exponent"] = np.polyfit(frames, np.log(group["seconds"].to_numpy()), 1)[0]
+                peak = group["peak_mb"].to_numpy()
+                if np.all(peak > 0):
+                    row["memory_exponent"] = np.polyfit(frames, np.log(peak), 1)[0]
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the self-calibration stages on synthetic gaze sessions.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="Numbers of frames of the sessions")
+    parser.add_argument("--stages", nargs="+", choices=BenchmarkGaze.stages, help="Stages to run (all by default)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs of each stage")
+    parser.add_argument("--no-memory", action="store_true", help="Do not trace the peak memory")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "gaze_benchmark"),
+                        help="Directory of the synthetic sessions")
+    parser.add_argument("--param", type=float, nargs=2, default=[2.0, -1.5], metavar=("ALPHA", "BETA"),
+                        help="Ground-truth parameters (degrees)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the sessions")
+    parser.add_argument("--output", help="CSV file of the results")
+    args = parser.parse_args()
+
+    benchmark = BenchmarkGaze(args.data_dir, tuple(args.sizes), args.repeat, not args.no_memory,
+                              tuple(args.param), args.seed)
+    results = benchmark.run(args.stages)
+    print()
+    print(BenchmarkGaze.scaling(results).to_string(index=False, float_format="%.2f"))
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
+    if not results["passed"].all():
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
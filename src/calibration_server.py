@@ -0,0 +1,434 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from extract_fixation import ExtractFixation
+from fixation_cache import FixationCache
+from instrumentation import Instrumentation, JsonLinesSink
+from optimize_gaze import OptimizeGaze
+from scene_geometry import HitPointProxy, TriangleMesh
+
+# Header of a message: length of the JSON body (unsigned 32-bit little endian)
+_header = struct.Struct("<I")
+# Alignment of the arrays in a shared memory segment (bytes)
+_align = 64
+# Keys of the descriptor of an array in shared memory
+_descriptor = {"shm", "offset", "dtype", "shape"}
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    # Attach to a segment of the other process without registering it to the resource tracker of this process,
+    # which would unlink it when this process exits
+    segment = shared_memory.SharedMemory(name=name)
+    if os.name == "posix":
+        resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+def _map_arrays(message, func):
+    # Apply func to the numpy arrays held by the dictionaries and lists of a message
+    if isinstance(message, np.ndarray):
+        return func(message)
+    if isinstance(message, dict):
+        return {key: _map_arrays(value, func) for key, value in message.items()}
+    if isinstance(message, (list, tuple)):
+        return [_map_arrays(value, func) for value in message]
+    return message
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("%s is not JSON serializable" % type(value).__name__)
+
+
+def pack_arrays(message, dtype: Optional[str] = None) -> Tuple[object, Optional[shared_memory.SharedMemory]]:
+    """
+    Copy the numpy arrays of a message into one new shared memory segment.
+
+    Each array is replaced by its descriptor {"shm": name, "offset": bytes, "dtype": str, "shape": list}. The arrays
+    are written straight into the segment, converting the float arrays to dtype on the way.
+
+    :param message: Dictionaries and lists holding the arrays.
+    :param dtype: Dtype of the float arrays in the segment (as they are if None).
+    :return: Tuple containing the message with the descriptors and the segment (None if there is no array).
+    """
+    def target(array):
+        return np.dtype(dtype) if dtype is not None and array.dtype.kind == "f" else array.dtype
+
+    arrays = []
+    _map_arrays(message, arrays.append)
+    if not arrays:
+        return message, None
+    size = sum(-(-array.size * target(array).itemsize // _align) * _align for array in arrays)
+    segment = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    offset = 0
+
+    def place(array):
+        nonlocal offset
+        view = np.ndarray(array.shape, target(array), buffer=segment.buf, offset=offset)
+        np.copyto(view, array, casting="same_kind")
+        descriptor = {"shm": segment.name, "offset": offset, "dtype": view.dtype.str, "shape": list(array.shape)}
+        offset += -(-view.nbytes // _align) * _align
+        return descriptor
+    return _map_arrays(message, place), segment
+
+
+def unpack_arrays(message, segments: Dict[str, shared_memory.SharedMemory]):
+    """
+    Replace the descriptors of a message by copies of the arrays (the only copy on the receiving side, as the
+    segment is released after the message).
+
+    :param message: Dictionaries and lists holding the descriptors.
+    :param segments: Dictionary of the attached segments keyed on the name (the segments attached here are added,
+        and are to be closed by the caller).
+    :return: Message with the arrays.
+    """
+    if isinstance(message, dict):
+        if set(message) == _descriptor:
+            if message["shm"] not in segments:
+                segments[message["shm"]] = _attach(message["shm"])
+            view = np.ndarray(message["shape"], np.dtype(message["dtype"]), buffer=segments[message["shm"]].buf,
+                              offset=message["offset"])
+            return view.copy()
+        return {key: unpack_arrays(value, segments) for key, value in message.items()}
+    if isinstance(message, list):
+        return [unpack_arrays(value, segments) for value in message]
+    return message
+
+
+class CalibrationServer:
+    """
+    Long-lived worker serving the fixation extraction and the calibration over a local socket (Unix or localhost).
+
+    A message is the length of its JSON body (unsigned 32-bit little endian) followed by the body. A request is
+    {"id": ..., "method": ..., "params": {...}, "release": [...]} and its response is {"id": ..., "result": {...}} or
+    {"id": ..., "error": "..."}. The bulk arrays are not sent through the socket: the arrays of a message are copied
+    into one shared memory segment (pack_arrays) and replaced by their descriptors. The segment of a response is kept
+    until the client lists its name in "release" of a later request (after copying the arrays) or disconnects; the
+    segment of a request belongs to the client.
+
+    The formatted gaze data of the last max_sessions files are kept, so that later requests on a file skip the
+    loading. The requests run one at a time in a worker thread while the loop keeps serving the connections.
+    """
+
+    methods = ["ping", "session", "extract_fixation", "calibrate", "shutdown"]
+
+    def __init__(self, max_sessions: int = 4, metrics_path: Optional[str] = None):
+        """
+        :param max_sessions: Maximum number of formatted gaze data kept.
+        :param metrics_path: Path of the JSON lines file of the instrumentation of each request (not recorded if None).
+        """
+        self.max_sessions = max_sessions
+        self.metrics_path = metrics_path
+        self.sessions = OrderedDict()  # ExtractFixation keyed on the path, modification time and size of the file
+        self.meshes = {}  # TriangleMesh keyed on the path, modification time and size of the file
+        self.segments = {}  # Segments of the responses not released yet
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stop = None
+
+    @staticmethod
+    def file_key(path: str) -> Tuple[str, int, int]:
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+    def load(self, file: str) -> ExtractFixation:
+        """
+        Get the formatted gaze data of a file, formatting it unless it is kept.
+        """
+        key = self.file_key(file)
+        if key in self.sessions:
+            self.sessions.move_to_end(key)
+            return self.sessions[key]
+        fix = ExtractFixation()
+        fix.formatting(file)
+        self.sessions[key] = fix
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        return fix
+
+    def detect(self, file: str, detector: str, dig_per_sec: float, duration: float, dispersion_th: float,
+               window: Optional[np.ndarray]) -> Tuple[ExtractFixation, np.ndarray]:
+        # Detect the fixations with the thresholds of the request (the given windows are used as they are)
+        if detector not in FixationCache.detectors:
+            raise ValueError("unknown detector: %s" % detector)
+        fix = self.load(file)
+        fix.duration = duration
+        fix.dispersion_th = dispersion_th
+        fix.calculate_th(dig_per_sec)
+        if window is None:
+            window = getattr(fix, FixationCache.detectors[detector])(fix.duration_frame)
+        return fix, np.asarray(window, dtype=np.int64).reshape(-1, 2)
+
+    def request_ping(self) -> dict:
+        return {"pid": os.getpid(), "methods": self.methods, "sessions": [key[0] for key in self.sessions]}
+
+    def request_session(self, file: str, dig_per_sec: float = 100, duration: float = 0.2,
+                        dtype: str = "float64") -> dict:
+        """
+        Get the formatted gaze data of all frames (ExtractFixation.formatting). The float arrays are converted to
+        dtype as they are written into the segment of the response.
+
+        :return: Dictionary containing ray (N, 3), CamToWorldMat (N, 3, 3), WorldToCamMat (N, 3, 3),
+            EyeToWorldPos (N, 3), PoR (N, 3, if recorded), frame (N,), fs and duration_frame.
+        """
+        fix = self.load(file)
+        fix.duration = duration  # The kept gaze data hold the duration of the previous request
+        fix.calculate_th(dig_per_sec)
+        result = {"ray": fix.ray, "CamToWorldMat": fix.CamToWorldMat, "WorldToCamMat": fix.WorldToCamMat[:, :3, :3],
+                  "EyeToWorldPos": fix.EyeToWorldPos, "frame": fix.frame,
+                  "fs": fix.fs, "duration_frame": fix.duration_frame}
+        if fix.PoR is not None:
+            result["PoR"] = fix.PoR
+        return result
+
+    def request_extract_fixation(self, file: str, detector: str = "ivt", dig_per_sec: float = 100,
+                                 duration: float = 0.2, dispersion_th: float = 0.00015, window=None,
+                                 dtype: str = "float64") -> dict:
+        """
+        Detect the fixations and gather their frames (OptimizeUtil.ExtractFixationByIVT and ExtractFixation).
+
+        The frames of fixation i are offsets[i]:offsets[i + 1] of the frame arrays. The float arrays are converted to
+        dtype as they are written into the segment of the response.
+
+        :return: Dictionary containing window (M, 2), offsets (M + 1,), base_ray (F, 3), CamToWorldMat (F, 3, 3),
+            WorldToCamMat (F, 3, 3), EyeToWorldPos (F, 3), eye_move (M,), fs and duration_frame.
+        """
+        fix, window = self.detect(file, detector, dig_per_sec, duration, dispersion_th, window)
+        window = window[window[:, 1] > window[:, 0]]
+        length = window[:, 1] - window[:, 0]
+        frame = np.concatenate([np.arange(fix_on, fix_off) for fix_on, fix_off in window] + [np.empty(0, np.int64)])
+        return {"window": window, "offsets": np.concatenate([[0], np.cumsum(length)]).astype(np.int64),
+                "base_ray": fix.base_ray[frame], "CamToWorldMat": fix.CamToWorldMat[frame],
+                "WorldToCamMat": fix.WorldToCamMat[frame, :3, :3], "EyeToWorldPos": fix.EyeToWorldPos[frame],
+                "eye_move": fix.get_fixation_features(window)["eye_move"],
+                "fs": fix.fs, "duration_frame": fix.duration_frame}
+
+    def request_calibrate(self, file: str, detector: str = "ivt", dig_per_sec: float = 100, duration: float = 0.2,
+                          dispersion_th: float = 0.00015, window=None, param_ini: List[float] = (0.0, 0.0),
+                          solver: str = "coarse_to_fine", options: Optional[dict] = None,
+                          mesh: Optional[str] = None) -> dict:
+        """
+        Estimate the calibration parameters from the fixations (OptimizeDE.Optimize).
+
+        The points of regard are obtained from the scene mesh (an OBJ file or a file saved by TriangleMesh.save) if
+        given, or else from the recorded points of regard (HitPointProxy).
+
+        :param solver: Solver of OptimizeGaze ("coarse_to_fine" or "de" for optimize).
+        :param options: Dictionary of the keyword arguments of the solver.
+        :return: Dictionary containing param (alpha, beta), value, stats, fixations and removed (non-hit fixations).
+        """
+        fix, window = self.detect(file, detector, dig_per_sec, duration, dispersion_th, window)
+        if mesh is not None:
+            key = self.file_key(mesh)
+            if key not in self.meshes:
+                self.meshes = {key: TriangleMesh.from_obj(mesh) if mesh.lower().endswith(".obj")
+                               else TriangleMesh.load(mesh)}
+            raycaster = self.meshes[key]
+        elif fix.PoR is not None:
+            ray_world = np.matmul(fix.CamToWorldMat, fix.ray[:, :, np.newaxis])[:, :, 0]
+            raycaster = HitPointProxy(fix.PoR, ray_world)
+        else:
+            raise ValueError("points of regard are required: record xc, yc, zc or pass mesh")
+
+        optimizer = OptimizeGaze(raycaster)
+        optimizer.set_fixation(fix, window)
+        if solver == "coarse_to_fine":
+            param, value = optimizer.optimize_coarse_to_fine(list(param_ini), **(options or {}))
+        elif solver == "de":
+            param, value = optimizer.optimize(list(param_ini), **(options or {}))
+        else:
+            raise ValueError("unknown solver: %s" % solver)
+        return {"param": [float(p) for p in param], "value": float(value), "stats": optimizer.stats,
+                "fixations": optimizer.fix_count, "removed": len(optimizer.remove_list)}
+
+    def request_shutdown(self) -> dict:
+        return {}
+
+    def respond(self, request: dict) -> Tuple[bytes, Optional[shared_memory.SharedMemory]]:
+        """
+        Run a request (in the worker thread).
+
+        :return: Tuple containing the body of the response and its segment (None if there is no array).
+        """
+        method = request.get("method")
+        segment = None
+        try:
+            if method not in self.methods:
+                raise ValueError("unknown method: %s" % method)
+            segments = {}
+            try:
+                params = unpack_arrays(request.get("params", {}), segments)
+            finally:
+                for attached in segments.values():
+                    attached.close()
+            if self.metrics_path is None:
+                result = getattr(self, "request_" + method)(**params)
+            else:
+                with Instrumentation(JsonLinesSink(self.metrics_path), run=method, memory=True):
+                    result = getattr(self, "request_" + method)(**params)
+            # The float arrays of the result are converted to the dtype of the request in the segment
+            result, segment = pack_arrays(result, params.get("dtype", "float64"))
+            response = {"id": request.get("id"), "result": result}
+        except Exception as error:
+            response = {"id": request.get("id"), "error": "%s: %s" % (type(error).__name__, error)}
+        return json.dumps(response, default=_json_default).encode("utf-8"), segment
+
+    @staticmethod
+    def release_segment(segment: Optional[shared_memory.SharedMemory]):
+        if segment is not None:
+            segment.close()
+            segment.unlink()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Serve the requests of a client one after another
+        loop = asyncio.get_running_loop()
+        owned = set()  # Segments of the responses to this client not released yet
+        try:
+            while True:
+                try:
+                    size = _header.unpack(await reader.readexactly(_header.size))[0]
+                    request = json.loads(await reader.readexactly(size))
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                for name in request.get("release", []):
+                    if name in owned:
+                        owned.discard(name)
+                        self.release_segment(self.segments.pop(name))
+                body, segment = await loop.run_in_executor(self.executor, self.respond, request)
+                if segment is not None:
+                    self.segments[segment.name] = segment
+                    owned.add(segment.name)
+                writer.write(_header.pack(len(body)) + body)
+                await writer.drain()
+                if request.get("method") == "shutdown":
+                    self.stop.set()
+                    break
+        finally:
+            for name in owned:
+                self.release_segment(self.segments.pop(name))
+            writer.close()
+
+    async def serve(self, path: Optional[str] = None, host: str = "127.0.0.1", port: int = 8765):
+        """
+        Serve until a shutdown request.
+
+        :param path: Path of the Unix socket (localhost TCP if None).
+        :param host: Host of the TCP socket.
+        :param port: Port of the TCP socket.
+        """
+        self.stop = asyncio.Event()
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        try:
+            async with server:
+                print("listening on %s" % (path or "%s:%d" % server.sockets[0].getsockname()[:2]), flush=True)
+                await self.stop.wait()
+        finally:
+            self.executor.shutdown()
+            for segment in self.segments.values():
+                self.release_segment(segment)
+            self.segments.clear()
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+
+class CalibrationClient:
+    """
+    Blocking client of CalibrationServer (the same protocol can be implemented by other clients, e.g. Unity).
+
+    The arrays of the parameters are sent through one shared memory segment per request, and the arrays of a result
+    are copied out of the segment of the response, which is released with the next request.
+    """
+
+    def __init__(self, path: Optional[str] = None, host: str = "127.0.0.1", port: int = 8765,
+                 timeout: Optional[float] = None):
+        """
+        :param path: Path of the Unix socket (localhost TCP if None).
+        :param host: Host of the TCP socket.
+        :param port: Port of the TCP socket.
+        :param timeout: Timeout of the socket (sec).
+        """
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.next_id = 0
+        self.release = []  # Segments of the responses to be released by the next request
+
+    def __enter__(self) -> "CalibrationClient":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        # The server releases the remaining segments of the client on disconnection
+        self.sock.close()
+
+    def receive(self, size: int) -> bytearray:
+        data = bytearray(size)
+        view = memoryview(data)
+        while view:
+            count = self.sock.recv_into(view)
+            if count == 0:
+                raise ConnectionError("connection closed by the server")
+            view = view[count:]
+        return data
+
+    def call(self, method: str, **params):
+        """
+        Run a request on the server.
+
+        :param method: Name of the method (CalibrationServer.methods).
+        :param params: Parameters of the method (numpy arrays are sent through shared memory).
+        :return: Result of the method.
+        """
+        params, segment = pack_arrays(params)
+        try:
+            request = {"id": self.next_id, "method": method, "params": params, "release": self.release}
+            body = json.dumps(request, default=_json_default).encode("utf-8")
+            self.next_id += 1
+            self.release = []
+            self.sock.sendall(_header.pack(len(body)) + body)
+            response = json.loads(self.receive(_header.unpack(self.receive(_header.size))[0]))
+        finally:
+            CalibrationServer.release_segment(segment)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+
+        segments = {}
+        try:
+            return unpack_arrays(response["result"], segments)
+        finally:
+            for attached in segments.values():
+                attached.close()
+            self.release += list(segments)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the fixation extraction and the calibration on a local socket.")
+    parser.add_argument("--socket", help="Path of the Unix socket (localhost TCP if not given)")
+    parser.add_argument("--host", default="127.0.0.1", help="Host of the TCP socket")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the TCP socket")
+    parser.add_argument("--max-sessions", type=int, default=4, help="Number of formatted gaze data kept")
+    parser.add_argument("--metrics", help="JSON lines file of the timers, counters and memory of each request")
+    args = parser.parse_args()
+
+    server = CalibrationServer(args.max_sessions, args.metrics)
+    asyncio.run(server.serve(args.socket, args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
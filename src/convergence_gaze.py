@@ -0,0 +1,206 @@
+import argparse
+from time import perf_counter
+from typing import List, Tuple
+import numpy as np
+import pandas as pd
+from scipy.optimize import Bounds, minimize
+from extract_fixation import ExtractFixation
+from fixation_cache import FixationCache
+from optimize_gaze import OptimizeGaze
+from scene_geometry import HitPointProxy, TriangleMesh
+
+
+class ConvergenceGaze:
+    """
+    Calibration on growing amounts of the data of a session (param/exp_distance) sharing the work between the amounts.
+
+    The objective of OptimizeGaze is a sum over the fixations, so the reprojection error of each fixation at the nodes
+    of a grid x grid surface over +-5 degrees (as OptimizeGaze.optimize_coarse_to_fine) is kept: an amount only
+    evaluates the fixations not seen before, and its error surface is the sum over its fixations. The estimate of an
+    amount is refined by the Nelder-Mead method from the estimate of the previous amount (warm start), or from the
+    best node of the surface if it is lower. An amount with the same fixations as the previous one keeps its estimate.
+    """
+
+    def __init__(self, fix: ExtractFixation, raycaster, param_ini: Tuple[float, float] = (0.0, 0.0), grid: int = 21,
+                 xatol: float = 0.001, fatol: float = 1e-9, maxfev: int = 200, max_distance: float = 100.0):
+        """
+        :param fix: ExtractFixation holding the formatted gaze data of the whole session.
+        :param raycaster: Scene representation providing raycast(origin, direction, frame, max_distance).
+        :param param_ini: Initial parameters (alpha, beta) used to remove the fixations.
+        :param grid: Integer number of nodes of the surface along each parameter.
+        :param xatol: Absolute tolerance of the parameters in the local optimizer.
+        :param fatol: Absolute tolerance of the objective in the local optimizer.
+        :param maxfev: Maximum number of evaluations of the local optimizer for an amount.
+        :param max_distance: Maximum distance of the raycast.
+        """
+        self.fix = fix
+        self.optimizer = OptimizeGaze(raycaster, max_distance=max_distance)
+        self.param_ini = list(param_ini)
+        axis = np.linspace(-5.0, 5.0, grid)
+        self.step = axis[1] - axis[0]
+        self.nodes = np.stack(np.meshgrid(axis, axis, indexing="ij"), axis=2).reshape(-1, 2)
+        self.xatol = xatol
+        self.fatol = fatol
+        self.maxfev = maxfev
+
+        self.errors = np.empty([grid * grid, 0])  # Reprojection error of each fixation at the nodes
+        self.windows = {}  # Fixations of each window (start, stop) added so far
+        self.non_hit = np.empty(0, dtype=bool)  # Fixations with non-collision gaze directions at param_ini
+        self.active = np.empty(0, dtype=bool)  # Fixations of the current amount
+        self.changed = True  # Whether the fixations differ from the previous amount
+        self.param = None  # Estimate of the previous amount
+        self.value = None
+        self.stats = {}  # Number of evaluations of the last amount
+
+    def set_window(self, window: np.ndarray) -> int:
+        """
+        Select the fixations of an amount, adding the windows not seen before (a window listed twice is counted twice).
+
+        :param window: Numpy array (M, 2) representing the start and end frames of the fixations.
+        :return: Integer number of fixations added.
+        """
+        window = np.asarray(window).astype(np.int64).reshape(-1, 2)
+        window = window[window[:, 1] > window[:, 0]]
+        pairs = list(map(tuple, window.tolist()))
+
+        # Reuse the fixations of the windows seen before
+        first = self.optimizer.fix_count
+        index = np.empty(len(pairs), dtype=np.int64)
+        used = {}
+        new = []
+        for i, pair in enumerate(pairs):
+            seen = self.windows.setdefault(pair, [])
+            used[pair] = used.get(pair, 0) + 1
+            if used[pair] <= len(seen):
+                index[i] = seen[used[pair] - 1]
+            else:
+                index[i] = first + len(new)
+                seen.append(index[i])
+                new.append(i)
+
+        if new:
+            self.optimizer.set_fixation(self.fix, window[new])
+            # The representative camera of a fixation depends only on its frames, so those of the fixations seen
+            # before do not change
+            self.non_hit = np.zeros(self.optimizer.fix_count, dtype=bool)
+            self.non_hit[self.optimizer.remove_fixation(self.param_ini)] = True
+            self.errors = np.concatenate([self.errors, self.optimizer.fixation_errors(self.nodes, first)], axis=1)
+
+        active = np.zeros(self.optimizer.fix_count, dtype=bool)
+        active[index] = True
+        self.changed = bool(new) or not np.array_equal(active, self.active)
+        self.active = active
+        # Fixations out of the amount are skipped as the non-hit ones
+        self.optimizer.remove_list = np.flatnonzero(self.non_hit | ~self.active).tolist()
+        return len(new)
+
+    def optimize(self) -> Tuple[np.ndarray, float]:
+        """
+        Estimate the calibration parameters of the current amount.
+
+        :return: Tuple containing the estimated parameters and the value of the objective.
+        """
+        if not self.changed and self.param is not None:
+            self.stats = {"evaluations": 0, "warm": True}
+            return self.param, self.value
+        evaluations = self.optimizer.evaluations
+
+        # Error surface of the amount (error_func_batch at the nodes)
+        keep = self.active & ~self.non_hit
+        surface = np.nansum(self.errors[:, keep], axis=1)
+        best = int(np.argmin(surface))
+        start, size, warm = self.nodes[best], self.step / 2, False
+        if self.param is not None:
+            value = self.optimizer.error_func(self.param)
+            if value <= surface[best]:
+                start, size, warm = self.param, self.step / 16, True
+
+        # Initial simplex turned back inside the bounds
+        simplex = start + np.array([[0.0, 0.0], [size, 0.0], [0.0, size]])
+        simplex = np.where(simplex > 5.0, 2.0 * start - simplex, simplex)
+        result = minimize(self.optimizer.error_func, start, method="Nelder-Mead", bounds=Bounds([-5.0, -5.0], [5.0, 5.0]),
+                          options={"xatol": self.xatol, "fatol": self.fatol, "maxfev": self.maxfev,
+                                   "initial_simplex": simplex})
+        self.param, self.value = result.x, float(result.fun)
+        if surface[best] < self.value:
+            self.param, self.value = self.nodes[best], float(surface[best])
+        self.changed = False
+        self.stats = {"evaluations": self.optimizer.evaluations - evaluations, "warm": warm}
+        return self.param, self.value
+
+    def curve(self, windows: List[np.ndarray]) -> pd.DataFrame:
+        """
+        Estimate the calibration parameters of each amount in order.
+
+        :param windows: List of numpy arrays (M, 2) representing the fixations of each amount.
+        :return: DataFrame of the number of fixations, the fixations added, the estimate (alpha, beta), the value of
+            the objective, the evaluations of the local optimizer and the elapsed time of each amount.
+        """
+        rows = []
+        for window in windows:
+            start = perf_counter()
+            added = self.set_window(window)
+            param, value = self.optimize()
+            rows.append({"fixations": int(self.active.sum()), "added": added, "alpha": param[0], "beta": param[1],
+                         "value": value, "evaluations": self.stats["evaluations"],
+                         "seconds": perf_counter() - start})
+        return pd.DataFrame(rows)
+
+    @staticmethod
+    def prefix_windows(window: np.ndarray, stops: List[int]) -> List[np.ndarray]:
+        """
+        Split the fixations of a session into the fixations ending before each amount of frames.
+
+        :param window: Numpy array (M, 2) representing the start and end frames of the fixations.
+        :param stops: List of the numbers of frames of the amounts.
+        :return: List of numpy arrays representing the fixations of each amount.
+        """
+        window = np.asarray(window).astype(np.int64).reshape(-1, 2)
+        return [window[window[:, 1] <= stop] for stop in stops]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate on growing amounts of the data of a session.")
+    parser.add_argument("input", help="Gaze data of the session (CSV or gaze session file)")
+    parser.add_argument("--windows", help="Template of the CSV files of the fixations of each amount, formatted "
+                                          "with {point} (detected on the whole session if not given)")
+    parser.add_argument("--points", type=int, nargs="+", default=[10],
+                        help="First and last point of --windows, or the number of amounts of equal length")
+    parser.add_argument("--detector", default="ivt", choices=list(FixationCache.detectors), help="Fixation detector")
+    parser.add_argument("--dig-per-sec", type=float, default=100, help="Velocity threshold (degrees per second)")
+    parser.add_argument("--duration", type=float, default=0.2, help="Duration threshold (sec)")
+    parser.add_argument("--dispersion", type=float, default=0.00015, help="Dispersion threshold of idt and ivdt")
+    parser.add_argument("--mesh", help="Scene mesh (OBJ or TriangleMesh.save) instead of the recorded points of regard")
+    parser.add_argument("--param-ini", type=float, nargs=2, default=[0.0, 0.0], help="Initial parameters")
+    parser.add_argument("--grid", type=int, default=21, help="Number of nodes of the surface along each parameter")
+    parser.add_argument("--output", help="CSV file of the curve")
+    args = parser.parse_args()
+
+    fix = ExtractFixation()
+    fix.duration = args.duration
+    fix.dispersion_th = args.dispersion
+    fix.formatting(args.input)
+    fix.calculate_th(args.dig_per_sec)
+    if args.windows is not None:
+        points = list(range(args.points[0], args.points[-1] + 1))
+        windows = [np.loadtxt(args.windows.format(point=point), delimiter=",", ndmin=2) for point in points]
+    else:
+        window = getattr(fix, FixationCache.detectors[args.detector])(fix.duration_frame)
+        points = list(range(1, args.points[0] + 1))
+        windows = ConvergenceGaze.prefix_windows(window, [fix.ray.shape[0] * point // points[-1] for point in points])
+
+    if args.mesh is not None:
+        raycaster = TriangleMesh.from_obj(args.mesh) if args.mesh.lower().endswith(".obj") else TriangleMesh.load(args.mesh)
+    else:
+        raycaster = HitPointProxy(fix.PoR, np.matmul(fix.CamToWorldMat, fix.ray[:, :, np.newaxis])[:, :, 0])
+
+    curve = ConvergenceGaze(fix, raycaster, args.param_ini, args.grid).curve(windows)
+    curve.insert(0, "point", points)
+    print(curve.to_string(index=False))
+    print(f"total {curve['seconds'].sum():.2f} s")
+    if args.output is not None:
+        curve.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,103 @@
 from typing import List, Tuple
 import numpy as np
-import pandas as pd
+import instrumentation
+from gaze_session import read_columns
 
 
 class EvaluateGaze:
     def __init__(self):
         pass
 
+    # Maximum number of values computed at once for a stack of parameters (K x N)
+    chunk_size = 1 << 22
+
     @staticmethod
-    def calibrate_reg(param: List[float],
+    def calibrate_reg(param: np.ndarray,
                       x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
         """
         calibration function using regression model.
 
-        :param param: List of float parameters for the regression model.
-        :param x: Numpy array representing the x-coordinate of the gaze direction.
-        :param y: Numpy array representing the y-coordinate of the gaze direction.
-        :return: Tuple containing calibrated x and y coordinates.
-        """
-        ones = np.ones_like(x)
-        zeros = np.zeros_like(x)
-        x_lis = np.array([ones, x, y, zeros, zeros, zeros])
-        y_lis = np.array([zeros, zeros, zeros, ones, x, y])
-        x_calib = np.dot(param, x_lis)
-        y_calib = np.dot(param, y_lis)
+        :param param: Numpy array (6,) or (K, 6) of float parameters for the regression model.
+        :param x: Numpy array (N,) representing the x-coordinate of the gaze direction.
+        :param y: Numpy array (N,) representing the y-coordinate of the gaze direction.
+        :return: Tuple containing calibrated x and y coordinates, (N,) or (K, N) for a stack of parameters.
+        """
+        param = np.asarray(param)
+        if param.ndim == 1:
+            # The product of the original code keeps the results of one parameter set bit-identical (the order of its
+            # sums is that of the BLAS)
+            ones = np.ones_like(x)
+            zeros = np.zeros_like(x)
+            x_calib = np.dot(param, np.array([ones, x, y, zeros, zeros, zeros]))
+            y_calib = np.dot(param, np.array([zeros, zeros, zeros, ones, x, y]))
+            return x_calib, y_calib
+        param = param.T[:, :, np.newaxis]
+        # affine map x' = p0 + p1 x + p2 y, y' = p3 + p4 x + p5 y
+        x_calib = param[1] * x
+        x_calib += param[2] * y
+        x_calib += param[0]
+        y_calib = param[4] * x
+        y_calib += param[5] * y
+        y_calib += param[3]
         return x_calib, y_calib
 
     @staticmethod
-    def calibrate_3d(param: List[float], ray: np.ndarray) -> np.ndarray:
+    def calibrate_3d(param: np.ndarray, ray: np.ndarray) -> np.ndarray:
         """
         calibration function using 3D eye model.
 
-        :param param: List of float parameters for the regression model.
-        :param ray: Numpy array representing the gaze direction.
-        :return: Numpy array containing the calibrated gaze direction.
+        :param param: Numpy array (9,) or (K, 9) of float parameters for the rotation matrix (row-major).
+        :param ray: Numpy array (N, 3) representing the gaze direction.
+        :return: Numpy array (N, 3) or (K, N, 3) containing the calibrated gaze direction.
         """
         # rotation matrix
-        rot = np.array([[param[0], param[1], param[2]],
-                        [param[3], param[4], param[5]],
-                        [param[6], param[7], param[8]]])
+        rot = np.asarray(param).reshape(-1, 3, 3).astype(ray.dtype, copy=False)
+
+        # calibration (rot @ ray for every row at once)
+        calib_ray = np.matmul(rot[:, np.newaxis], ray[:, :, np.newaxis])[..., 0]
+        return calib_ray[0] if np.ndim(param) == 1 else calib_ray
+
+    @staticmethod
+    def err_plane(calib_xe: np.ndarray, calib_ye: np.ndarray,
+                  eye_x: np.ndarray, eye_y: np.ndarray, eye_z: np.ndarray,
+                  p: np.ndarray, q: np.ndarray) -> np.ndarray:
+        """
+        Calculate the mean distance from the markers on the calibration plane at z=1, in place of calib_xe and calib_ye.
+
+        :param calib_xe: Numpy array (..., N) representing the x-coordinate of the gaze direction at z=1 (overwritten).
+        :param calib_ye: Numpy array (..., N) representing the y-coordinate of the gaze direction at z=1 (overwritten).
+        :param eye_x: Numpy array (N,) representing the x-coordinate of the eye position.
+        :param eye_y: Numpy array (N,) representing the y-coordinate of the eye position.
+        :param eye_z: Numpy array (N,) representing the z-coordinate of the eye position.
+        :param p: Numpy array (N,) representing the x-coordinate of the marker position.
+        :param q: Numpy array (N,) representing the y-coordinate of the marker position.
+        :return: Numpy array (...) representing the mean distance.
+        """
+        # convert gaze position on calibration plane at 1m away (HMD coordinates)
+        t = 1.0 - eye_z
+        err_x = calib_xe
+        err_x *= t
+        err_x += eye_x
+        err_y = calib_ye
+        err_y *= t
+        err_y += eye_y
 
-        # calibration
-        calib_ray_list = np.empty([0, 3])
-        for i in range(ray.shape[0]):
-            calib_ray = np.dot(rot, ray[i])
-            calib_ray_list = np.vstack([calib_ray_list, calib_ray])
-        return calib_ray_list
+        # calculate error
+        err_x -= p
+        err_y -= q
+        err_x *= err_x
+        err_y *= err_y
+        err_x += err_y
+        return np.mean(np.sqrt(err_x, out=err_x), axis=-1)
 
     @staticmethod
-    def err_rmse_reg(param: List[float], xe: np.ndarray, ye: np.ndarray,
+    def err_rmse_reg(param: np.ndarray, xe: np.ndarray, ye: np.ndarray,
                      eye_x: np.ndarray, eye_y: np.ndarray, eye_z: np.ndarray,
-                     p: np.ndarray, q: np.ndarray) -> float:
+                     p: np.ndarray, q: np.ndarray, dtype=None):
         """
         Calculate the square error using regression model.
 
-        :param param: List of float parameters for the regression model.
+        :param param: Numpy array (6,) or (K, 6) of float parameters for the regression model.
         :param xe: Numpy array representing the x-coordinate of the gaze direction.
         :param ye: Numpy array representing the y-coordinate of the gaze direction.
         :param eye_x: Numpy array representing the x-coordinate of the eye position.
@@ -62,55 +105,55 @@ class EvaluateGaze:
         :param eye_z: Numpy array representing the z-coordinate of the eye position.
         :param p: Numpy array representing the x-coordinate of the marker position.
         :param q: Numpy array representing the y-coordinate of the marker position.
-        :return: float value representing the root-mean-square error.
+        :param dtype: Dtype of the computation (float64 or float32, the dtype of xe if None).
+        :return: float value (or Numpy array (K,) for a stack of parameters) representing the root-mean-square error.
         """
-        # calibrate gaze direction
-        calib_xe, calib_ye = EvaluateGaze.calibrate_reg(param, xe, ye)
+        dtype = np.result_type(xe) if dtype is None else np.dtype(dtype)
+        xe, ye, eye_x, eye_y, eye_z, p, q = [np.asarray(v, dtype=dtype) for v in (xe, ye, eye_x, eye_y, eye_z, p, q)]
+        param = np.asarray(param, dtype=dtype)
 
-        # convert gaze position on calibration plane at 1m away (HMD coordinates)
-        ones = np.ones_like(calib_xe)
-        t = (ones - eye_z) / 1.0
-        xh = eye_x + t * calib_xe
-        yh = eye_y + t * calib_ye
-
-        # calculate error
-        err_x = xh - p
-        err_y = yh - q
-        return np.mean(np.sqrt(err_x * err_x + err_y * err_y))
+        params = param.reshape(-1, 6)
+        error = np.empty(params.shape[0])
+        step = max(1, EvaluateGaze.chunk_size // max(1, xe.shape[0]))
+        for k in range(0, params.shape[0], step):
+            # calibrate gaze direction (one parameter set as the original code)
+            calib_xe, calib_ye = EvaluateGaze.calibrate_reg(param if param.ndim == 1 else params[k:k + step], xe, ye)
+            error[k:k + step] = EvaluateGaze.err_plane(calib_xe, calib_ye, eye_x, eye_y, eye_z, p, q)
+        return float(error[0]) if param.ndim == 1 else error
 
     @staticmethod
-    def err_rmse_3d(param: List[float], ray: np.ndarray,
+    def err_rmse_3d(param: np.ndarray, ray: np.ndarray,
                     eye_x: np.ndarray, eye_y: np.ndarray, eye_z: np.ndarray,
-                    p: np.ndarray, q: np.ndarray) -> float:
+                    p: np.ndarray, q: np.ndarray, dtype=None):
         """
         Calculate the square error using 3D eye model.
 
-        :param param: List of float parameters for the regression model.
+        :param param: Numpy array (9,) or (K, 9) of float parameters for the rotation matrix (row-major).
         :param ray: Numpy array representing the gaze direction.
         :param eye_x: Numpy array representing the x-coordinate of the eye position.
         :param eye_y: Numpy array representing the y-coordinate of the eye position.
         :param eye_z: Numpy array representing the z-coordinate of the eye position.
         :param p: Numpy array representing the x-coordinate of the marker position.
         :param q: Numpy array representing the y-coordinate of the marker position.
-        :return: float value representing the root-mean-square error.
+        :param dtype: Dtype of the computation (float64 or float32, the dtype of ray if None).
+        :return: float value (or Numpy array (K,) for a stack of parameters) representing the root-mean-square error.
         """
-        # calibrate gaze direction
-        calib_ray = EvaluateGaze.calibrate_3d(param, ray)
-
-        # calculate gaze direction at z=1
-        calib_xe = calib_ray[:, 0] / calib_ray[:, 2] * 1.0
-        calib_ye = calib_ray[:, 1] / calib_ray[:, 2] * 1.0
+        dtype = np.result_type(ray) if dtype is None else np.dtype(dtype)
+        ray, eye_x, eye_y, eye_z, p, q = [np.asarray(v, dtype=dtype) for v in (ray, eye_x, eye_y, eye_z, p, q)]
+        param = np.asarray(param, dtype=dtype)
 
-        # convert gaze position on calibration plane at 1m away (HMD coordinates)
-        ones = np.ones_like(calib_xe)
-        t = (ones - eye_z) / 1.0
-        xh = eye_x + t * calib_xe
-        yh = eye_y + t * calib_ye
+        params = param.reshape(-1, 9)
+        error = np.empty(params.shape[0])
+        step = max(1, EvaluateGaze.chunk_size // max(1, ray.shape[0]))
+        for k in range(0, params.shape[0], step):
+            # calibrate gaze direction
+            calib_ray = EvaluateGaze.calibrate_3d(params[k:k + step], ray)
 
-        # calculate error
-        err_x = xh - p
-        err_y = yh - q
-        return np.mean(np.sqrt(err_x * err_x + err_y * err_y))
+            # calculate gaze direction at z=1
+            calib_xe = calib_ray[..., 0] / calib_ray[..., 2]
+            calib_ye = calib_ray[..., 1] / calib_ray[..., 2]
+            error[k:k + step] = EvaluateGaze.err_plane(calib_xe, calib_ye, eye_x, eye_y, eye_z, p, q)
+        return float(error[0]) if param.ndim == 1 else error
 
     @staticmethod
     def get_rotation(param: List[float]) -> np.ndarray:
@@ -137,6 +180,23 @@ class EvaluateGaze:
         # return rotation matrix
         return np.dot(y_rot, x_rot)
 
+    @staticmethod
+    def get_rotations(param: np.ndarray) -> np.ndarray:
+        """
+        Get the rotation matrices of a stack of parameters (same as get_rotation for each row).
+
+        :param param: Numpy array (K, 2) of float parameters (alpha, beta) in degrees.
+        :return: Numpy array (K, 3, 3) representing the rotation matrices.
+        """
+        param = np.asarray(param, dtype=np.float64).reshape(-1, 2)
+        alpha = np.deg2rad(param[:, 0])
+        beta = np.deg2rad(param[:, 1])
+        ca, sa, cb, sb = np.cos(alpha), np.sin(alpha), np.cos(beta), np.sin(beta)
+        zeros = np.zeros_like(alpha)
+        return np.stack([ca, -sa * sb, sa * cb,
+                         zeros, cb, sb,
+                         -sa, -ca * sb, ca * cb], axis=1).reshape(-1, 3, 3)
+
     @staticmethod
     def get_rotation_inv(param: List[float]) -> np.ndarray:
         """
@@ -165,33 +225,37 @@ class EvaluateGaze:
         return np.dot(y_rot_inv, x_rot_inv)
 
     @staticmethod
+    @instrumentation.timed("EvaluateGaze.get_absolute_error")
     def get_absolute_error(gaze_data_path: str,
                            param_base: np.ndarray,
-                           param: np.ndarray) -> float:
+                           param: np.ndarray, dtype=np.float64):
         """
         Calculate the absolute error.
 
         :param gaze_data_path: File path of the gaze data.
         :param param_base: Numpy array representing the visual axis parameters.
-        :param param: Numpy array representing the calibration parameters.
-        :return: float value representing the absolute error.
+        :param param: Numpy array (9,) or (K, 9) representing the calibration parameters.
+        :param dtype: Dtype of the computation (float64 or float32).
+        :return: float value (or Numpy array (K,) for a stack of parameters) representing the absolute error.
         """
-        # load data
-        df = pd.read_csv(gaze_data_path)
+        # load data (memory-mapped for gaze session files)
+        df = read_columns(gaze_data_path, ["ray_x", "ray_y", "ray_z", "u", "v", "eye_x", "eye_y", "eye_z"],
+                          dtype=np.float64)
         # gaze direction
-        ray_x = df["ray_x"].values
-        ray_y = df["ray_y"].values
-        ray_z = df["ray_z"].values
+        ray_x = df["ray_x"]
+        ray_y = df["ray_y"]
+        ray_z = df["ray_z"]
+        instrumentation.count("eval_frames", ray_z.shape[0])
         # gaze direction at z=1
         xe = ray_x[:] / ray_z[:] * 1.0
         ye = ray_y[:] / ray_z[:] * 1.0
         # marker position on a calibration plane at 1m away (HMD coordinates)
-        p = df["u"].values
-        q = df["v"].values
+        p = df["u"]
+        q = df["v"]
         # origin (HMD coordinates)
-        eye_x = df["eye_x"].values
-        eye_y = df["eye_y"].values
-        eye_z = df["eye_z"].values
+        eye_x = df["eye_x"]
+        eye_y = df["eye_y"]
+        eye_z = df["eye_z"]
 
         # calibrate gaze direction
         calib_xe, calib_ye = EvaluateGaze.calibrate_reg(param_base, xe, ye)
@@ -199,7 +263,7 @@ class EvaluateGaze:
         base_ray = np.stack([calib_xe / r, calib_ye / r, 1 / r], axis=1)
 
         # 精度評価
-        rmse_error = EvaluateGaze.err_rmse_3d(param, base_ray, eye_x, eye_y, eye_z, p, q)
+        rmse_error = EvaluateGaze.err_rmse_3d(param, base_ray, eye_x, eye_y, eye_z, p, q, dtype)
         absolute_error = np.rad2deg(rmse_error)
 
         return absolute_error
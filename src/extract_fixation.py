@@ -1,9 +1,121 @@
 import numpy as np
 import pandas as pd
 import itertools
+import instrumentation
+from gaze_session import GazeSession
+
+
+class FixationWindow:
+    """
+    Window of frames whose dispersion is updated incrementally as frames are added or removed.
+
+    The dispersion is that of OptimizeUtil.CalculateDispersion: the maximum squared distance from the mean of the
+    points of regard reprojected to the representative camera (OptimizeUtil.ChoiceCenterCamera).
+    """
+
+    def __init__(self, ray_world, por, WorldToCamMat, EyeToWorldPos, dispersion_th):
+        self.ray_world = ray_world  # Gaze direction in world coordinate
+        self.por = por  # Point of regard in world coordinate
+        self.rot = WorldToCamMat[:, :3, :3]  # WorldToCamera rotation matrix
+        self.pos = EyeToWorldPos  # Eye position in world coordinate
+        self.dispersion_th = dispersion_th  # Dispersion threshold
+
+        # Frames in the window are index[head:tail]
+        self.index = np.empty(ray_world.shape[0], dtype=np.int64)
+        self.direction = np.empty([ray_world.shape[0], 3])  # Gaze directions of the frames in the window
+        self.point = np.empty([ray_world.shape[0], 3])  # Points of regard of the frames in the window
+        self.gaze = np.empty([ray_world.shape[0], 2])  # Reprojected points of regard
+        self.head = 0
+        self.tail = 0
+        self.center = -1  # Frame of the representative camera
+        self.gaze_sum = np.zeros(2)  # Running sum of the reprojected points of regard
+        self.ref_mean = np.zeros(2)  # Mean of the reprojected points of regard at the last full evaluation
+        self.ref_radius = 0.0  # Upper bound of the distance from ref_mean
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def clear(self):
+        self.head = 0
+        self.tail = 0
+        self.center = -1
+        self.gaze_sum[:] = 0.0
+
+    def reproject(self, point):
+        ray_eye = np.matmul(point - self.pos[self.center], self.rot[self.center].T)
+        return ray_eye[:, :2] / ray_eye[:, 2:]
+
+    def choice_center(self):
+        direction = self.direction[self.head:self.tail]
+        dis = direction - direction.sum(axis=0) / len(self)
+        return self.index[self.head + np.argmin(np.einsum("ij,ij->i", dis, dis))]
+
+    def append(self, frame):
+        self.index[self.tail] = frame
+        self.direction[self.tail] = self.ray_world[frame]
+        self.point[self.tail] = self.por[frame]
+        self.tail += 1
+
+    def popleft(self):
+        self.gaze_sum -= self.gaze[self.head]
+        self.head += 1
+
+    def exceeds(self):
+        """
+        Re-evaluate the window from scratch and return whether the dispersion exceeds the threshold.
+        """
+        self.center = self.choice_center()
+        gaze = self.gaze[self.head:self.tail]
+        gaze[:] = self.reproject(self.point[self.head:self.tail])
+        self.gaze_sum = gaze.sum(axis=0)
+        self.ref_mean = self.gaze_sum / len(self)
+        dis = gaze - self.ref_mean
+        self.ref_radius = np.sqrt(np.max(np.einsum("ij,ij->i", dis, dis)))
+        return self.ref_radius * self.ref_radius > self.dispersion_th
+
+    def add(self, frame):
+        """
+        Add a frame and return whether the dispersion exceeds the threshold.
+
+        The window is re-evaluated only when the representative camera changes or the bound of the dispersion
+        kept from the last evaluation cannot decide against the threshold.
+        """
+        self.append(frame)
+        if self.choice_center() != self.center:
+            return self.exceeds()
+
+        # Reproject the new point of regard to the same representative camera
+        gaze = self.reproject(self.point[self.tail - 1:self.tail])[0]
+        self.gaze[self.tail - 1] = gaze
+        self.gaze_sum += gaze
+        mean = self.gaze_sum / len(self)
+
+        # The new point alone exceeds the threshold
+        if np.sum((gaze - mean) ** 2) > self.dispersion_th:
+            return True
+        # Removed points only shrink the bound, so it stays valid
+        self.ref_radius = max(self.ref_radius, np.sqrt(np.sum((gaze - self.ref_mean) ** 2)))
+        bound = self.ref_radius + np.sqrt(np.sum((mean - self.ref_mean) ** 2))
+        if bound * bound <= self.dispersion_th:
+            return False
+        return self.exceeds()
 
 
 class ExtractFixation:
+    # Columns of the WorldToCamera matrix in row-major order
+    mat_columns = ["mat_%d%d" % (r, c) for r in range(4) for c in range(4)]
+    # Columns of the CameraToWorld matrix (rotation and translation) in row-major order
+    ctw_columns = ["ctw_%d%d" % (r, c) for r in range(3) for c in range(4)]
+    # Columns read by formatting and their dtypes
+    columns = mat_columns + ctw_columns + ["opennessl", "opennessr", "ray_x", "ray_y", "ray_z",
+                                           "eye_x", "eye_y", "eye_z", "time", "frame"]
+    # Columns of the point of regard (only in the raw data)
+    por_columns = ["xc", "yc", "zc"]
+    dtypes = dict({column: np.float64 for column in columns + por_columns}, frame=np.int64)
+    # Fields of the feature table of the fixations (get_fixation_features)
+    fixation_features = np.dtype([("start", np.int64), ("stop", np.int64), ("frames", np.int64),
+                                  ("duration", np.float64), ("eye_move", np.float64), ("dispersion", np.float64),
+                                  ("nan_ratio", np.float64), ("direction", np.float64, (3,)), ("center", np.int64)])
 
     def __init__(self):
         # Format data
@@ -16,6 +128,7 @@ class ExtractFixation:
         self.CamToWorldMat = None  # CameraToWorld matrix (3x3 matrix)
         self.CamToWorldPos = None  # HMD position in world coordinate
         self.EyeToWorldPos = None  # Eye position in world coordinate
+        self.PoR = None  # Point of regard (hit point of the gaze direction) in world coordinate
 
         # Calculate threshold
         self.start_frame = 100  # Start frame for calculating frame rate
@@ -29,103 +142,67 @@ class ExtractFixation:
         # fixation_calc_ivt
         self.fix_frame = None  # frame of fixation
 
+        # fixation_calc_idt, fixation_calc_ivdt
+        self.dispersion_th = 0.00015  # Dispersion threshold (0.7 deg)
+
         # fixation_calc_ict
         # self.ict_th = 0.0003 # 1.0 deg
         self.ict_th = 0.000033  # 2.0 cm
 
+    @instrumentation.timed("ExtractFixation.formatting")
     def formatting(self, path):
-        df = pd.read_csv(path)
+        if GazeSession.is_session(path):
+            # Gather the columns from the memory-mapped session file
+            df = GazeSession(path)
+            columns = df.columns
+            select = df.stack
+        else:
+            # Read only the columns used below with explicit dtypes
+            df = pd.read_csv(path, usecols=lambda column: column in self.dtypes, dtype=self.dtypes)
+            columns = df.columns
+            select = lambda names, dtype=np.float64: df[names].to_numpy(dtype=dtype, copy=True)
         self.df = df
 
         # Replaced by nan when openness is less than 0.5
-        openness_l = np.array(df["opennessl"].values)
-        openness_r = np.array(df["opennessr"].values)
-        openness = np.logical_or(openness_l < 0.5, openness_r < 0.5)
+        openness = (select(["opennessl", "opennessr"]) < 0.5).any(axis=1)
+        instrumentation.count("frames", openness.shape[0])
+        instrumentation.count("frames_closed", np.count_nonzero(openness))
 
         # Get gaze directions of the cyclopean eye
-        ray_x = np.array(df["ray_x"].values, dtype=np.float64)
-        ray_y = np.array(df["ray_y"].values, dtype=np.float64)
-        ray_z = np.array(df["ray_z"].values, dtype=np.float64)
+        self.ray = select(["ray_x", "ray_y", "ray_z"])
         # Replaced by nan when openness is less than 0.5
-        ray_x[openness] = np.nan
-        ray_y[openness] = np.nan
-        ray_z[openness] = np.nan
-        self.ray = np.stack([ray_x, ray_y, ray_z], axis=1)
-
-        # Get gaze directions (visual axis) of the cyclopean eye
-        base_ray_x = np.array(df["ray_x"].values, dtype=np.float64)
-        base_ray_y = np.array(df["ray_y"].values, dtype=np.float64)
-        base_ray_z = np.array(df["ray_z"].values, dtype=np.float64)
-        # Replaced by nan when openness is less than 0.5
-        base_ray_x[openness] = np.nan
-        base_ray_y[openness] = np.nan
-        base_ray_z[openness] = np.nan
-        self.base_ray = np.stack([base_ray_x, base_ray_y, base_ray_z], axis=1)
-
-        # Get WorldToCamera matrix
-        mat00 = np.array(df["mat_00"].values)
-        mat10 = np.array(df["mat_10"].values)
-        mat20 = np.array(df["mat_20"].values)
-        mat30 = np.array(df["mat_30"].values)
-        mat01 = np.array(df["mat_01"].values)
-        mat11 = np.array(df["mat_11"].values)
-        mat21 = np.array(df["mat_21"].values)
-        mat31 = np.array(df["mat_31"].values)
-        mat02 = np.array(df["mat_02"].values)
-        mat12 = np.array(df["mat_12"].values)
-        mat22 = np.array(df["mat_22"].values)
-        mat32 = np.array(df["mat_32"].values)
-        mat03 = np.array(df["mat_03"].values)
-        mat13 = np.array(df["mat_13"].values)
-        mat23 = np.array(df["mat_23"].values)
-        mat33 = np.array(df["mat_33"].values)
-
-        self.WorldToCamMat = np.empty([mat00.shape[0], 4, 4])
-        for i in range(mat00.shape[0]):
-            self.WorldToCamMat[i] = np.array([[mat00[i], mat01[i], mat02[i], mat03[i]],
-                                              [mat10[i], mat11[i], mat12[i], mat13[i]],
-                                              [-mat20[i], -mat21[i], -mat22[i], -mat23[i]],
-                                              [mat30[i], mat31[i], mat32[i], mat33[i]]])
+        self.ray[openness] = np.nan
+
+        # Get gaze directions (visual axis) of the cyclopean eye (same values as the gaze directions)
+        self.base_ray = self.ray
+
+        # Get WorldToCamera matrix (mat_rc is the element of row r and column c)
+        self.WorldToCamMat = select(self.mat_columns).reshape(-1, 4, 4)
+        self.WorldToCamMat[:, 2, :] *= -1.0
 
         # Get CameraToWorld matrix
-        ctw00 = np.array(df["ctw_00"].values)
-        ctw10 = np.array(df["ctw_10"].values)
-        ctw20 = np.array(df["ctw_20"].values)
-        ctw01 = np.array(df["ctw_01"].values)
-        ctw11 = np.array(df["ctw_11"].values)
-        ctw21 = np.array(df["ctw_21"].values)
-        ctw02 = np.array(df["ctw_02"].values)
-        ctw12 = np.array(df["ctw_12"].values)
-        ctw22 = np.array(df["ctw_22"].values)
-
-        self.CamToWorldMat = np.empty([ctw00.shape[0], 3, 3])
-        for i in range(ctw00.shape[0]):
-            self.CamToWorldMat[i] = np.array([[ctw00[i], ctw01[i], -ctw02[i]],
-                                              [ctw10[i], ctw11[i], -ctw12[i]],
-                                              [ctw20[i], ctw21[i], -ctw22[i]]])
+        ctw = select(self.ctw_columns).reshape(-1, 3, 4)
+        self.CamToWorldMat = np.ascontiguousarray(ctw[:, :, :3])
+        self.CamToWorldMat[:, :, 2] *= -1.0
 
         # Get HMD position in world coordinate
-        ctw03 = np.array(df["ctw_03"].values)
-        ctw13 = np.array(df["ctw_13"].values)
-        ctw23 = np.array(df["ctw_23"].values)
-        self.CamToWorldPos = np.stack([ctw03, ctw13, ctw23], 1)
+        self.CamToWorldPos = np.ascontiguousarray(ctw[:, :, 3])
 
         # Get eye position in HMD coordinate
-        eye_x = np.array(df["eye_x"].values)
-        eye_y = np.array(df["eye_y"].values)
-        eye_z = np.array(df["eye_z"].values)
-        eye = np.stack([eye_x, eye_y, eye_z], 1)
+        eye = select(["eye_x", "eye_y", "eye_z"])
 
         # Get eye position in world coordinate
-        eye_rotated = np.empty([0, 3])
-        for i in range(eye.shape[0]):  # Rotate eye position
-            eye_tmp = np.dot(self.CamToWorldMat[i], eye[i])
-            eye_rotated = np.vstack([eye_rotated, [eye_tmp[0], eye_tmp[1], eye_tmp[2]]])
+        eye_rotated = np.matmul(self.CamToWorldMat, eye[:, :, np.newaxis])[:, :, 0]  # Rotate eye position
         self.EyeToWorldPos = self.CamToWorldPos + eye_rotated  # Translate eye position
 
+        # Get point of regard in world coordinate if recorded
+        if set(self.por_columns).issubset(columns):
+            self.PoR = select(self.por_columns)
+            self.PoR[openness] = np.nan
+
         # Get frame and time
-        self.frame = np.array(df["frame"].values, dtype=np.int64)
-        self.time = np.array(df["time"].values)
+        self.frame = select(["frame"], dtype=np.int64)[:, 0]
+        self.time = select(["time"])[:, 0]
         return df.head()
 
     # Calculate frame rate and threshold
@@ -149,57 +226,184 @@ class ExtractFixation:
         c = i / n
         return np.rad2deg(np.arccos(np.clip(c, -1.0, 1.0)))
 
+    # Calculate angles between consecutive vectors (nan when either vector is nan)
+    def calculate_angles(self, vectors):
+        vectors = vectors[:, np.newaxis, :]
+        i = np.matmul(vectors[:-1], np.swapaxes(vectors[1:], 1, 2))[:, 0, 0]
+        norm = np.sqrt(np.matmul(vectors, np.swapaxes(vectors, 1, 2))[:, 0, 0])
+        n = norm[:-1] * norm[1:]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            c = i / n
+        return np.rad2deg(np.arccos(np.clip(c, -1.0, 1.0)))
+
+    # Get the windows of consecutive frames whose angular velocity is below the threshold
+    def get_fixation_by_velocity(self, vectors, duration=10):
+        # Frames with nan (eyes closed) never belong to a fixation
+        valid = ~np.isnan(vectors).any(axis=1)
+        with np.errstate(invalid="ignore"):
+            below = (self.calculate_angles(vectors) < self.dig_per_frame) & valid[:-1] & valid[1:]
+
+        # Run-length encoding of the frames below the velocity threshold
+        edge = np.flatnonzero(np.diff(np.concatenate([[False], below, [False]]).astype(np.int8)))
+        start = edge[0::2]
+        stop = edge[1::2]
+
+        # A run reaching the end of the data is not closed
+        closed = stop < below.shape[0]
+        long = stop - start >= duration  # Duration threshold
+        keep = np.logical_and(closed, long)
+        instrumentation.count("fixations_detected", np.count_nonzero(keep))
+        instrumentation.count("fixations_rejected", keep.shape[0] - np.count_nonzero(keep))
+        window = np.stack([start[keep], stop[keep]], axis=1).astype(np.float64)
+        return window
+
     # I-VT
+    @instrumentation.timed("ExtractFixation.get_fixation_by_ivt")
     def get_fixation_by_ivt(self, duration=10):
-        i = 0
-        window = np.empty([0, 2])
-        while i < self.ray.shape[0] - 1:
-            angle = self.calculate_angle(self.ray[i], self.ray[i + 1])
-            if angle < self.dig_per_frame:  # Velocity threshold
-                start = i
-                while angle < self.dig_per_frame:  # Velocity threshold
-                    i += 1
-                    if i >= self.ray.shape[0] - 1:  # End of the data
-                        break
-                    angle = self.calculate_angle(self.ray[i], self.ray[i + 1])
-                else:
-                    stop = i
-                    if stop - start >= duration:  # Duration threshold
-                        window = np.vstack([window, [start, stop]])
-            else:
-                i += 1
-                if i >= self.ray.shape[0] - 1:  # End of the data
-                    break
+        window = self.get_fixation_by_velocity(self.ray, duration)
         self.fix_frame = np.stack([window[:, 0], window[:, 1]], axis=1)
         return self.fix_frame
 
     # I-VT in world coordinate
+    @instrumentation.timed("ExtractFixation.get_fixation_by_ivt_world")
     def get_fixation_by_ivt_world(self, duration=10):
-        ray_world = np.empty([0, 3])
-        for j in range(self.ray.shape[0]):
-            ray_world_tmp = np.dot(self.CamToWorldMat[j], self.ray[j])
-            ray_world = np.vstack([ray_world, [ray_world_tmp[0], ray_world_tmp[1], ray_world_tmp[2]]])
+        ray_world = np.matmul(self.CamToWorldMat, self.ray[:, :, np.newaxis])[:, :, 0]
+        window = self.get_fixation_by_velocity(ray_world, duration)
+        self.fix_frame = np.stack([window[:, 0], window[:, 1]], axis=1)
+        return self.fix_frame
+
+    # Get the points of regard and the valid frames for the dispersion-based methods
+    def prepare_dispersion(self, por=None):
+        if por is None:
+            por = self.PoR
+        if por is None:
+            raise ValueError("points of regard are required: record xc, yc, zc or pass por")
+        ray_world = np.matmul(self.CamToWorldMat, self.ray[:, :, np.newaxis])[:, :, 0]
+        # Frames with eyes closed or without a point of regard (no hit) are excluded
+        valid = np.logical_and(~np.isnan(self.ray).any(axis=1), ~np.isnan(por).any(axis=1))
+        window = FixationWindow(ray_world, por, self.WorldToCamMat, self.EyeToWorldPos, self.dispersion_th)
+        return window, valid
 
+    # I-DT (OptimizeUtil.GetFixationByIDT)
+    @instrumentation.timed("ExtractFixation.get_fixation_by_idt")
+    def get_fixation_by_idt(self, duration=10, por=None):
+        win, valid = self.prepare_dispersion(por)
+        n = valid.shape[0]
+        fix = []
+        rejected = 0  # Windows shorter than the duration threshold
         i = 0
-        window = np.empty([0, 2])
-        while i < ray_world.shape[0] - 1:
-            angle = self.calculate_angle(ray_world[i], ray_world[i + 1])
-            if angle < self.dig_per_frame:  # Velocity threshold
-                start = i
-                while angle < self.dig_per_frame:  # Velocity threshold
+        while i + duration < n:
+            start = i  # Index of the fixation start
+            stop = i  # Index of the fixation end
+
+            # Check the PoRs in the initial window
+            win.clear()
+            while i - start < duration:
+                if i >= n:  # End of the data
+                    break
+                if not valid[i]:  # Eyes closed
+                    win.clear()
                     i += 1
-                    if i >= ray_world.shape[0] - 1:  # End of the data
-                        break
-                    angle = self.calculate_angle(ray_world[i], ray_world[i + 1])
+                    start = i
                 else:
+                    win.append(i)
+                    i += 1
+            if len(win) == 0:  # No frame left
+                break
+            exceeds = win.exceeds()
+
+            # Slide the window if the dispersion is larger than the threshold
+            while exceeds:
+                win.popleft()
+                start += 1
+                if i >= n or not valid[i]:  # End of the data or eyes closed
+                    break
+                exceeds = win.add(i)
+                i += 1
+
+            # Expand the window while the dispersion is smaller than the threshold
+            while not exceeds:
+                if i >= n or not valid[i]:  # End of the data or eyes closed
                     stop = i
-                    if stop - start >= duration:  # Duration threshold
-                        window = np.vstack([window, [start, stop]])
+                    break
+                exceeds = win.add(i)
+                if not exceeds:
+                    stop = i
+                    i += 1
+
+            if stop - start >= duration:  # Duration threshold
+                fix.append([start, stop])
             else:
+                rejected += 1
+            if i >= n:  # End of the data
+                break
+
+        instrumentation.count("fixations_detected", len(fix))
+        instrumentation.count("fixations_rejected", rejected)
+        self.fix_frame = np.array(fix, dtype=np.float64).reshape(-1, 2)
+        return self.fix_frame
+
+    # I-VDT (OptimizeUtil.GetFixationByIVDT)
+    @instrumentation.timed("ExtractFixation.get_fixation_by_ivdt")
+    def get_fixation_by_ivdt(self, duration=10, por=None):
+        win, valid = self.prepare_dispersion(por)
+        n = valid.shape[0]
+        # Angle between the gaze directions of the previous and current frames
+        velocity = np.concatenate([[0.0], self.calculate_angles(self.ray)])
+        fix = []
+        rejected = 0  # Windows shorter than the duration threshold
+        i = 0
+        while i + duration < n:
+            start = i  # Index of the fixation start
+            stop = i  # Index of the fixation end
+
+            # Check the PoRs in the initial window
+            win.clear()
+            while i - start < duration:
+                if i >= n:  # End of the data
+                    break
+                if valid[i] and (len(win) == 0 or velocity[i] < self.dig_per_frame):
+                    win.append(i)
+                    i += 1
+                else:  # Eyes closed or saccade
+                    win.clear()
+                    i += 1
+                    start = i
+            if len(win) == 0:  # No frame left
+                break
+            exceeds = win.exceeds()
+
+            # Slide the window if the dispersion is larger than the threshold
+            while exceeds:
+                win.popleft()
+                start += 1
+                if i >= n or not valid[i]:  # End of the data or eyes closed
+                    break
+                if len(win) == 0 or velocity[i] < self.dig_per_frame:
+                    exceeds = win.add(i)
                 i += 1
-                if i >= ray_world.shape[0] - 1:  # End of the data
+
+            # Expand the window while the dispersion is smaller than the threshold
+            while not exceeds:
+                if i >= n or not valid[i]:  # End of the data or eyes closed
+                    stop = i
                     break
-        self.fix_frame = np.stack([window[:, 0], window[:, 1]], axis=1)
+                stop = i
+                i += 1
+                if len(win) > 0 and velocity[stop] >= self.dig_per_frame:  # Saccade
+                    break
+                exceeds = win.add(stop)
+
+            if stop - start >= duration:  # Duration threshold
+                fix.append([start, stop])
+            else:
+                rejected += 1
+            if i >= n:  # End of the data
+                break
+
+        instrumentation.count("fixations_detected", len(fix))
+        instrumentation.count("fixations_rejected", rejected)
+        self.fix_frame = np.array(fix, dtype=np.float64).reshape(-1, 2)
         return self.fix_frame
 
     # Extract gaze directions during a fixation
@@ -229,10 +433,110 @@ class ExtractFixation:
     # Calculate the maximum distance of eye position during a fixation
     def calculate_head_move(self, fix_on, fix_off):
         EyeToWorldPos = self.EyeToWorldPos[int(fix_on):int(fix_off)]
-        dis_list = []
-        for pair in itertools.combinations(EyeToWorldPos, 2):
-            dis = np.sqrt((pair[0][0] - pair[1][0]) * (pair[0][0] - pair[1][0]) + (pair[0][1] - pair[1][1]) * (
-                    pair[0][1] - pair[1][1]) + (pair[0][2] - pair[1][2]) * (pair[0][2] - pair[1][2]))
-            dis_list.append(dis)
-        dis_max = max(dis_list)
-        return dis_max
+        return float(self.calculate_max_distances(EyeToWorldPos, np.zeros(1, dtype=np.int64))[0])
+
+    # Calculate the maximum distance between the points of each group (the points of group i are offsets[i]:offsets[i + 1])
+    @staticmethod
+    def calculate_max_distances(points, offsets):
+        n = np.diff(np.append(offsets, points.shape[0]))
+        if points.shape[0] == 0:
+            return np.zeros(n.shape[0])
+        group = np.repeat(np.arange(n.shape[0]), n)
+
+        # Radius of each group around its centroid
+        center = np.add.reduceat(points, offsets, axis=0) / n[:, np.newaxis]
+        radius = np.sqrt(np.maximum.reduceat(np.sum((points - center[group]) ** 2, axis=1), offsets))
+
+        # Lower bound of the maximum distance: the largest extent along the axes, the diagonals and the principal axis
+        local = points - center[group]
+        cov = np.add.reduceat(local[:, :, np.newaxis] * local[:, np.newaxis, :], offsets, axis=0)
+        principal = np.linalg.eigh(cov)[1][:, :, 2]
+        axes = np.array(list(itertools.product([0.0, 1.0, -1.0], repeat=3))[1:14])
+        proj = np.concatenate([np.matmul(points, axes.T), np.sum(points * principal[group], axis=1)[:, np.newaxis]], axis=1)
+        extent = np.maximum.reduceat(proj, offsets, axis=0) - np.minimum.reduceat(proj, offsets, axis=0)
+        axes_norm = np.append(np.linalg.norm(axes, axis=1), 1.0)
+        bound = np.max(extent / axes_norm, axis=1)
+
+        # Only the points whose farthest possible partner is beyond the bound can be the ends of the maximum distance
+        keep = np.flatnonzero(np.sqrt(np.sum(local ** 2, axis=1)) + radius[group] >= bound[group] * (1.0 - 1e-9))
+        keep_group = group[keep]
+        keep_n = np.bincount(keep_group, minlength=n.shape[0])
+        keep_start = np.concatenate([[0], np.cumsum(keep_n)[:-1]])
+
+        # Distances between the remaining points of each group
+        pair_n = keep_n[keep_group]
+        first = np.repeat(np.arange(keep.shape[0]), pair_n)
+        second = keep_start[keep_group[first]] + np.arange(first.shape[0]) - np.repeat(np.cumsum(pair_n) - pair_n, pair_n)
+        diff = points[keep[first]] - points[keep[second]]
+        dis = np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1] + diff[:, 2] * diff[:, 2])
+        pair_offsets = np.concatenate([[0], np.cumsum(keep_n * keep_n)[:-1]])
+        return np.maximum.reduceat(dis, pair_offsets)
+
+    # Get the features of the fixations as one structured array (fixation_features)
+    @instrumentation.timed("ExtractFixation.get_fixation_features")
+    def get_fixation_features(self, window=None, ray=None):
+        """
+        Calculate the features of all fixations at once.
+
+        :param window: Numpy array (M, 2) representing the start and end frames of the fixations (fix_frame if None).
+        :param ray: Numpy array (N, 3) representing the gaze directions in camera coordinate used for the direction,
+                    the dispersion and the representative camera (base_ray if None), e.g. calibrated by the initial
+                    parameters as in OptimizeGaze.remove_fixation.
+        :return: Structured numpy array (M,) of fixation_features: start and end frames, number of frames,
+                 duration (sec), eye_move (maximum distance of the eye positions, calculate_head_move),
+                 dispersion (maximum angle from the mean gaze direction in world coordinate, degrees),
+                 nan_ratio (ratio of the frames with eyes closed), direction (mean gaze direction in world
+                 coordinate) and center (representative camera in the fixation, OptimizeUtil.ChoiceCenterCamera).
+        """
+        window = np.asarray(self.fix_frame if window is None else window).astype(np.int64).reshape(-1, 2)
+        ray = self.base_ray if ray is None else ray
+        features = np.zeros(window.shape[0], dtype=self.fixation_features)
+        features["start"] = window[:, 0]
+        features["stop"] = window[:, 1]
+        features["frames"] = np.maximum(window[:, 1] - window[:, 0], 0)
+        features["duration"] = features["frames"] / self.fs if self.fs is not None else np.nan
+        features["eye_move"] = np.nan
+        features["dispersion"] = np.nan
+        features["nan_ratio"] = np.nan
+        features["direction"] = np.nan
+        features["center"] = -1
+
+        # Frames of the fixations with frames, concatenated
+        index = np.flatnonzero(features["frames"] > 0)
+        length = features["frames"][index]
+        if index.shape[0] == 0:
+            return features
+        offsets = np.concatenate([[0], np.cumsum(length)[:-1]])
+        fix_id = np.repeat(np.arange(index.shape[0]), length)
+        frame = window[index, 0][fix_id] + np.arange(fix_id.shape[0]) - offsets[fix_id]
+
+        # Maximum distance of the eye positions (frames without eye position are skipped)
+        eye = self.EyeToWorldPos[frame]
+        valid_eye = ~np.isnan(eye).any(axis=1)
+        eye_n = np.add.reduceat(valid_eye, offsets)
+        has_eye = eye_n > 0
+        eye_offsets = np.concatenate([[0], np.cumsum(eye_n[has_eye])[:-1]])
+        features["eye_move"][index[has_eye]] = self.calculate_max_distances(eye[valid_eye], eye_offsets)
+
+        # Gaze directions in world coordinate (frames with eyes closed are skipped)
+        direction = np.matmul(self.CamToWorldMat[frame], ray[frame][:, :, np.newaxis])[:, :, 0]
+        valid = ~np.isnan(direction).any(axis=1)
+        count = np.add.reduceat(valid, offsets)
+        features["nan_ratio"][index] = 1.0 - count / length
+        direction[~valid] = 0.0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.add.reduceat(direction, offsets, axis=0) / count[:, np.newaxis]
+            unit_mean = mean / np.linalg.norm(mean, axis=1, keepdims=True)
+            unit = direction / np.linalg.norm(direction, axis=1, keepdims=True)
+            angle = np.rad2deg(np.arccos(np.clip(np.sum(unit * unit_mean[fix_id], axis=1), -1.0, 1.0)))
+        angle[~valid] = -np.inf
+        seen = count > 0
+        features["direction"][index[seen]] = unit_mean[seen]
+        features["dispersion"][index[seen]] = np.maximum.reduceat(angle, offsets)[seen]
+
+        # Representative camera: the first frame whose gaze direction is the closest to the mean
+        dis = np.linalg.norm(mean[fix_id] - direction, axis=1)
+        dis[~valid] = np.inf
+        order = np.lexsort((np.arange(dis.shape[0]), dis, fix_id))
+        features["center"][index[seen]] = (order[offsets] - offsets)[seen]
+        return features
@@ -0,0 +1,251 @@
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+from typing import Dict, Optional, Tuple
+import numpy as np
+from extract_fixation import ExtractFixation
+from gaze_session import file_mode
+
+
+class FixationCache:
+    """
+    Cache of the fixations detected in the gaze data (ExtractFixation) stored as .npz files.
+
+    An entry is keyed on the content hash of the gaze data, the detector and its thresholds. It holds the detected
+    windows and the frame data of the fixations as one flat array (F, 24) whose columns are base_ray (3),
+    CamToWorldMat (9), WorldToCamMat (9) and EyeToWorldPos (3); the frames of fixation i are offsets[i]:offsets[i + 1].
+    The least recently used entries are evicted when the cache exceeds max_entries or max_bytes.
+    """
+
+    version = 1  # Format version of the entries (entries of other versions are invalid)
+    detectors = {"ivt": "get_fixation_by_ivt",
+                 "ivt_world": "get_fixation_by_ivt_world",
+                 "idt": "get_fixation_by_idt",
+                 "ivdt": "get_fixation_by_ivdt"}
+    # Column ranges of the flat frame array
+    layout = {"base_ray": (0, 3), "CamToWorldMat": (3, 12), "WorldToCamMat": (12, 21), "EyeToWorldPos": (21, 24)}
+
+    def __init__(self, cache_dir: str, max_entries: int = 256, max_bytes: int = 1 << 30, dtype=np.float64):
+        """
+        :param cache_dir: Directory of the cache files.
+        :param max_entries: Maximum number of entries.
+        :param max_bytes: Maximum total size of the entries in bytes.
+        :param dtype: Dtype of the flat frame array (np.float64 or np.float32).
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.hashes = {}  # Content hash of each file keyed on (path, size, mtime)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def file_hash(self, path: str) -> str:
+        """
+        Get the content hash of a file (reused while the size and modification time are unchanged).
+
+        :param path: Path of the file.
+        :return: String SHA-256 hex digest of the content.
+        """
+        stat = os.stat(path)
+        stamp = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if stamp not in self.hashes:
+            sha = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(block)
+            self.hashes[stamp] = sha.hexdigest()
+        return self.hashes[stamp]
+
+    def key(self, path: str, detector: str, **thresholds) -> str:
+        """
+        Get the key of an entry.
+
+        :param path: Path of the gaze data.
+        :param detector: Name of the detector (ivt, ivt_world, idt or ivdt).
+        :param thresholds: Thresholds of the detector.
+        :return: String key of the entry.
+        """
+        desc = json.dumps({"hash": self.file_hash(path), "detector": detector, "thresholds": thresholds,
+                           "dtype": self.dtype.name, "version": self.version}, sort_keys=True)
+        return hashlib.sha256(desc.encode()).hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def get(self, path: str, detector: str = "ivt", dig_per_sec: float = 100, duration: float = 0.2,
+            dispersion_th: float = 0.00015) -> Dict[str, np.ndarray]:
+        """
+        Get the fixations of the gaze data, detecting and storing them on a cache miss.
+
+        :param path: Path of the gaze data.
+        :param detector: Name of the detector (ivt, ivt_world, idt or ivdt).
+        :param dig_per_sec: Velocity threshold (degrees per second).
+        :param duration: Duration threshold (sec).
+        :param dispersion_th: Dispersion threshold (used by idt and ivdt).
+        :return: Dictionary of the entry (see load).
+        """
+        if detector not in self.detectors:
+            raise ValueError("unknown detector: %s" % detector)
+        thresholds = {"dig_per_sec": float(dig_per_sec), "duration": float(duration)}
+        if detector in ("idt", "ivdt"):
+            thresholds["dispersion_th"] = float(dispersion_th)
+        key = self.key(path, detector, **thresholds)
+
+        entry = self.load(key)
+        if entry is None:
+            entry = self.detect(path, detector, **thresholds)
+            entry["meta"] = self.save(key, entry, path, detector, thresholds)
+        return entry
+
+    def detect(self, path: str, detector: str, dig_per_sec: float, duration: float,
+               dispersion_th: float = 0.00015) -> Dict[str, np.ndarray]:
+        """
+        Detect the fixations and gather the frame data of the fixations.
+
+        :return: Dictionary containing window, offsets, frame, data and fs.
+        """
+        fix = ExtractFixation()
+        fix.duration = duration
+        fix.dispersion_th = dispersion_th
+        fix.formatting(path)
+        fix.calculate_th(dig_per_sec)
+        window = getattr(fix, self.detectors[detector])(fix.duration_frame).astype(np.int64).reshape(-1, 2)
+
+        length = window[:, 1] - window[:, 0]
+        frame = np.concatenate([np.arange(fix_on, fix_off) for fix_on, fix_off in window] + [np.empty(0, np.int64)])
+        data = np.concatenate([fix.base_ray[frame],
+                               fix.CamToWorldMat[frame].reshape(-1, 9),
+                               fix.WorldToCamMat[frame, :3, :3].reshape(-1, 9),
+                               fix.EyeToWorldPos[frame]], axis=1).astype(self.dtype)
+        return {"window": window,
+                "offsets": np.concatenate([[0], np.cumsum(length)]).astype(np.int64),
+                "frame": frame,
+                "data": data,
+                "fs": np.float64(fix.fs)}
+
+    def save(self, key: str, entry: Dict[str, np.ndarray], path: str, detector: str, thresholds: Dict[str, float]):
+        """
+        Store an entry atomically and evict the least recently used entries.
+
+        :return: Dictionary of the metadata of the entry.
+        """
+        meta = {"version": self.version, "hash": self.file_hash(path), "source": os.path.abspath(path),
+                "detector": detector, "thresholds": thresholds}
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, meta=np.array(json.dumps(meta)), **entry)
+            os.chmod(tmp, file_mode())
+            os.replace(tmp, self.entry_path(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict()
+        return meta
+
+    def load(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Load an entry.
+
+        :param key: String key of the entry.
+        :return: Dictionary containing window (M, 2), offsets (M + 1,), frame (F,), data (F, 24), fs and meta,
+            or None if the entry does not exist or is invalid.
+        """
+        entry_path = self.entry_path(key)
+        try:
+            with np.load(entry_path) as npz:
+                entry = {name: npz[name] for name in npz.files}
+            entry["meta"] = json.loads(str(entry["meta"]))
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return None
+        if not self.is_valid(entry):
+            self.remove(key)
+            return None
+        try:
+            os.utime(entry_path)  # Mark as recently used
+        except OSError:  # Removed by another process since it was loaded
+            pass
+        return entry
+
+    def is_valid(self, entry: Dict[str, np.ndarray]) -> bool:
+        """
+        Check the version of an entry and the sizes of its arrays (the key already pins the content of the gaze data,
+        which identical files share).
+        """
+        if entry["meta"].get("version") != self.version:
+            return False
+        return entry["offsets"][-1] == entry["data"].shape[0] == entry["frame"].shape[0]
+
+    @classmethod
+    def fixation_arrays(cls, entry: Dict[str, np.ndarray]) -> Tuple[np.ndarray, ...]:
+        """
+        Split the flat frame array of an entry into the arguments of OptimizeGaze.set_fixation_arrays.
+
+        :param entry: Dictionary of the entry.
+        :return: Tuple containing base_ray, CamToWorldMat, WorldToCamMat, EyeToWorldPos, frame and length.
+        """
+        data = entry["data"].astype(np.float64, copy=False)
+        arrays = {name: data[:, start:stop] for name, (start, stop) in cls.layout.items()}
+        return (np.ascontiguousarray(arrays["base_ray"]),
+                arrays["CamToWorldMat"].reshape(-1, 3, 3),
+                arrays["WorldToCamMat"].reshape(-1, 3, 3),
+                np.ascontiguousarray(arrays["EyeToWorldPos"]),
+                entry["frame"],
+                np.diff(entry["offsets"]))
+
+    def entries(self):
+        """
+        List the entries from the least recently used.
+
+        :return: List of tuples containing the path, the size and the last access time of each entry.
+        """
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:  # Removed by another process since it was listed
+                    continue
+                files.append((os.path.join(self.cache_dir, name), stat.st_size, stat.st_mtime_ns))
+        return sorted(files, key=lambda file: file[2])
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits max_entries and max_bytes.
+        """
+        files = self.entries()
+        total = sum(size for _, size, _ in files)
+        while files and (len(files) > self.max_entries or total > self.max_bytes):
+            entry_path, size, _ = files.pop(0)
+            self.remove_file(entry_path)  # Other processes sharing the cache may evict the same entries
+            total -= size
+
+    def remove(self, key: str):
+        self.remove_file(self.entry_path(key))
+
+    @staticmethod
+    def remove_file(entry_path: str):
+        # Remove an entry file unless another process already removed it
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            pass
+
+    def invalidate(self, path: Optional[str] = None):
+        """
+        Remove the entries of a gaze data file (all entries if path is None).
+
+        :param path: Path of the gaze data.
+        """
+        for entry_path, _, _ in self.entries():
+            if path is not None:
+                try:
+                    with np.load(entry_path) as npz:
+                        source = json.loads(str(npz["meta"]))["source"]
+                except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                    source = None
+                if source is not None and source != os.path.abspath(path):
+                    continue
+            self.remove_file(entry_path)
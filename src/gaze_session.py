@@ -0,0 +1,376 @@
+import argparse
+import functools
+import json
+import os
+import shutil
+import struct
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+
+class GazeSession:
+    """
+    Gaze data in a binary session file (.gaze) whose columns are memory-mapped without copying.
+
+    The file consists of a magic number, the length of the header (uint64), the JSON header holding the number of
+    rows, the frame rate and the schema (name, dtype and offset of each column), and the columns stored contiguously
+    (little endian) from the data section aligned to 64 bytes.
+    """
+
+    magic = b"\x93GAZE\x01\x00\x00"
+    suffix = ".gaze"
+    alignment = 64
+    version = 1
+    # Frames used to calculate the frame rate (ExtractFixation.calculate_th)
+    start_frame = 100
+    end_frame = 200
+
+    def __init__(self, path: str):
+        """
+        :param path: Path of the session file.
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(self.magic)) != self.magic:
+                raise ValueError("not a gaze session file: %s" % path)
+            (length,) = struct.unpack("<Q", f.read(8))
+            self.header = json.loads(f.read(length).decode("utf-8"))
+        if self.header.get("version") != self.version:
+            raise ValueError("unsupported gaze session version: %s" % self.header.get("version"))
+
+        self.rows = self.header["rows"]  # Number of frames
+        self.fs = self.header["fs"]  # Frame rate (None if the session is too short)
+        self.schema = {column["name"]: column for column in self.header["columns"]}
+        self.columns = [column["name"] for column in self.header["columns"]]
+        self.data_start = self.aligned(len(self.magic) + 8 + length)
+        self.buffer = np.memmap(path, dtype=np.uint8, mode="r") if self.rows > 0 else np.empty(0, np.uint8)
+
+    def __len__(self):
+        return self.rows
+
+    def __contains__(self, name):
+        return name in self.schema
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """
+        Get a column as a read-only view of the file.
+
+        :param name: Column name.
+        :return: Numpy array (rows,) of the column.
+        """
+        column = self.schema[name]
+        dtype = np.dtype(column["dtype"])
+        start = self.data_start + column["offset"]
+        return self.buffer[start:start + self.rows * dtype.itemsize].view(dtype)
+
+    def stack(self, names: List[str], dtype=np.float64) -> np.ndarray:
+        """
+        Gather columns into one array.
+
+        :param names: List of column names.
+        :param dtype: Dtype of the array.
+        :return: Numpy array (rows, len(names)).
+        """
+        data = np.empty([self.rows, len(names)], dtype=dtype)
+        for i, name in enumerate(names):
+            data[:, i] = self[name]
+        return data
+
+    def head(self, n: int = 5) -> pd.DataFrame:
+        return pd.DataFrame({name: self[name][:n] for name in self.columns})
+
+    @classmethod
+    def aligned(cls, offset: int) -> int:
+        return -(-offset // cls.alignment) * cls.alignment
+
+    @classmethod
+    def is_session(cls, path: str) -> bool:
+        """
+        Check whether a file is a session file (by the suffix or the magic number).
+        """
+        if path.endswith(cls.suffix):
+            return True
+        try:
+            with open(path, "rb") as f:
+                return f.read(len(cls.magic)) == cls.magic
+        except OSError:
+            return False
+
+    @classmethod
+    def frame_rate(cls, time: np.ndarray) -> Optional[float]:
+        """
+        Calculate the frame rate in the same way as ExtractFixation.calculate_th.
+
+        :param time: Numpy array representing the time of each frame.
+        :return: float frame rate, or None if there are not enough frames.
+        """
+        if time.shape[0] < cls.end_frame:
+            return None
+        ts = (time[cls.end_frame - 1] - time[cls.start_frame]) / (cls.end_frame - cls.start_frame)
+        return float(1 / ts)
+
+    @classmethod
+    def layout(cls, dtypes: Dict[str, np.dtype], rows: int, fs: Optional[float] = None,
+               attrs: Optional[dict] = None) -> Tuple[List[dict], bytes, int]:
+        """
+        Lay out the columns of a session file.
+
+        :param dtypes: Dictionary of the dtypes of the columns in order.
+        :param rows: Integer number of rows.
+        :param fs: Frame rate.
+        :param attrs: Dictionary of additional attributes stored in the header.
+        :return: Tuple containing the schema, the magic number and header bytes, and the start of the data section.
+        """
+        columns = []
+        offset = 0
+        for name, dtype in dtypes.items():
+            dtype = np.dtype(dtype).newbyteorder("<")
+            columns.append({"name": name, "dtype": dtype.str, "offset": offset})
+            offset = cls.aligned(offset + rows * dtype.itemsize)
+        header = json.dumps({"version": cls.version, "rows": rows, "fs": fs, "columns": columns,
+                             "attrs": attrs or {}}).encode("utf-8")
+        header = cls.magic + struct.pack("<Q", len(header)) + header
+        return columns, header, cls.aligned(len(header))
+
+    @classmethod
+    def write(cls, path: str, data: Dict[str, np.ndarray], fs: Optional[float] = None, attrs: Optional[dict] = None):
+        """
+        Write columns to a session file atomically.
+
+        :param path: Path of the session file.
+        :param data: Dictionary of the columns (numpy arrays of the same length) in order.
+        :param fs: Frame rate (calculated from the time column if None).
+        :param attrs: Dictionary of additional attributes stored in the header.
+        """
+        arrays = {name: np.ascontiguousarray(value, dtype=np.asarray(value).dtype.newbyteorder("<"))
+                  for name, value in data.items()}
+        rows = len(next(iter(arrays.values()))) if arrays else 0
+        if any(array.shape != (rows,) for array in arrays.values()):
+            raise ValueError("columns must be one-dimensional arrays of the same length")
+        if fs is None and "time" in arrays:
+            fs = cls.frame_rate(arrays["time"].astype(np.float64))
+
+        columns, header, data_start = cls.layout({name: array.dtype for name, array in arrays.items()}, rows, fs, attrs)
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                for column, array in zip(columns, arrays.values()):
+                    f.seek(data_start + column["offset"])
+                    f.write(array.tobytes())
+            os.chmod(tmp, file_mode())
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    @classmethod
+    def from_csv(cls, csv_path: str, path: str, dtype=np.float64):
+        """
+        Convert gaze data in a CSV file to a session file.
+
+        :param csv_path: Path of the CSV file.
+        :param path: Path of the session file.
+        :param dtype: Dtype of the float columns (integer columns such as frame are kept).
+        """
+        df = pd.read_csv(csv_path, encoding="utf_8_sig")
+        data = {}
+        for name in df.columns:
+            values = df[name].to_numpy()
+            if values.dtype.kind == "f":
+                values = values.astype(dtype)
+            elif values.dtype.kind not in "iub":
+                raise ValueError("column %s of %s is not numeric" % (name, csv_path))
+            data[name] = values
+        cls.write(path, data, attrs={"source": os.path.basename(csv_path)})
+
+
+@functools.lru_cache(maxsize=None)
+def file_mode() -> int:
+    """
+    Get the permissions of a new file under the umask of the process (tempfile.mkstemp creates its files with 0600,
+    which os.replace keeps). The umask is read once, as reading it sets it.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def read_columns(path: str, names: Optional[List[str]] = None, dtype=None) -> Dict[str, np.ndarray]:
+    """
+    Read columns of gaze data from a session file (memory-mapped) or a CSV file.
+
+    :param path: Path of the gaze data.
+    :param names: List of column names (all columns if None).
+    :param dtype: Dtype of the float columns (as stored if None).
+    :return: Dictionary of the columns in the order of the file.
+    """
+    if GazeSession.is_session(path):
+        session = GazeSession(path)
+        data = {name: session[name] for name in session.columns if names is None or name in names}
+    else:
+        df = pd.read_csv(path, usecols=None if names is None else (lambda column: column in names))
+        data = {name: df[name].to_numpy() for name in df.columns}
+    if names is not None and len(data) < len(set(names)):
+        raise KeyError("columns not found in %s: %s" % (path, sorted(set(names) - set(data))))
+    if dtype is not None:
+        data = {name: value.astype(dtype, copy=False) if value.dtype.kind == "f" else value
+                for name, value in data.items()}
+    return data
+
+
+def write_columns(path: str, data: Dict[str, np.ndarray]):
+    """
+    Write columns of gaze data to a session file (.gaze) or a CSV file with BOM.
+
+    :param path: Path of the output file.
+    :param data: Dictionary of the columns in order.
+    """
+    if path.endswith(GazeSession.suffix):
+        GazeSession.write(path, data)
+    else:
+        pd.DataFrame(data).to_csv(path, index=False, encoding="utf_8_sig")
+
+
+def iter_columns(path: str, chunksize: Optional[int] = None,
+                 integer_columns: Tuple[str, ...] = ("frame",)) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Read gaze data in chunks of rows from a session file (memory-mapped) or a CSV file.
+
+    In the chunks of a CSV file, the columns other than integer_columns are parsed as float64 so that every chunk
+    has the same dtypes.
+
+    :param path: Path of the gaze data.
+    :param chunksize: Integer number of rows in each chunk (the whole file in one chunk if None).
+    :param integer_columns: Tuple of the column names whose dtype is inferred from each chunk of a CSV file.
+    :return: Iterator of dictionaries of the columns in the order of the file.
+    """
+    if chunksize is None:
+        yield read_columns(path)
+    elif GazeSession.is_session(path):
+        session = GazeSession(path)
+        for start in range(0, len(session), chunksize):
+            yield {name: session[name][start:start + chunksize] for name in session.columns}
+    else:
+        names = pd.read_csv(path, nrows=0).columns
+        dtype = {name: np.float64 for name in names if name not in integer_columns}
+        for df in pd.read_csv(path, chunksize=chunksize, dtype=dtype):
+            yield {name: df[name].to_numpy() for name in df.columns}
+
+
+class ColumnWriter:
+    """
+    Write gaze data in chunks of rows to a CSV file with BOM or a session file (.gaze).
+
+    Each column of a session file is spooled to a temporary file until the number of rows is known. The output
+    replaces path only when the writer is closed without an error.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: Path of the output file.
+        """
+        self.path = path
+        self.session = path.endswith(GazeSession.suffix)
+        self.rows = 0
+        self.dtypes = None  # Dtype of each column
+        self.spools = None  # Temporary file of each column (session file)
+        self.time = np.empty(0)  # Time of the frames used to calculate the frame rate (session file)
+        fd, self.tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        if self.session:
+            self.file = os.fdopen(fd, "wb")
+        else:
+            self.file = os.fdopen(fd, "w", encoding="utf_8_sig", newline="")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def append(self, data: Dict[str, np.ndarray]):
+        """
+        Append rows.
+
+        :param data: Dictionary of the columns (numpy arrays of the same length) in order.
+        """
+        if self.dtypes is None:
+            self.dtypes = {name: np.asarray(value).dtype for name, value in data.items()}
+            if self.session:
+                self.spools = {name: tempfile.TemporaryFile(dir=os.path.dirname(self.tmp)) for name in data}
+        if list(data) != list(self.dtypes):
+            raise ValueError("columns differ from the first chunk")
+
+        if self.session:
+            for name, value in data.items():
+                self.spools[name].write(np.ascontiguousarray(value, dtype=self.dtypes[name].newbyteorder("<")).tobytes())
+            if "time" in data and self.time.shape[0] < GazeSession.end_frame:
+                self.time = np.concatenate([self.time, np.asarray(data["time"], dtype=np.float64)])[:GazeSession.end_frame]
+        else:
+            pd.DataFrame(data).to_csv(self.file, header=self.rows == 0, index=False)
+        self.rows += len(next(iter(data.values())))
+
+    def close(self):
+        """
+        Finish the output file.
+        """
+        if self.session:
+            columns, header, data_start = GazeSession.layout(self.dtypes or {}, self.rows,
+                                                             GazeSession.frame_rate(self.time))
+            self.file.write(header)
+            for column in columns:
+                self.file.seek(data_start + column["offset"])
+                spool = self.spools[column["name"]]
+                spool.seek(0)
+                shutil.copyfileobj(spool, self.file)
+                spool.close()
+        self.file.close()
+        os.chmod(self.tmp, file_mode())
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        """
+        Discard the output file.
+        """
+        for spool in (self.spools or {}).values():
+            spool.close()
+        self.file.close()
+        os.remove(self.tmp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert gaze data in CSV files to gaze session files (.gaze).")
+    parser.add_argument("inputs", nargs="+", help="CSV files or directories searched recursively")
+    parser.add_argument("--output-dir", help="Output directory mirroring the input directories (next to the input by default)")
+    parser.add_argument("--dtype", default="float64", choices=["float64", "float32"], help="Dtype of the float columns")
+    parser.add_argument("--force", action="store_true", help="Convert even if the output is newer than the input")
+    args = parser.parse_args()
+
+    for root in args.inputs:
+        if os.path.isdir(root):
+            files = sorted(os.path.join(directory, name) for directory, _, names in os.walk(root)
+                           for name in names if name.endswith(".csv"))
+            base = root
+        else:
+            files = [root]
+            base = os.path.dirname(root)
+        for csv_path in files:
+            path = os.path.splitext(csv_path)[0] + GazeSession.suffix
+            if args.output_dir is not None:
+                path = os.path.join(args.output_dir, os.path.relpath(path, base))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not args.force and os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(csv_path):
+                continue
+            GazeSession.from_csv(csv_path, path, dtype=args.dtype)
+            print(f"{csv_path} -> {path}")
+
+
+if __name__ == "__main__":
+    main()
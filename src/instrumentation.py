@@ -0,0 +1,204 @@
+import cProfile
+import contextlib
+import functools
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+# Instrumentation receiving the timers and counters of this process (None while the instrumentation is off)
+_active = None
+_off = contextlib.nullcontext()
+
+
+def timer(name: str):
+    """
+    Time a block of the pipeline: with timer("stage"): ... (does nothing while the instrumentation is off).
+    """
+    return _off if _active is None else _active.timer(name)
+
+
+def count(name: str, value: int = 1):
+    """
+    Add to a counter of the pipeline (does nothing while the instrumentation is off).
+    """
+    if _active is not None:
+        _active.count(name, value)
+
+
+def timed(name: str) -> Callable:
+    """
+    Decorator timing every call of a function under a name (one check of the instrumentation while it is off).
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            with _active.timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MemorySink:
+    """
+    Sink keeping the records in a list.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def write(self, record: dict):
+        self.records.append(record)
+
+
+class JsonLinesSink:
+    """
+    Sink appending the records to a JSON lines file (one write per record, so that processes can share the file).
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: Path of the JSON lines file.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def write(self, record: dict):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, default=float) + "\n")
+
+
+class Instrumentation:
+    """
+    Timers, counters and peak-memory samples of the pipeline (ExtractFixation, EvaluateGaze, PrecalibrateGaze and
+    OptimizeGaze) sent to a sink.
+
+    The instrumentation is off by default: the hooks of the pipeline (timer, count and timed) only check whether an
+    instrumentation is active. Within with Instrumentation(sink): ... every timed block is sent as a "timer" record
+    (with the resident set size and its peak if memory is set), and the counters and the total time of each timer
+    are sent as a "summary" record at the end of the run. The profile mode also captures the run by cProfile or
+    tracemalloc and sends the top entries as a "profile" record (and writes the full capture to profile_path).
+    The instrumentation is kept per process: the workers of a process pool need their own.
+    """
+
+    profiles = ["cprofile", "tracemalloc"]
+
+    def __init__(self, sink, run: Optional[str] = None, memory: bool = False, profile: Optional[str] = None,
+                 profile_path: Optional[str] = None, top: int = 20):
+        """
+        :param sink: Object receiving the records by write(record) (MemorySink or JsonLinesSink).
+        :param run: Name of the run added to every record.
+        :param memory: Whether to sample the resident set size at the end of every timer.
+        :param profile: Capture mode of the run ("cprofile", "tracemalloc" or None).
+        :param profile_path: Path of the full capture (cProfile stats or tracemalloc snapshot, not written if None).
+        :param top: Integer number of entries of the profile record.
+        """
+        if profile is not None and profile not in self.profiles:
+            raise ValueError("unknown profile mode %r (expected one of %s)" % (profile, ", ".join(self.profiles)))
+        self.sink = sink
+        self.run = run
+        self.memory = memory
+        self.profile = profile
+        self.profile_path = profile_path
+        self.top = top
+        self.counters = {}  # Value of each counter
+        self.timers = {}  # Number of calls and total seconds of each timer
+        self.depth = 0  # Number of open timers (nested timers are sent with their depth)
+        self.previous = None  # Instrumentation active before this one
+        self.profiler = None
+        self.start = None
+
+    def emit(self, event: str, **fields):
+        self.sink.write(dict({"run": self.run, "pid": os.getpid(), "event": event}, **fields))
+
+    @staticmethod
+    def memory_status() -> Dict[str, float]:
+        # Current and peak resident set size in megabytes (the peak only where /proc is not available, empty on Windows)
+        try:
+            with open("/proc/self/status") as f:
+                status = {line.split(":")[0]: int(line.split()[1]) / 1024 for line in f
+                          if line.startswith(("VmRSS:", "VmHWM:"))}
+            return {"rss_mb": status["VmRSS"], "peak_mb": status["VmHWM"]}
+        except (OSError, KeyError):
+            try:
+                import resource
+            except ImportError:
+                return {}
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return {"peak_mb": peak / (1 << 20) if sys.platform == "darwin" else peak / 1024}
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        self.depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.depth -= 1
+            calls, total = self.timers.get(name, (0, 0.0))
+            self.timers[name] = (calls + 1, total + seconds)
+            self.emit("timer", name=name, seconds=seconds, depth=self.depth,
+                      **(self.memory_status() if self.memory else {}))
+
+    def count(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def sample(self, name: str):
+        """
+        Send the current and peak resident set size as a "memory" record.
+        """
+        self.emit("memory", name=name, **self.memory_status())
+
+    def __enter__(self) -> "Instrumentation":
+        global _active
+        self.previous, _active = _active, self
+        self.emit("start")
+        if self.profile == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.profile == "tracemalloc":
+            tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active
+        seconds = time.perf_counter() - self.start
+        if self.profile == "cprofile":
+            self.profiler.disable()
+            self.emit("profile", mode="cprofile", top=self.profile_cprofile())
+        elif self.profile == "tracemalloc":
+            top = self.profile_tracemalloc()
+            tracemalloc.stop()
+            self.emit("profile", mode="tracemalloc", **top)
+        _active = self.previous
+        self.emit("summary", seconds=seconds, counters=self.counters,
+                  timers={name: {"calls": calls, "seconds": total} for name, (calls, total) in self.timers.items()},
+                  error=None if exc_type is None else exc_type.__name__, **self.memory_status())
+        return False
+
+    def profile_cprofile(self) -> List[dict]:
+        # Functions with the largest cumulative time
+        stats = pstats.Stats(self.profiler)
+        if self.profile_path is not None:
+            stats.dump_stats(self.profile_path)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.top]
+        return [{"function": "%s:%d(%s)" % key, "calls": calls, "tottime": tottime, "cumtime": cumtime}
+                for key, (_, calls, tottime, cumtime, _) in rows]
+
+    def profile_tracemalloc(self) -> dict:
+        # Peak of the traced memory and the lines holding the most memory at the end of the run
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        if self.profile_path is not None:
+            snapshot.dump(self.profile_path)
+        top = [{"line": "%s:%d" % (stat.traceback[0].filename, stat.traceback[0].lineno),
+                "size_mb": stat.size / (1 << 20), "count": stat.count}
+               for stat in snapshot.statistics("lineno")[:self.top]]
+        return {"traced_peak_mb": peak / (1 << 20), "top": top}
@@ -0,0 +1,271 @@
+from collections import deque
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional
+import numpy as np
+from extract_fixation import ExtractFixation
+from optimize_gaze import OptimizeGaze
+
+
+class OnlineCalibration:
+    """
+    Online self-calibration that ingests the gaze frames one at a time.
+
+    The fixations are detected by I-VT as in ExtractFixation.get_fixation_by_ivt (a fixation is a run of consecutive
+    frame pairs below the velocity threshold lasting at least the duration threshold). The last max_fixations
+    fixations (of at most max_fixation_frames frames each) are kept, and the parameters (alpha, beta) are refined by
+    a search over the objective of OptimizeGaze: a coarse grid over +-5 degrees followed by a pattern search from the
+    best point. Each frame runs either one batched evaluation of at most batch_size candidates or, when it closes a
+    fixation, the rebuild of the objective (one evaluation), so the work per frame is bounded by
+    batch_size x max_fixations x max_fixation_frames raycasts. The frames received before the frame rate is known
+    are detected at most catch_up per frame, up to the first rebuild, so they do not add to the bound. The latency
+    of push is kept in last_latency and max_latency.
+    """
+
+    # Directions of the pattern search (and the current point)
+    pattern = np.array([[0, 0], [1, 0], [-1, 0], [0, 1], [0, -1], [1, 1], [1, -1], [-1, 1], [-1, -1]], dtype=np.float64)
+
+    def __init__(self, raycaster, fs: Optional[float] = None, dig_per_sec: float = 100, duration: float = 0.2,
+                 param_ini: Optional[List[float]] = None, max_fixations: int = 100, max_fixation_frames: int = 120,
+                 min_fixations: int = 10, grid: int = 11, step: float = 0.5, min_step: float = 0.01,
+                 batch_size: int = 9, catch_up: int = 4, world: bool = False, max_distance: float = 100.0):
+        """
+        :param raycaster: Scene representation providing raycast(origin, direction, frame, max_distance).
+        :param fs: Frame rate (estimated from the frames as ExtractFixation.calculate_th if None).
+        :param dig_per_sec: Velocity threshold (degrees per second).
+        :param duration: Duration threshold (sec).
+        :param param_ini: List of float initial parameters (alpha, beta) used to remove the fixations.
+        :param max_fixations: Maximum number of fixations kept for the objective.
+        :param max_fixation_frames: Maximum number of frames kept for a fixation (the first frames).
+        :param min_fixations: Number of fixations from which the parameters are searched.
+        :param grid: Integer number of grid points of each parameter in the coarse search.
+        :param step: Initial step of the pattern search (degrees).
+        :param min_step: Step of the pattern search at which it is converged (degrees).
+        :param batch_size: Maximum number of candidates evaluated in a frame.
+        :param catch_up: Maximum number of buffered frames detected in a frame (more than one, so the buffer drains).
+        :param world: Whether the velocity is calculated in world coordinate (get_fixation_by_ivt_world).
+        :param max_distance: Maximum distance of the raycast.
+        """
+        self.raycaster = raycaster
+        self.max_distance = max_distance
+        self.optimizer = OptimizeGaze(raycaster, max_distance=max_distance)
+        self.extract = ExtractFixation()  # Frame rate estimation and velocity calculation
+        self.dig_per_sec = dig_per_sec
+        self.duration = duration
+        self.param_ini = [0.0, 0.0] if param_ini is None else list(param_ini)
+        self.max_fixation_frames = max_fixation_frames
+        self.min_fixations = min_fixations
+        self.step0 = step
+        self.min_step = min_step
+        self.batch_size = batch_size
+        self.catch_up = catch_up
+        self.world = world
+
+        # Frame rate and thresholds (ExtractFixation.calculate_th)
+        self.fs = None
+        self.dig_per_frame = None
+        self.duration_frame = None
+        self.pending = deque()  # Frames not detected yet (received before the frame rate is known)
+        if fs is not None:
+            self.set_frame_rate(fs)
+
+        # Fixation detection
+        self.frame_count = 0  # Number of frames received
+        self.prev = None  # Previous frame
+        self.run_start = -1  # First frame of the current run of frame pairs below the velocity threshold
+        self.run_length = 0  # Number of frame pairs in the current run
+        self.run = []  # Frames of the current run (at most max_fixation_frames)
+        self.fixations = deque(maxlen=max_fixations)  # Fixations kept for the objective
+        self.windows = []  # Start and end frames of the detected fixations
+        self.rebuilt = False  # Whether the objective was rebuilt in the current frame
+
+        # Search (coarse grid, then pattern search)
+        axis = np.linspace(-5.0, 5.0, grid)
+        self.grid = np.stack(np.meshgrid(axis, axis, indexing="ij"), axis=2).reshape(-1, 2)
+        self.grid_next = 0  # Next grid point to be evaluated
+        self.grid_error = np.full(self.grid.shape[0], np.inf)
+        self.param = np.array(self.param_ini, dtype=np.float64)  # Current estimate
+        self.error = np.inf  # Objective at the current estimate
+        self.step = step
+        self.evaluations = 0  # Number of candidate evaluations
+
+        # Latency of push (seconds)
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+
+    def set_frame_rate(self, fs: float):
+        self.fs = fs
+        self.dig_per_frame = self.dig_per_sec / fs
+        self.duration_frame = int(np.ceil(fs * self.duration))
+
+    @staticmethod
+    def make_frame(time: float, ray: np.ndarray, openness: np.ndarray, WorldToCamMat: np.ndarray,
+                   CamToWorldMat: np.ndarray, eye: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Format a frame in the same way as ExtractFixation.formatting.
+
+        :param time: Time of the frame (sec).
+        :param ray: Numpy array (3,) representing the gaze direction of the cyclopean eye in camera coordinate.
+        :param openness: Numpy array (2,) representing the openness of the left and right eyes.
+        :param WorldToCamMat: Numpy array (4, 4) representing the recorded WorldToCamera matrix (mat_rc).
+        :param CamToWorldMat: Numpy array (3, 4) representing the recorded CameraToWorld matrix (ctw_rc).
+        :param eye: Numpy array (3,) representing the eye position in camera coordinate.
+        :return: Dictionary of the formatted frame.
+        """
+        ray = np.array(ray, dtype=np.float64)
+        if np.any(np.asarray(openness) < 0.5):
+            ray[:] = np.nan
+        w2c = np.array(WorldToCamMat, dtype=np.float64).reshape(4, 4)
+        w2c[2, :] *= -1.0
+        ctw = np.asarray(CamToWorldMat, dtype=np.float64).reshape(3, 4)
+        c2w = np.array(ctw[:, :3])
+        c2w[:, 2] *= -1.0
+        eye_pos = ctw[:, 3] + np.matmul(c2w, np.asarray(eye, dtype=np.float64)[:, np.newaxis])[:, 0]
+        return {"time": float(time), "ray": ray, "WorldToCamMat": w2c[:3, :3], "CamToWorldMat": c2w,
+                "EyeToWorldPos": eye_pos}
+
+    @staticmethod
+    def iter_frames(data: Dict[str, np.ndarray]) -> Iterator[dict]:
+        """
+        Iterate the frames of recorded gaze data as the arguments of push (e.g. to replay a session).
+
+        :param data: Dictionary of the columns (gaze_session.read_columns).
+        :return: Iterator of dictionaries of the arguments of push.
+        """
+        ray = np.stack([data["ray_x"], data["ray_y"], data["ray_z"]], axis=1)
+        openness = np.stack([data["opennessl"], data["opennessr"]], axis=1)
+        mat = np.stack([data[column] for column in ExtractFixation.mat_columns], axis=1)
+        ctw = np.stack([data[column] for column in ExtractFixation.ctw_columns], axis=1)
+        eye = np.stack([data["eye_x"], data["eye_y"], data["eye_z"]], axis=1)
+        for i in range(ray.shape[0]):
+            yield {"time": data["time"][i], "ray": ray[i], "openness": openness[i], "WorldToCamMat": mat[i],
+                   "CamToWorldMat": ctw[i], "eye": eye[i]}
+
+    def push(self, time: float, ray: np.ndarray, openness: np.ndarray, WorldToCamMat: np.ndarray,
+             CamToWorldMat: np.ndarray, eye: np.ndarray) -> np.ndarray:
+        """
+        Ingest a frame (see make_frame for the arguments).
+
+        :return: Numpy array (2,) representing the current estimate of the parameters (alpha, beta).
+        """
+        start = perf_counter()
+        self.pending.append(self.make_frame(time, ray, openness, WorldToCamMat, CamToWorldMat, eye))
+        extract = self.extract
+        if self.fs is None and len(self.pending) >= extract.end_frame:
+            # Estimate the frame rate from the frames start_frame to end_frame - 1 (ExtractFixation.calculate_th)
+            ts = (self.pending[extract.end_frame - 1]["time"] - self.pending[extract.start_frame]["time"]) / (
+                extract.end_frame - extract.start_frame)
+            self.set_frame_rate(1 / ts)
+        if self.fs is not None:
+            # The frames buffered while the frame rate was unknown are detected over the following frames
+            count = 0
+            while self.pending and count < self.catch_up and not self.rebuilt:
+                self.detect(self.pending.popleft())
+                count += 1
+        # The frame closing a fixation rebuilds the objective instead of searching
+        if not self.rebuilt:
+            self.search()
+        self.rebuilt = False
+
+        self.last_latency = perf_counter() - start
+        self.max_latency = max(self.max_latency, self.last_latency)
+        return self.param
+
+    def detect(self, frame: Dict[str, np.ndarray]):
+        """
+        Update the fixation detection with a frame (ExtractFixation.get_fixation_by_velocity).
+        """
+        frame["index"] = self.frame_count
+        frame["vector"] = np.matmul(frame["CamToWorldMat"], frame["ray"][:, np.newaxis])[:, 0] if self.world else frame["ray"]
+        self.frame_count += 1
+        prev, self.prev = self.prev, frame
+        if prev is None:
+            return
+
+        # The pair of the previous and the current frame is below the velocity threshold
+        valid = not (np.isnan(prev["vector"]).any() or np.isnan(frame["vector"]).any())
+        if valid and self.extract.calculate_angle(prev["vector"], frame["vector"]) < self.dig_per_frame:
+            if self.run_length == 0:
+                self.run_start = prev["index"]
+            self.run_length += 1
+            if len(self.run) < self.max_fixation_frames:
+                self.run.append(prev)
+            return
+        self.close_run()
+
+    def close_run(self):
+        # A run lasting the duration threshold is a fixation
+        if self.run_length >= self.duration_frame:
+            self.windows.append((self.run_start, self.run_start + self.run_length))
+            self.fixations.append({name: np.stack([frame[name] for frame in self.run])
+                                   for name in ["ray", "CamToWorldMat", "WorldToCamMat", "EyeToWorldPos", "index"]})
+            self.update_fixations()
+        self.run_length = 0
+        self.run = []
+
+    def update_fixations(self):
+        """
+        Rebuild the objective from the fixations kept and restart the pattern search.
+        """
+        fixations = list(self.fixations)
+        if len(fixations) < self.min_fixations:
+            return
+        optimizer = OptimizeGaze(self.raycaster, max_distance=self.max_distance)
+        optimizer.set_fixation_arrays(np.concatenate([fixation["ray"] for fixation in fixations]),
+                                      np.concatenate([fixation["CamToWorldMat"] for fixation in fixations]),
+                                      np.concatenate([fixation["WorldToCamMat"] for fixation in fixations]),
+                                      np.concatenate([fixation["EyeToWorldPos"] for fixation in fixations]),
+                                      np.concatenate([fixation["index"] for fixation in fixations]),
+                                      [fixation["index"].shape[0] for fixation in fixations])
+        optimizer.remove_fixation(self.param_ini)
+        self.optimizer = optimizer
+        self.rebuilt = True
+        self.error = np.inf
+        self.step = max(self.step, self.step0 / 4)
+        if self.grid_next < self.grid.shape[0]:
+            # The coarse grid is evaluated again on the same objective
+            self.grid_next = 0
+
+    def search(self):
+        """
+        Run one batched step of the search over the fixations kept.
+        """
+        if self.optimizer.fix_count == 0:
+            return
+        if self.grid_next < self.grid.shape[0]:
+            # Coarse grid (the objective grows with the fixations, so the grid is evaluated once)
+            candidates = self.grid[self.grid_next:self.grid_next + self.batch_size]
+            self.grid_error[self.grid_next:self.grid_next + candidates.shape[0]] = self.evaluate(candidates)
+            self.grid_next += candidates.shape[0]
+            if self.grid_next == self.grid.shape[0]:
+                self.param = self.grid[np.argmin(self.grid_error)].copy()
+                self.step = self.step0
+            return
+        if self.step < self.min_step and np.isfinite(self.error):
+            return
+
+        # Pattern search around the current estimate within +-5 degrees
+        candidates = np.clip(self.param + self.step * self.pattern[:self.batch_size], -5.0, 5.0)
+        error = self.evaluate(candidates)
+        best = int(np.argmin(error))
+        if error[best] < error[0]:
+            self.param = candidates[best]
+        else:
+            self.step /= 2
+        self.error = error[best]
+
+    def evaluate(self, candidates: np.ndarray) -> np.ndarray:
+        self.evaluations += candidates.shape[0]
+        return self.optimizer.error_func_batch(candidates.T)
+
+    def finish(self) -> List[tuple]:
+        """
+        End the session. A run reaching the end of the data is not a fixation (as in the offline detection).
+
+        :return: List of the start and end frames of the detected fixations.
+        """
+        while self.fs is not None and self.pending:
+            self.detect(self.pending.popleft())
+        self.run_length = 0
+        self.run = []
+        return self.windows
+
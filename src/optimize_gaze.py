@@ -0,0 +1,523 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+import numpy as np
+import instrumentation
+from scipy.ndimage import label, maximum_filter, minimum_filter
+from scipy.optimize import Bounds, differential_evolution, least_squares, minimize
+from evaluate_gaze import EvaluateGaze
+
+
+def _optimize_cell(optimizer: "OptimizeGaze", lb: List[float], ub: List[float],
+                   popsize: int, tol: float, seed: int, vectorized: bool) -> Tuple[np.ndarray, float, int]:
+    # Differential evolution in one cell of the grid (run in a worker process)
+    func = optimizer.error_func_batch if vectorized else optimizer.error_func
+    evaluations = optimizer.evaluations
+    result = differential_evolution(func, Bounds(lb, ub), popsize=popsize, tol=tol, seed=seed,
+                                    vectorized=vectorized, updating="deferred" if vectorized else "immediate")
+    return result.x, float(result.fun), optimizer.evaluations - evaluations
+
+
+class OptimizeGaze:
+    """
+    Fixation-based self-calibration without Unity (OptimizeDE and OptimizeUtil).
+
+    The points of regard are obtained from an offline scene representation (scene_geometry.TriangleMesh or
+    scene_geometry.HitPointProxy) instead of Physics.Raycast. The fixations are stored as one ragged array:
+    the frames of fixation i are offsets[i]:offsets[i + 1] of the frame arrays.
+    """
+
+    def __init__(self, raycaster, max_distance: float = 100.0, chunk_size: int = 1 << 21):
+        """
+        :param raycaster: Scene representation providing raycast(origin, direction, frame, max_distance).
+        :param max_distance: Maximum distance of the raycast.
+        :param chunk_size: Maximum number of rays cast at once when evaluating candidate parameters.
+        """
+        self.raycaster = raycaster
+        self.max_distance = max_distance
+        self.chunk_size = chunk_size
+
+        # Fixation data (concatenated over the fixations)
+        self.base_ray = np.empty([0, 3])  # Gaze direction at the visual axis parameter
+        self.CamToWorldMat = np.empty([0, 3, 3])  # Camera (hmd or eye) to world rotation matrix
+        self.WorldToCamMat = np.empty([0, 3, 3])  # World to camera (hmd or eye) rotation matrix
+        self.EyeToWorldPos = np.empty([0, 3])  # Eye position in world coordinate system
+        self.frame = np.empty(0, dtype=np.int64)  # Frames in the gaze data
+        self.offsets = np.zeros(1, dtype=np.int64)  # Start of each fixation (and the total number of frames)
+        self.fix_id = np.empty(0, dtype=np.int64)  # Fixation of each frame
+        self.remove_list = []  # List of fixations to be removed
+        self.fix_num_list = []  # List of representative cameras (index in each fixation)
+        self.center_rot = None  # WorldToCamera matrix of the representative camera of each frame
+        self.center_pos = None  # Eye position of the representative camera of each frame
+        self.evaluations = 0  # Number of candidate parameters evaluated so far
+        self.stats = {}  # Number of evaluations of the last optimization
+
+    @property
+    def fix_count(self) -> int:
+        return self.offsets.shape[0] - 1
+
+    def set_fixation(self, fix, window: np.ndarray) -> int:
+        """
+        Add the fixations detected by ExtractFixation (OptimizeUtil.ExtractFixation).
+
+        :param fix: ExtractFixation holding the formatted gaze data.
+        :param window: Numpy array (M, 2) representing the start and end frames of the fixations.
+        :return: Integer number of fixations.
+        """
+        window = np.asarray(window).astype(np.int64).reshape(-1, 2)
+        window = window[window[:, 1] > window[:, 0]]  # Fixations without frames are ignored
+        frame = np.concatenate([np.arange(fix_on, fix_off) for fix_on, fix_off in window] + [np.empty(0, np.int64)])
+        return self.set_fixation_arrays(fix.base_ray[frame], fix.CamToWorldMat[frame],
+                                        fix.WorldToCamMat[frame, :3, :3], fix.EyeToWorldPos[frame],
+                                        frame, window[:, 1] - window[:, 0])
+
+    def set_fixation_arrays(self, base_ray: np.ndarray, CamToWorldMat: np.ndarray, WorldToCamMat: np.ndarray,
+                            EyeToWorldPos: np.ndarray, frame: np.ndarray, length: np.ndarray) -> int:
+        """
+        Add fixations given as frame arrays concatenated over the fixations.
+
+        :param base_ray: Numpy array (F, 3) representing the gaze directions at the visual axis parameter.
+        :param CamToWorldMat: Numpy array (F, 3, 3) representing the CameraToWorld matrices.
+        :param WorldToCamMat: Numpy array (F, 3, 3) representing the WorldToCamera matrices.
+        :param EyeToWorldPos: Numpy array (F, 3) representing the eye positions in world coordinate.
+        :param frame: Numpy array (F,) representing the frames in the gaze data.
+        :param length: Numpy array (M,) representing the number of frames of each fixation.
+        :return: Integer number of fixations.
+        """
+        length = np.asarray(length, dtype=np.int64)
+        self.base_ray = np.concatenate([self.base_ray, base_ray])
+        self.CamToWorldMat = np.concatenate([self.CamToWorldMat, CamToWorldMat])
+        self.WorldToCamMat = np.concatenate([self.WorldToCamMat, WorldToCamMat])
+        self.EyeToWorldPos = np.concatenate([self.EyeToWorldPos, EyeToWorldPos])
+        self.frame = np.concatenate([self.frame, frame])
+        self.offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum(length)])
+        self.fix_id = np.repeat(np.arange(self.fix_count), np.diff(self.offsets))
+        # The representative cameras are chosen again by remove_fixation
+        self.center_rot = None
+        self.center_pos = None
+        return self.fix_count
+
+    @staticmethod
+    def transform(mat: np.ndarray, vec: np.ndarray) -> np.ndarray:
+        """
+        Multiply per-frame 3x3 matrices with stacks of vectors.
+
+        :param mat: Numpy array (N, 3, 3) representing the matrices.
+        :param vec: Numpy array (..., N, 3) representing the vectors.
+        :return: Numpy array (..., N, 3) representing the products.
+        """
+        return mat[:, :, 0] * vec[..., 0:1] + mat[:, :, 1] * vec[..., 1:2] + mat[:, :, 2] * vec[..., 2:3]
+
+    @staticmethod
+    def calibrate_ray_by_3d(param: List[float], ray: np.ndarray) -> np.ndarray:
+        """
+        Calibrate the gaze directions using 3D eye model (OptimizeUtil.CalibrateRayBy3D).
+
+        :param param: List of float parameters (alpha, beta) in degrees.
+        :param ray: Numpy array (N, 3) representing the gaze directions.
+        :return: Numpy array (N, 3) representing the normalized calibrated gaze directions.
+        """
+        calib_ray = np.matmul(ray, EvaluateGaze.get_rotation(param).T)
+        return calib_ray / np.linalg.norm(calib_ray, axis=1, keepdims=True)
+
+    def calculate_pors(self, ray: np.ndarray, CamToWorldMat: np.ndarray,
+                       EyeToWorldPos: np.ndarray, frame: np.ndarray) -> np.ndarray:
+        """
+        Calculate the points of regard (OptimizeUtil.CalculatePoRs).
+
+        :param ray: Numpy array (..., N, 3) representing the gaze directions in camera coordinate.
+        :param CamToWorldMat: Numpy array (N, 3, 3) representing the CameraToWorld matrices.
+        :param EyeToWorldPos: Numpy array (N, 3) representing the eye positions in world coordinate.
+        :param frame: Numpy array (N,) representing the frames.
+        :return: Numpy array (..., N, 3) representing the points of regard (nan for non-collision).
+        """
+        direction = self.transform(CamToWorldMat, ray)
+        origin = np.broadcast_to(EyeToWorldPos, direction.shape)
+        por = self.raycaster.raycast(origin.reshape(-1, 3), direction.reshape(-1, 3),
+                                     np.broadcast_to(frame, direction.shape[:-1]).reshape(-1), self.max_distance)
+        return por.reshape(direction.shape)
+
+    @staticmethod
+    def choice_center_camera(ray: np.ndarray, CamToWorldMat: np.ndarray) -> int:
+        """
+        Choose the representative camera whose gaze direction is the closest to the mean (OptimizeUtil.ChoiceCenterCamera).
+
+        :param ray: Numpy array (N, 3) representing the gaze directions in camera coordinate.
+        :param CamToWorldMat: Numpy array (N, 3, 3) representing the CameraToWorld matrices.
+        :return: Integer index of the representative camera.
+        """
+        direction = np.matmul(CamToWorldMat, ray[:, :, np.newaxis])[:, :, 0]
+        return int(np.argmin(np.linalg.norm(direction.mean(axis=0) - direction, axis=1)))
+
+    def choice_center_cameras(self, ray: np.ndarray) -> np.ndarray:
+        """
+        Choose the representative camera of every fixation at once.
+
+        :param ray: Numpy array (F, 3) representing the gaze directions of all fixations.
+        :return: Numpy array (M,) representing the index of the representative camera in each fixation.
+        """
+        if self.fix_count == 0:
+            return np.empty(0, dtype=np.int64)
+        direction = np.matmul(self.CamToWorldMat, ray[:, :, np.newaxis])[:, :, 0]
+        mean = np.add.reduceat(direction, self.offsets[:-1], axis=0) / np.diff(self.offsets)[:, np.newaxis]
+        dis = np.linalg.norm(mean[self.fix_id] - direction, axis=1)
+        # First frame with the minimum distance in each fixation
+        order = np.lexsort((np.arange(dis.shape[0]), dis, self.fix_id))
+        return order[self.offsets[:-1]] - self.offsets[:-1]
+
+    @staticmethod
+    def reprojection_pors(WorldToCamMat: np.ndarray, EyeToWorldPos: np.ndarray, por: np.ndarray) -> np.ndarray:
+        """
+        Reproject the points of regard to the scene image plane of a camera (OptimizeUtil.ReprojectionPoRs).
+
+        :param WorldToCamMat: Numpy array (3, 3) representing the WorldToCamera matrix of the camera.
+        :param EyeToWorldPos: Numpy array (3,) representing the eye position of the camera.
+        :param por: Numpy array (N, 3) representing the points of regard.
+        :return: Numpy array (N, 2) representing the reprojected gaze positions.
+        """
+        ray_eye = np.matmul(por - EyeToWorldPos, WorldToCamMat.T)
+        return ray_eye[:, :2] / ray_eye[:, 2:]
+
+    @staticmethod
+    def calculate_reprojection_error(fix_gaze: np.ndarray) -> Tuple[float, np.ndarray]:
+        """
+        Calculate the reprojection error (OptimizeUtil.CalculateReprojectionError).
+
+        :param fix_gaze: Numpy array (N, 2) representing the reprojected gaze positions.
+        :return: Tuple containing the mean squared distance from the mean and the mean.
+        """
+        fix_mean = fix_gaze.mean(axis=0)
+        return float(np.mean(np.sum((fix_gaze - fix_mean) ** 2, axis=1))), fix_mean
+
+    def fixation_errors(self, param: np.ndarray, first: int = 0) -> np.ndarray:
+        """
+        Calculate the reprojection error of every fixation for a stack of candidate parameters.
+
+        :param param: Numpy array (K, 2) representing the candidate parameters (alpha, beta) in degrees.
+        :param first: Integer index of the first fixation evaluated (the fixations before it are skipped).
+        :return: Numpy array (K, M - first) representing the reprojection errors (nan for non-collision fixations).
+        """
+        param = np.asarray(param, dtype=np.float64).reshape(-1, 2)
+        self.evaluations += param.shape[0]
+        instrumentation.count("objective_evaluations", param.shape[0])
+        error = np.empty([param.shape[0], max(self.fix_count - first, 0)])
+        if error.shape[1] == 0:
+            return error
+        if self.center_rot is None:
+            raise ValueError("representative cameras are not chosen: call remove_fixation first")
+
+        # Frames of the evaluated fixations
+        frames = slice(self.offsets[first], None)
+        offsets = self.offsets[first:-1] - self.offsets[first]
+        fix_id = self.fix_id[frames] - first
+        count = np.diff(self.offsets[first:])
+        base_ray = self.base_ray[frames]
+
+        step = max(1, self.chunk_size // base_ray.shape[0])
+        for k in range(0, param.shape[0], step):
+            # Calibrate the gaze directions (OptimizeUtil.CalibrateRayBy3D, normalized by the raycast)
+            rot = EvaluateGaze.get_rotations(param[k:k + step])
+            calib_ray = np.matmul(base_ray, np.swapaxes(rot, 1, 2))
+
+            # Calculate the points of regard and reproject them to the representative cameras
+            fix_pos = self.calculate_pors(calib_ray, self.CamToWorldMat[frames], self.EyeToWorldPos[frames],
+                                          self.frame[frames])
+            ray_eye = self.transform(self.center_rot[frames], fix_pos - self.center_pos[frames])
+            fix_gaze = ray_eye[:, :, :2] / ray_eye[:, :, 2:]
+
+            # Mean squared distance from the mean in each fixation (nan if any frame is non-collision)
+            fix_mean = np.add.reduceat(fix_gaze, offsets, axis=1) / count[:, np.newaxis]
+            dis = np.sum((fix_gaze - fix_mean[:, fix_id]) ** 2, axis=2)
+            error[k:k + step] = np.add.reduceat(dis, offsets, axis=1) / count
+        return error
+
+    def fixation_residuals(self, param: List[float], jac: bool = False):
+        """
+        Calculate the residuals of the reprojected gaze positions from the mean of their fixation.
+
+        The residuals are scaled by the square root of the length of their fixation, so their sum of squares is
+        error_func. The residuals of the removed fixations and of the fixations with non-collision gaze directions
+        are zero. The Jacobian is the derivative of the reprojection through the planes hit by the raycast
+        (raycaster.plane), exact as long as the same planes are hit.
+
+        :param param: List of float parameters (alpha, beta) in degrees.
+        :param jac: Whether to return the Jacobian with respect to the parameters.
+        :return: Numpy array (2F,) representing the residuals, and the numpy array (2F, 2) representing the Jacobian
+            if jac is set.
+        """
+        self.evaluations += 1
+        instrumentation.count("objective_evaluations")
+        if self.center_rot is None:
+            raise ValueError("representative cameras are not chosen: call remove_fixation first")
+        offsets = self.offsets[:-1]
+        count = np.diff(self.offsets)
+        if self.fix_count == 0:
+            return (np.empty(0), np.empty([0, 2])) if jac else np.empty(0)
+
+        # Rotation and its derivatives (per degree) applied to the gaze directions
+        alpha, beta = np.deg2rad(param[0]), np.deg2rad(param[1])
+        ca, sa, cb, sb = np.cos(alpha), np.sin(alpha), np.cos(beta), np.sin(beta)
+        y_rot = np.array([[ca, 0.0, sa], [0.0, 1.0, 0.0], [-sa, 0.0, ca]])
+        x_rot = np.array([[1.0, 0.0, 0.0], [0.0, cb, sb], [0.0, -sb, cb]])
+        dy_rot = np.array([[-sa, 0.0, ca], [0.0, 0.0, 0.0], [-ca, 0.0, -sa]])
+        dx_rot = np.array([[0.0, 0.0, 0.0], [0.0, -sb, cb], [0.0, -cb, -sb]])
+        rot = np.stack([y_rot @ x_rot, dy_rot @ x_rot, y_rot @ dx_rot])
+        rot[1:] *= np.pi / 180.0
+        direction = self.transform(self.CamToWorldMat, np.matmul(self.base_ray, np.swapaxes(rot, 1, 2)))
+
+        # Points of regard on the planes hit by the raycast
+        fix_pos, index = self.raycaster.raycast(self.EyeToWorldPos, direction[0], self.frame, self.max_distance,
+                                                return_index=True)
+        ray_eye = self.transform(self.center_rot, fix_pos - self.center_pos)
+        fix_gaze = ray_eye[:, :2] / ray_eye[:, 2:]
+        scale = 1.0 / np.sqrt(count)[self.fix_id, np.newaxis]
+        fix_mean = np.add.reduceat(fix_gaze, offsets, axis=0) / count[:, np.newaxis]
+        residual = (fix_gaze - fix_mean[self.fix_id]) * scale
+
+        # Fixations skipped by error_func
+        skip = np.logical_or.reduceat(np.isnan(residual).any(axis=1), offsets)
+        skip[self.remove_list] = True
+        residual[skip[self.fix_id]] = 0.0
+        if not jac:
+            return residual.reshape(-1)
+
+        # Derivative of the hit point o + t * d on the plane n . (x - q) = 0 along the rotated directions
+        _, normal = self.raycaster.plane(index)
+        denominator = np.einsum("ij,ij->i", normal, direction[0])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (np.einsum("ij,ij->i", normal, fix_pos - self.EyeToWorldPos) / denominator)[:, np.newaxis]
+            d_pos = t * (direction[1:] - direction[0] * (np.einsum("kij,ij->ki", direction[1:], normal)
+                                                         / denominator)[:, :, np.newaxis])
+            d_eye = self.transform(self.center_rot, d_pos)
+            d_gaze = (d_eye[:, :, :2] - fix_gaze * d_eye[:, :, 2:]) / ray_eye[:, 2:]
+        d_mean = np.add.reduceat(d_gaze, offsets, axis=1) / count[:, np.newaxis]
+        jacobian = (d_gaze - d_mean[:, self.fix_id]) * scale
+        jacobian[:, skip[self.fix_id]] = 0.0
+        return residual.reshape(-1), np.nan_to_num(jacobian.reshape(2, -1).T)
+
+    @instrumentation.timed("OptimizeGaze.remove_fixation")
+    def remove_fixation(self, param: List[float]) -> List[int]:
+        """
+        Find the fixations with non-collision gaze directions and choose the representative cameras (OptimizeDE.RemoveFixation).
+
+        :param param: List of float parameters (alpha, beta) in degrees.
+        :return: List of the fixations to be removed.
+        """
+        calib_ray = self.calibrate_ray_by_3d(param, self.base_ray)
+        self.fix_num_list = self.choice_center_cameras(calib_ray).tolist()
+        center = (self.offsets[:-1] + np.asarray(self.fix_num_list, dtype=np.int64))[self.fix_id]
+        self.center_rot = self.WorldToCamMat[center]
+        self.center_pos = self.EyeToWorldPos[center]
+
+        fix_pos = self.calculate_pors(calib_ray, self.CamToWorldMat, self.EyeToWorldPos, self.frame)
+        non_hit = np.zeros(self.fix_count, dtype=bool)
+        if self.fix_count > 0:
+            non_hit = np.logical_or.reduceat(np.isnan(fix_pos).any(axis=1), self.offsets[:-1])
+        self.remove_list = np.flatnonzero(non_hit).tolist()
+        instrumentation.count("fixations_non_hit", len(self.remove_list))
+        return self.remove_list
+
+    def error_func_batch(self, param: np.ndarray) -> np.ndarray:
+        """
+        Calculate the sum of the reprojection errors for a population of candidate parameters.
+
+        It follows scipy.optimize.differential_evolution(vectorized=True): the candidates are the columns of param.
+
+        :param param: Numpy array (2, S) representing the candidate parameters (alpha, beta) in degrees.
+        :return: Numpy array (S,) representing the sum of the reprojection errors of each candidate.
+        """
+        param = np.asarray(param, dtype=np.float64)
+        if param.ndim == 1:
+            return self.error_func(param)
+        error = self.fixation_errors(param.T)
+        error[:, self.remove_list] = np.nan
+        # Fixations with non-collision gaze directions are skipped
+        return np.nansum(error, axis=1)
+
+    def error_func(self, param: List[float]) -> float:
+        """
+        Calculate the sum of the reprojection errors of the fixations (OptimizeDE.ErrorFunc).
+
+        :param param: List of float parameters (alpha, beta) in degrees.
+        :return: float value representing the sum of the reprojection errors.
+        """
+        return float(self.error_func_batch(np.reshape(param, (2, 1)))[0])
+
+    @instrumentation.timed("OptimizeGaze.optimize")
+    def optimize(self, param_ini: List[float], div: int = 4, popsize: int = 15, tol: float = 0.0001,
+                 seed: int = 1, vectorized: bool = True, workers: int = 1) -> Tuple[np.ndarray, float]:
+        """
+        Estimate the calibration parameters by differential evolution in each cell of a grid over +-5 degrees (OptimizeDE.Optimize).
+
+        :param param_ini: List of float initial parameters (alpha, beta) used to remove the fixations.
+        :param div: Integer number of divisions of each parameter range.
+        :param popsize: Population size of the differential evolution.
+        :param tol: Relative tolerance of the differential evolution.
+        :param seed: Random seed of the differential evolution.
+        :param vectorized: Whether to evaluate the whole population at once.
+        :param workers: Integer number of processes optimizing the cells in parallel.
+        :return: Tuple containing the estimated parameters and the value of the objective.
+        """
+        self.remove_fixation(param_ini)
+
+        cells = []
+        for i in range(div):
+            for j in range(div):
+                lb = [-5.0 + 10.0 / div * i, -5.0 + 10.0 / div * j]
+                ub = [-5.0 + 10.0 / div * (i + 1), -5.0 + 10.0 / div * (j + 1)]
+                cells.append((lb, ub))
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_optimize_cell, self, lb, ub, popsize, tol, seed, vectorized)
+                           for lb, ub in cells]
+                results = [future.result() for future in futures]
+            self.evaluations += sum(count for _, _, count in results)
+            instrumentation.count("objective_evaluations", sum(count for _, _, count in results))
+        else:
+            results = [_optimize_cell(self, lb, ub, popsize, tol, seed, vectorized) for lb, ub in cells]
+        self.stats = {"evaluations": sum(count for _, _, count in results)}
+
+        # Get the optimal parameters
+        ind_opt = int(np.argmin([value for _, value, _ in results]))
+        return results[ind_opt][:2]
+
+    @instrumentation.timed("OptimizeGaze.optimize_coarse_to_fine")
+    def optimize_coarse_to_fine(self, param_ini: List[float], grid: int = 21, margin: float = 2.0,
+                                max_starts: int = 4, xatol: float = 0.001, fatol: float = 1e-9,
+                                maxfev: int = 200) -> Tuple[np.ndarray, float]:
+        """
+        Estimate the calibration parameters over +-5 degrees coarse to fine (a cheaper alternative to optimize).
+
+        The objective is evaluated at the nodes of a grid x grid surface in one batched pass. A cell of the surface
+        cannot hold a value below the best node if its lowest corner minus the local slope (the largest corner
+        difference around the cell times margin) times the half diagonal is above the best node, so these cells are
+        pruned. The Nelder-Mead method then starts from the nodes of the remaining cells that are not above any of
+        their neighbours (at most max_starts of them, lowest first) within the bounds of the connected region of
+        remaining cells around the node.
+        The numbers of evaluations are kept in stats.
+
+        :param param_ini: List of float initial parameters (alpha, beta) used to remove the fixations.
+        :param grid: Integer number of nodes of the surface along each parameter.
+        :param margin: Safety factor of the local slope used to prune the cells.
+        :param max_starts: Maximum number of local minima refined by the local optimizer.
+        :param xatol: Absolute tolerance of the parameters in the local optimizer.
+        :param fatol: Absolute tolerance of the objective in the local optimizer.
+        :param maxfev: Maximum number of evaluations of the local optimizer from each start.
+        :return: Tuple containing the estimated parameters and the value of the objective.
+        """
+        self.remove_fixation(param_ini)
+
+        # Error surface at the nodes of the grid
+        axis = np.linspace(-5.0, 5.0, grid)
+        step = axis[1] - axis[0]
+        nodes = np.stack(np.meshgrid(axis, axis, indexing="ij"), axis=2)
+        evaluations = self.evaluations
+        value = self.error_func_batch(nodes.reshape(-1, 2).T).reshape(grid, grid)
+
+        # Lower bound of the objective in each cell from its corners and the slope around it
+        corner = np.stack([value[:-1, :-1], value[1:, :-1], value[:-1, 1:], value[1:, 1:]])
+        slope = maximum_filter((corner.max(axis=0) - corner.min(axis=0)) / step, size=3, mode="nearest")
+        lower = corner.min(axis=0) - margin * slope * step / np.sqrt(2.0)
+        kept = lower <= value.min()
+
+        # Refine the local minima of the nodes of the remaining cells within the bounds of their region
+        regions, count = label(kept, structure=np.ones([3, 3]))
+        region = maximum_filter(np.pad(regions, 1), size=2)[1:, 1:]  # Region of each node (the largest label)
+        minimum = value <= minimum_filter(value, size=3, mode="nearest")
+        starts = np.flatnonzero((region > 0) & minimum)
+        starts = starts[np.argsort(value.reshape(-1)[starts], kind="stable")][:max_starts]
+        bounds = {}
+        for label_id in np.unique(region.reshape(-1)[starts]):
+            i, j = np.nonzero(regions == label_id)
+            bounds[label_id] = Bounds([axis[i.min()], axis[j.min()]], [axis[i.max() + 1], axis[j.max() + 1]])
+
+        x_opt, f_opt = nodes.reshape(-1, 2)[np.argmin(value)], float(value.min())
+        for index in starts:
+            start = nodes.reshape(-1, 2)[index]
+            bound = bounds[region.reshape(-1)[index]]
+            # Initial simplex of half a cell turned back inside the bounds
+            simplex = start + np.array([[0.0, 0.0], [step / 2, 0.0], [0.0, step / 2]])
+            simplex = np.where(simplex > bound.ub, 2.0 * start - simplex, simplex)
+            result = minimize(self.error_func, start, method="Nelder-Mead", bounds=bound,
+                              options={"xatol": xatol, "fatol": fatol, "maxfev": maxfev,
+                                       "initial_simplex": simplex})
+            if result.fun < f_opt:
+                x_opt, f_opt = result.x, float(result.fun)
+
+        self.stats = {"evaluations": self.evaluations - evaluations, "grid": grid * grid,
+                      "local": self.evaluations - evaluations - grid * grid,
+                      "cells": int(kept.size), "kept": int(kept.sum()), "regions": count, "starts": len(starts)}
+        return x_opt, f_opt
+
+    @instrumentation.timed("OptimizeGaze.optimize_gradient")
+    def optimize_gradient(self, param_ini: List[float], grid: int = 15, max_starts: int = 6, xtol: float = 1e-10,
+                          ftol: float = 1e-10, max_nfev: int = 10, polish: bool = True, xatol: float = 0.001,
+                          fatol: float = 1e-9, maxfev: int = 200) -> Tuple[np.ndarray, float]:
+        """
+        Estimate the calibration parameters over +-5 degrees by Gauss-Newton steps from a few starts (a cheaper alternative to optimize).
+
+        The objective is evaluated at the nodes of a grid x grid surface in one batched pass, and the nodes that are
+        not above any of their neighbours (at most max_starts of them, lowest first) start the trust region
+        reflective method of scipy.optimize.least_squares on the residuals of fixation_residuals with their
+        analytic Jacobian. The objective drops where a fixation stops colliding with the scene (it is then skipped),
+        and its minimum often lies on such an edge, which the Gauss-Newton steps of one side cannot reach: the best
+        solution is polished by the Nelder-Mead method from a simplex of a quarter of a cell.
+        The numbers of evaluations are kept in stats.
+
+        :param param_ini: List of float initial parameters (alpha, beta) used to remove the fixations.
+        :param grid: Integer number of nodes of the surface along each parameter.
+        :param max_starts: Maximum number of starts of the least squares.
+        :param xtol: Tolerance of the parameters in the least squares.
+        :param ftol: Tolerance of the objective in the least squares.
+        :param max_nfev: Maximum number of evaluations of the least squares from each start.
+        :param polish: Whether to polish the best solution by the Nelder-Mead method.
+        :param xatol: Absolute tolerance of the parameters in the polish.
+        :param fatol: Absolute tolerance of the objective in the polish.
+        :param maxfev: Maximum number of evaluations of the polish.
+        :return: Tuple containing the estimated parameters and the value of the objective.
+        """
+        self.remove_fixation(param_ini)
+
+        # Starts at the local minima of the error surface
+        axis = np.linspace(-5.0, 5.0, grid)
+        nodes = np.stack(np.meshgrid(axis, axis, indexing="ij"), axis=2).reshape(-1, 2)
+        evaluations = self.evaluations
+        value = self.error_func_batch(nodes.T)
+        minimum = value <= minimum_filter(value.reshape(grid, grid), size=3, mode="nearest").reshape(-1)
+        starts = np.flatnonzero(minimum)
+        starts = starts[np.argsort(value[starts], kind="stable")][:max_starts]
+
+        # The Jacobian is computed with the residuals and kept for the jac call at the same parameters
+        last = {}
+
+        def residuals(x):
+            last["x"] = np.copy(x)
+            last["residual"], last["jacobian"] = self.fixation_residuals(x, jac=True)
+            return last["residual"]
+
+        def jacobian(x):
+            if not np.array_equal(x, last.get("x")):
+                residuals(x)
+            return last["jacobian"]
+
+        x_opt, f_opt = nodes[np.argmin(value)], float(value.min())
+        for index in starts:
+            result = least_squares(residuals, nodes[index], jac=jacobian, bounds=([-5.0, -5.0], [5.0, 5.0]),
+                                   method="trf", xtol=xtol, ftol=ftol, gtol=None, max_nfev=max_nfev)
+            if 2.0 * result.cost < f_opt:
+                x_opt, f_opt = result.x, float(2.0 * result.cost)
+        local = self.evaluations - evaluations - grid * grid
+
+        if polish:
+            # Initial simplex of a quarter of a cell turned back inside the bounds
+            size = (axis[1] - axis[0]) / 4
+            simplex = x_opt + np.array([[0.0, 0.0], [size, 0.0], [0.0, size]])
+            simplex = np.where(simplex > 5.0, 2.0 * x_opt - simplex, simplex)
+            result = minimize(self.error_func, x_opt, method="Nelder-Mead", bounds=Bounds([-5.0, -5.0], [5.0, 5.0]),
+                              options={"xatol": xatol, "fatol": fatol, "maxfev": maxfev, "initial_simplex": simplex})
+            if result.fun < f_opt:
+                x_opt, f_opt = result.x, float(result.fun)
+
+        self.stats = {"evaluations": self.evaluations - evaluations, "grid": grid * grid, "local": local,
+                      "polish": self.evaluations - evaluations - grid * grid - local, "starts": len(starts)}
+        return x_opt, f_opt
@@ -0,0 +1,174 @@
+import argparse
+import os
+from time import perf_counter
+from typing import List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from extract_fixation import ExtractFixation
+from fixation_cache import FixationCache
+from optimize_gaze import OptimizeGaze
+from scene_geometry import HitPointProxy, TriangleMesh
+
+
+class ParityGaze:
+    """
+    Parity of the solvers of OptimizeGaze against the differential evolution results of param/*/param_*.csv.
+
+    For every row of a param_*.csv whose gaze data is available, each solver is run on the fixations of the row and
+    its estimate is compared with a reference estimate of the same objective. With a mesh and the data calibrated
+    to the optical axis (data/*_data_opt) the objective is the one of the stored results, and the reference is the
+    stored estimate. Otherwise (e.g. the points of regard of the raw data, HitPointProxy) the stored estimates belong
+    to another objective, and the reference is the differential evolution solver ("de") run on the same fixations;
+    without it the row is not checked. A row passes if every other solver is within param_tol degrees of the
+    reference.
+    """
+
+    # Participants of the rows of param_*.csv (as the notebooks of result_graph)
+    users = [1, 5, 6, 7, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22]
+    solvers = ["gradient", "coarse_to_fine", "de"]
+
+    def __init__(self, param_path: str, data: str, windows: Optional[str] = None, mesh: Optional[str] = None,
+                 solvers: Tuple[str, ...] = ("gradient",), detector: str = "ivdt", dig_per_sec: float = 80,
+                 duration: float = 0.16, dispersion: float = 0.00015, param_tol: float = 0.05):
+        """
+        :param param_path: Path of the param_*.csv file (columns alpha and beta).
+        :param data: Template of the gaze data of each row, formatted with {user} and {row}.
+        :param windows: Template of the CSV files of the fixations of each row, formatted with {user} and {row}
+            (detected by detector if None).
+        :param mesh: Scene mesh (OBJ or TriangleMesh.save) instead of the recorded points of regard.
+        :param solvers: Solvers compared with the stored estimates ("gradient", "coarse_to_fine" or "de").
+        :param detector: Fixation detector used without windows.
+        :param dig_per_sec: Velocity threshold (degrees per second).
+        :param duration: Duration threshold (sec).
+        :param dispersion: Dispersion threshold of idt and ivdt.
+        :param param_tol: Tolerance of the estimates from the reference estimate (degrees).
+        """
+        self.param = pd.read_csv(param_path)
+        self.data = data
+        self.windows = windows
+        self.mesh = None
+        if mesh is not None:
+            self.mesh = TriangleMesh.from_obj(mesh) if mesh.lower().endswith(".obj") else TriangleMesh.load(mesh)
+        self.solvers = solvers
+        self.detector = detector
+        self.dig_per_sec = dig_per_sec
+        self.duration = duration
+        self.dispersion = dispersion
+        self.param_tol = param_tol
+        # The stored estimates minimize the objective only with the scene mesh and the data of the stored results
+        self.stored_objective = mesh is not None and "_data_opt" in data
+
+    def solve(self, optimizer: OptimizeGaze, solver: str) -> Tuple[np.ndarray, float]:
+        if solver == "gradient":
+            return optimizer.optimize_gradient([0.0, 0.0])
+        if solver == "coarse_to_fine":
+            return optimizer.optimize_coarse_to_fine([0.0, 0.0])
+        param = optimizer.optimize([0.0, 0.0])[0]
+        return param, optimizer.error_func(param)
+
+    def compare(self, row: int, user: int) -> dict:
+        """
+        Compare the solvers with the stored estimate of a row.
+
+        :param row: Integer index of the row of param_*.csv.
+        :param user: Integer participant of the row.
+        :return: Dictionary of the stored estimate, the reference ("stored", "de" or None), the status ("passed",
+            "failed" or "not checked") and the estimate, the objective, the distance from the reference, the
+            evaluations and the elapsed time of each solver.
+        """
+        fix = ExtractFixation()
+        fix.duration = self.duration
+        fix.dispersion_th = self.dispersion
+        fix.formatting(self.data.format(user=user, row=row))
+        fix.calculate_th(self.dig_per_sec)
+        if self.windows is not None:
+            window = np.loadtxt(self.windows.format(user=user, row=row), delimiter=",", ndmin=2)
+        else:
+            window = getattr(fix, FixationCache.detectors[self.detector])(fix.duration_frame)
+        if self.mesh is not None:
+            raycaster = self.mesh
+        else:
+            raycaster = HitPointProxy(fix.PoR, np.matmul(fix.CamToWorldMat, fix.ray[:, :, np.newaxis])[:, :, 0])
+
+        optimizer = OptimizeGaze(raycaster)
+        optimizer.set_fixation(fix, window)
+        optimizer.remove_fixation([0.0, 0.0])
+        stored = self.param[["alpha", "beta"]].to_numpy()[row]
+        result = {"row": row, "user": user, "fixations": optimizer.fix_count, "alpha": stored[0], "beta": stored[1],
+                  "value": optimizer.error_func(stored), "reference": None, "status": "not checked"}
+        params = {}
+        for solver in self.solvers:
+            start = perf_counter()
+            param, value = self.solve(optimizer, solver)
+            params[solver] = np.asarray(param)
+            result.update({solver + "_alpha": param[0], solver + "_beta": param[1], solver + "_value": value,
+                           solver + "_evaluations": optimizer.stats["evaluations"],
+                           solver + "_seconds": perf_counter() - start})
+
+        # Distance of each solver from the reference estimate of the same objective
+        if self.stored_objective:
+            result["reference"], reference = "stored", stored
+        elif "de" in params:
+            result["reference"], reference = "de", params["de"]
+        checked = [solver for solver in self.solvers if solver != result["reference"]]
+        for solver in checked if result["reference"] is not None else []:
+            result[solver + "_diff"] = float(np.max(np.abs(params[solver] - reference)))
+        if result["reference"] is not None and checked:
+            passed = all(result[solver + "_diff"] <= self.param_tol for solver in checked)
+            result["status"] = "passed" if passed else "failed"
+        return result
+
+    def run(self, users: Optional[List[int]] = None) -> pd.DataFrame:
+        """
+        Compare the rows whose gaze data is available.
+
+        :param users: List of the participants of the rows (ParityGaze.users if None).
+        :return: DataFrame of the comparison of each row.
+        """
+        users = self.users if users is None else users
+        rows = []
+        for row, user in enumerate(users[:self.param.shape[0]]):
+            if not os.path.exists(self.data.format(user=user, row=row)):
+                continue
+            rows.append(self.compare(row, user))
+            print(" ".join("%s=%s" % (key, "%.4g" % value if isinstance(value, float) else value)
+                           for key, value in rows[-1].items()), flush=True)
+        return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the solvers with the stored differential evolution results.")
+    parser.add_argument("param", help="param_*.csv file of the stored estimates")
+    parser.add_argument("--data", required=True, help="Template of the gaze data of each row ({user} and {row})")
+    parser.add_argument("--windows", help="Template of the CSV files of the fixations of each row ({user} and {row})")
+    parser.add_argument("--mesh", help="Scene mesh (OBJ or TriangleMesh.save) instead of the recorded points of regard")
+    parser.add_argument("--solvers", nargs="+", default=["gradient"], choices=ParityGaze.solvers, help="Solvers")
+    parser.add_argument("--users", type=int, nargs="+", help="Participants of the rows of the param file")
+    parser.add_argument("--detector", default="ivdt", choices=list(FixationCache.detectors), help="Fixation detector")
+    parser.add_argument("--dig-per-sec", type=float, default=80, help="Velocity threshold (degrees per second)")
+    parser.add_argument("--duration", type=float, default=0.16, help="Duration threshold (sec)")
+    parser.add_argument("--dispersion", type=float, default=0.00015, help="Dispersion threshold of idt and ivdt")
+    parser.add_argument("--param-tol", type=float, default=0.05,
+                        help="Tolerance of the estimates from the reference estimate (degrees)")
+    parser.add_argument("--output", help="CSV file of the comparison")
+    args = parser.parse_args()
+
+    parity = ParityGaze(args.param, args.data, args.windows, args.mesh, tuple(args.solvers), args.detector,
+                        args.dig_per_sec, args.duration, args.dispersion, args.param_tol)
+    results = parity.run(args.users)
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
+    if results.empty:
+        raise SystemExit("no gaze data of the rows of %s" % args.param)
+    status = results["status"].value_counts()
+    print("passed %d, failed %d, not checked %d of %d rows"
+          % (status.get("passed", 0), status.get("failed", 0), status.get("not checked", 0), results.shape[0]))
+    if status.get("not checked", 0) > 0:
+        print("rows without a reference of the same objective are not checked (run de, or pass --mesh with "
+              "data/*_data_opt to compare with the stored estimates)")
+    if status.get("failed", 0) > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,31 @@
-from typing import List
+from typing import List, Optional, Tuple, Union
 import numpy as np
 import pandas as pd
+import instrumentation
 from evaluate_gaze import EvaluateGaze
+from gaze_session import ColumnWriter, iter_columns
 
 
 class PrecalibrateGaze:
 
-    def __init__(self, path: str):
-        self.param_base = pd.read_csv(path).values
+    def __init__(self, path: Union[str, np.ndarray]):
+        # Regression parameters of the users (row user_id - 1) read from a CSV file or given as an array
+        self.param_base = pd.read_csv(path).values if isinstance(path, str) else np.asarray(path)
         print(f"param_base.shape: {self.param_base.shape}")
 
-    def precalibrate_gaze(self, input_path: str, output_path: str,
-                          user_id: int, param: List[float]) -> None:
+    def precalibrate_ray(self, user_id: int, rot: np.ndarray,
+                         ray: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
         """
-        Pre-calibrate gaze data using regression model and 3D eye model.
+        Pre-calibrate gaze directions using regression model and 3D eye model.
 
-        :param input_path: String path to the input file.
-        :param output_path: String path to the output file.
         :param user_id: Integer user ID.
-        :param param: List of float parameters for the rotation matrix.
-        :return: None
+        :param rot: Numpy array (3, 3) representing the rotation matrix of the 3D eye model.
+        :param ray: Numpy array (N, 3) representing the gaze directions.
+        :return: Tuple containing the gaze directions calibrated by the regression model and by both models.
         """
-        df = pd.read_csv(input_path)
-        df = df.iloc[:, 10:]
-        print(f"df.shape: {df.shape}")
-
-        # gaze direction
-        ray_x = df["ray_x"].values
-        ray_y = df["ray_y"].values
-        ray_z = df["ray_z"].values
-
         # gaze direction at z=1
-        xe = ray_x[:] / ray_z[:] * 1.0
-        ye = ray_y[:] / ray_z[:] * 1.0
+        xe = ray[:, 0] / ray[:, 2] * 1.0
+        ye = ray[:, 1] / ray[:, 2] * 1.0
 
         # calibrate gaze direction using regression model
         calib_xe, calib_ye = EvaluateGaze.calibrate_reg(self.param_base[user_id - 1], xe, ye)
@@ -42,18 +35,49 @@ class PrecalibrateGaze:
         base_dis = np.sqrt(calib_xe * calib_xe + calib_ye * calib_ye + ones * ones)
         base_ray = np.stack([calib_xe / base_dis, calib_ye / base_dis, ones / base_dis], axis=1)
 
-        # calibrate gaze direction using 3D eye model
-        param_3d = EvaluateGaze.get_rotation_inv(param).flatten()
-        calib_ray = EvaluateGaze.calibrate_3d(param_3d, base_ray)
-
-        # update dataframe
-        df = df.drop(["ray_x", "ray_y", "ray_z"], axis=1)
-        df.insert(len(df.columns), "ray_x", calib_ray[:, 0], True)
-        df.insert(len(df.columns), "ray_y", calib_ray[:, 1], True)
-        df.insert(len(df.columns), "ray_z", calib_ray[:, 2], True)
-        df.insert(len(df.columns), "base_x", base_ray[:, 0], True)
-        df.insert(len(df.columns), "base_y", base_ray[:, 1], True)
-        df.insert(len(df.columns), "base_z", base_ray[:, 2], True)
-
-        df.to_csv(output_path, index=False, encoding="utf_8_sig")
-        print(f"updated df.shape: {df.shape}")
+        # calibrate gaze direction using 3D eye model (EvaluateGaze.calibrate_3d for all rows at once)
+        calib_ray = np.matmul(rot, base_ray[:, :, np.newaxis])[:, :, 0]
+        return base_ray, calib_ray
+
+    @instrumentation.timed("PrecalibrateGaze.precalibrate_gaze")
+    def precalibrate_gaze(self, input_path: str, output_path: str,
+                          user_id: int, param: List[float], chunksize: Optional[int] = None) -> None:
+        """
+        Pre-calibrate gaze data using regression model and 3D eye model.
+
+        With chunksize, the input is streamed in chunks of rows and appended to the output, so that the memory
+        does not depend on the length of the recording.
+
+        :param input_path: String path to the input file.
+        :param output_path: String path to the output file.
+        :param user_id: Integer user ID.
+        :param param: List of float parameters for the rotation matrix.
+        :param chunksize: Integer number of rows processed at once (the whole file if None).
+        :return: None
+        """
+        rot = EvaluateGaze.get_rotation_inv(param)
+        rows = 0
+        columns = 0
+        with ColumnWriter(output_path) as writer:
+            for data in iter_columns(input_path, chunksize):
+                df = {name: data[name] for name in list(data)[10:]}
+                columns = len(df)
+
+                # gaze direction
+                ray = np.stack([df.pop("ray_x"), df.pop("ray_y"), df.pop("ray_z")], axis=1).astype(np.float64, copy=False)
+                base_ray, calib_ray = self.precalibrate_ray(user_id, rot, ray)
+
+                # update columns
+                df["ray_x"] = calib_ray[:, 0]
+                df["ray_y"] = calib_ray[:, 1]
+                df["ray_z"] = calib_ray[:, 2]
+                df["base_x"] = base_ray[:, 0]
+                df["base_y"] = base_ray[:, 1]
+                df["base_z"] = base_ray[:, 2]
+
+                # CSV with BOM, or gaze session file for the .gaze suffix
+                writer.append(df)
+                rows += ray.shape[0]
+        instrumentation.count("precalibrate_rows", rows)
+        print(f"df.shape: {(rows, columns)}")
+        print(f"updated df.shape: {(rows, columns + 3)}")
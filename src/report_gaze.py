@@ -0,0 +1,350 @@
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import matplotlib
+matplotlib.use("Agg")  # Headless rendering in the worker processes
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from batch_gaze import BatchGaze
+from evaluate_gaze import EvaluateGaze
+from fixation_cache import FixationCache
+from gaze_session import file_mode, read_columns
+from parity_gaze import ParityGaze
+
+# Report generator of the worker processes (set once in each worker process)
+_report = None
+
+
+def _init_worker(report: "ReportGaze"):
+    global _report
+    _report = report
+
+
+def _run_user(args: Tuple[int, bool]) -> dict:
+    user, force = args
+    return _report.run_user(user, force)
+
+
+class ReportGaze:
+    """
+    Analysis report of each user (notebooks/user_analysis/evaluate_userN.ipynb) over the evaluation data and scenes.
+
+    The report of a user holds the errors of the raw gaze directions, the visual axis (baseline_param.csv) and the
+    optical axis (param_opt) on the evaluation data, the fixations of each scene (FixationCache) and the absolute
+    error of the estimate of each method and scene (param/{method}/param_{scene}.csv), with their figures.
+    It is written to output_dir/user{N}: report.json (signature, metrics and figures), intermediate.npz (the gaze
+    positions on the calibration plane and the fixation durations) and the figures. The signature is the hash of the
+    contents of the inputs and of the parameters of the user: a user with the same signature is skipped, and its
+    missing figures are rendered again from intermediate.npz without recomputing.
+    """
+
+    version = 1  # Version of the reports (reports of other versions are computed again)
+    # Axis labels and limits of the calibration plane figures (as the notebooks)
+    label_xy = [-0.7 / 4, 0.0, 0.7 / 4]
+    offset_y = 0.071
+
+    def __init__(self, data_dir: str, output_dir: str, scenes: Tuple[str, ...] = ("office", "supermarket"),
+                 methods: Tuple[str, ...] = (), cache_dir: Optional[str] = None, eval_points: int = 9,
+                 param_opt: Tuple[float, float] = (-1.021, -3.306), detector: str = "ivt", dig_per_sec: float = 100,
+                 duration: float = 0.2, dispersion: float = 0.00015):
+        """
+        :param data_dir: Directory of the notebooks (data and param).
+        :param output_dir: Directory of the reports.
+        :param scenes: Scenes of the gaze data (data/{scene}_data).
+        :param methods: Methods of the estimated parameters (param/{method}/param_{scene}.csv).
+        :param cache_dir: Directory of the fixation cache (output_dir/fixation_cache if None).
+        :param eval_points: Integer number of markers of the evaluation data (9, 16 or 25).
+        :param param_opt: Parameters (alpha, beta) of the optical axis in degrees.
+        :param detector: Fixation detector (ivt, ivt_world, idt or ivdt).
+        :param dig_per_sec: Velocity threshold (degrees per second).
+        :param duration: Duration threshold (sec).
+        :param dispersion: Dispersion threshold of idt and ivdt.
+        """
+        self.data_dir = data_dir
+        self.output_dir = output_dir
+        self.scenes = tuple(scenes)
+        self.methods = tuple(methods)
+        self.cache = FixationCache(os.path.join(output_dir, "fixation_cache") if cache_dir is None else cache_dir)
+        self.eval_points = eval_points
+        self.param_opt = tuple(param_opt)
+        self.detector = detector
+        self.thresholds = {"dig_per_sec": dig_per_sec, "duration": duration, "dispersion_th": dispersion}
+
+        self.param_base = pd.read_csv(os.path.join(data_dir, "param", "baseline_param.csv"),
+                                      encoding="utf_8_sig").to_numpy(dtype=np.float64)
+        # Estimated parameters of each method and scene (row i belongs to the i-th user of ParityGaze.users)
+        self.param = {}
+        for method in self.methods:
+            for scene in self.scenes:
+                path = os.path.join(data_dir, "param", method, "param_%s.csv" % scene)
+                if os.path.exists(path):
+                    self.param[method, scene] = pd.read_csv(path)[["alpha", "beta"]].to_numpy(dtype=np.float64)
+
+    def inputs(self, user: int) -> Dict[str, str]:
+        """
+        Get the gaze data of a user.
+
+        :param user: Integer user.
+        :return: Dictionary of the existing paths keyed on "eval" and the scenes.
+        """
+        paths = {"eval": os.path.join(self.data_dir, "data", "eval_data",
+                                      "gaze_user%d_eval_%d.csv" % (user, self.eval_points))}
+        for scene in self.scenes:
+            paths[scene] = os.path.join(self.data_dir, "data", "%s_data" % scene, "gaze_user%d_%s.csv" % (user, scene))
+        return {name: path for name, path in paths.items() if os.path.exists(path)}
+
+    def estimates(self, user: int) -> Dict[str, List[float]]:
+        # Estimated parameters of the user keyed on "method/scene"
+        if user not in ParityGaze.users:
+            return {}
+        row = ParityGaze.users.index(user)
+        return {"%s/%s" % key: param[row].tolist() for key, param in self.param.items() if row < param.shape[0]}
+
+    def signature(self, user: int) -> str:
+        """
+        Get the signature of the report of a user (the contents of its inputs and its parameters).
+
+        :param user: Integer user.
+        :return: String SHA-256 hex digest.
+        """
+        desc = json.dumps({"version": self.version,
+                           "inputs": {name: self.cache.file_hash(path) for name, path in self.inputs(user).items()},
+                           "param_base": self.param_base[user - 1].tolist(), "param_opt": self.param_opt,
+                           "estimates": self.estimates(user), "detector": self.detector,
+                           "thresholds": self.thresholds}, sort_keys=True)
+        return hashlib.sha256(desc.encode()).hexdigest()
+
+    @staticmethod
+    def plane_positions(xe: np.ndarray, ye: np.ndarray, eye: Dict[str, np.ndarray]) -> np.ndarray:
+        # Gaze positions on the calibration plane at 1m away from the gaze directions at z=1 (HMD coordinates)
+        t = 1.0 - eye["eye_z"]
+        return np.stack([eye["eye_x"] + t * xe, eye["eye_y"] + t * ye], axis=1)
+
+    def evaluate(self, user: int) -> Tuple[dict, Dict[str, np.ndarray]]:
+        """
+        Calculate the metrics of a user.
+
+        :param user: Integer user.
+        :return: Tuple containing the metrics and the intermediate arrays of the figures.
+        """
+        inputs = self.inputs(user)
+        df = read_columns(inputs["eval"], ["ray_x", "ray_y", "ray_z", "u", "v", "eye_x", "eye_y", "eye_z"],
+                          dtype=np.float64)
+        eye = {name: df[name] for name in ("eye_x", "eye_y", "eye_z")}
+        p, q = df["u"], df["v"]
+
+        # Raw gaze directions at z=1 and their positions on the calibration plane
+        xe = df["ray_x"] / df["ray_z"]
+        ye = df["ray_y"] / df["ray_z"]
+        t = (1.0 - eye["eye_z"]) / df["ray_z"]
+        arrays = {"marker": np.stack([p, q], axis=1),
+                  "raw": np.stack([eye["eye_x"] + t * df["ray_x"], eye["eye_y"] + t * df["ray_y"]], axis=1)}
+        param_raw = np.array([0.0, 1.0, 0.0, 0.0, 0.0, 1.0])
+        metrics = {"user": user, "frames": int(xe.shape[0]),
+                   "raw_error": float(np.rad2deg(np.arctan(EvaluateGaze.err_rmse_reg(param_raw, xe, ye, eye["eye_x"],
+                                                                                    eye["eye_y"], eye["eye_z"], p, q))))}
+
+        # Visual axis (regression model of the user)
+        param_base = self.param_base[user - 1]
+        calib_xe, calib_ye = EvaluateGaze.calibrate_reg(param_base, xe, ye)
+        arrays["vis"] = self.plane_positions(calib_xe, calib_ye, eye)
+        metrics["vis_error"] = float(np.rad2deg(np.arctan(EvaluateGaze.err_rmse_reg(
+            param_base, xe, ye, eye["eye_x"], eye["eye_y"], eye["eye_z"], p, q))))
+
+        # Optical axis and the estimates of the methods (3D eye model on the visual axis)
+        r = np.sqrt(calib_xe * calib_xe + calib_ye * calib_ye + 1)
+        ray = np.stack([calib_xe / r, calib_ye / r, 1 / r], axis=1)
+        for name, alpha_beta in [("opt", self.param_opt)] + list(self.estimates(user).items()):
+            param = EvaluateGaze.get_rotation(alpha_beta).flatten()
+            calib_ray = EvaluateGaze.calibrate_3d(param, ray)
+            arrays[name] = self.plane_positions(calib_ray[:, 0] / calib_ray[:, 2], calib_ray[:, 1] / calib_ray[:, 2],
+                                                eye)
+            rmse = EvaluateGaze.err_rmse_3d(param, ray, eye["eye_x"], eye["eye_y"], eye["eye_z"], p, q)
+            metrics[name + "_error"] = float(np.rad2deg(np.arctan(rmse)))
+
+        # Fixations of the scenes
+        for scene in self.scenes:
+            if scene not in inputs:
+                continue
+            entry = self.cache.get(inputs[scene], self.detector, **self.thresholds)
+            durations = (entry["window"][:, 1] - entry["window"][:, 0]) / float(entry["fs"])
+            arrays[scene + "_durations"] = durations
+            metrics[scene + "_fixations"] = int(durations.shape[0])
+            metrics[scene + "_duration"] = float(durations.mean()) if durations.shape[0] > 0 else float("nan")
+        return metrics, arrays
+
+    def plot_plane(self, path: str, arrays: Dict[str, np.ndarray], series: List[Tuple[str, str, str]]):
+        # Gaze positions on the calibration plane (the figures of the notebooks)
+        fig = plt.figure(figsize=(8, 8))
+        fig.patch.set_facecolor("white")
+        for name, color, label in series:
+            plt.scatter(arrays[name][:, 0], arrays[name][:, 1], c=color, label=label)
+        plt.xlabel("x [m]", size=24)
+        plt.ylabel("y [m]", size=24)
+        plt.xlim(-0.4, 0.4)
+        plt.ylim(-0.4 - self.offset_y, 0.4 - self.offset_y)
+        plt.xticks([-0.175, 0.0, 0.175], self.label_xy, fontsize=14)
+        plt.yticks([-0.175 - self.offset_y, -self.offset_y, 0.175 - self.offset_y], self.label_xy, fontsize=14)
+        plt.grid(which="major", axis="both", linestyle="--")
+        plt.tick_params(length=8)
+        plt.legend(fontsize=18, loc="upper right")
+        plt.subplots_adjust(left=0.15, right=0.95, bottom=0.1, top=0.9)
+        fig.savefig(path)
+        plt.close(fig)
+
+    def plot_durations(self, path: str, durations: np.ndarray, scene: str):
+        # Histogram of the fixation durations of a scene
+        fig = plt.figure(figsize=(8, 6))
+        fig.patch.set_facecolor("white")
+        plt.hist(durations, bins=np.arange(0.0, max(durations.max(initial=0.0), 1.0) + 0.1, 0.1), color="gray")
+        plt.xlabel("duration [s]", size=24)
+        plt.ylabel("fixations", size=24)
+        plt.title(scene, size=24)
+        plt.tick_params(length=8, labelsize=14)
+        plt.subplots_adjust(left=0.15, right=0.95, bottom=0.15, top=0.9)
+        fig.savefig(path)
+        plt.close(fig)
+
+    def figures(self, arrays: Dict[str, np.ndarray]) -> List[str]:
+        # File names of the figures of a report
+        names = ["eval_vis.png", "eval_opt.png"]
+        names += ["eval_%s.png" % key.replace("/", "_") for key in arrays if "/" in key]
+        names += ["%s_durations.png" % key[:-len("_durations")] for key in arrays if key.endswith("_durations")]
+        return names
+
+    def render(self, user_dir: str, arrays: Dict[str, np.ndarray]) -> List[str]:
+        """
+        Render the figures of a report.
+
+        :param user_dir: Directory of the report.
+        :param arrays: Dictionary of the intermediate arrays.
+        :return: List of the file names of the figures.
+        """
+        plt.rcParams["font.family"] = "serif"
+        plt.rcParams["font.serif"] = ["Times New Roman"] + plt.rcParams["font.serif"]
+        plt.rcParams["mathtext.fontset"] = "stix"
+        figures = self.figures(arrays)
+        marker = ("marker", "black", "marker")
+        self.plot_plane(os.path.join(user_dir, figures[0]), arrays,
+                        [("vis", "green", "visual axis"), ("raw", "gray", "raw data"), marker])
+        self.plot_plane(os.path.join(user_dir, figures[1]), arrays,
+                        [("vis", "green", "visual axis"), ("opt", "lightgreen", "optical axis"), marker])
+        for key in arrays:
+            if "/" in key:
+                self.plot_plane(os.path.join(user_dir, "eval_%s.png" % key.replace("/", "_")), arrays,
+                                [("vis", "green", "visual axis"), (key, "orange", key), marker])
+            elif key.endswith("_durations"):
+                scene = key[:-len("_durations")]
+                self.plot_durations(os.path.join(user_dir, "%s_durations.png" % scene), arrays[key], scene)
+        return figures
+
+    @staticmethod
+    def write_atomic(path: str, write):
+        # Write a file by write(f) and move it into place
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.chmod(tmp, file_mode())
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def run_user(self, user: int, force: bool = False) -> dict:
+        """
+        Write the report of a user unless its signature and figures are unchanged.
+
+        :param user: Integer user.
+        :param force: Whether to compute the report even if it is unchanged.
+        :return: Dictionary of the status ("missing", "skipped", "rendered" or "computed"), the elapsed time and the
+            metrics of the user.
+        """
+        start = time.perf_counter()
+        if "eval" not in self.inputs(user):
+            return {"user": user, "status": "missing", "seconds": time.perf_counter() - start}
+        user_dir = os.path.join(self.output_dir, "user%d" % user)
+        os.makedirs(user_dir, exist_ok=True)
+        state_path = os.path.join(user_dir, "report.json")
+        arrays_path = os.path.join(user_dir, "intermediate.npz")
+        signature = self.signature(user)
+
+        state = None
+        if not force and os.path.exists(state_path) and os.path.exists(arrays_path):
+            with open(state_path, encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("signature") != signature:
+                state = None
+        if state is not None:
+            if all(os.path.exists(os.path.join(user_dir, name)) for name in state["figures"]):
+                status = "skipped"
+            else:
+                with np.load(arrays_path) as npz:
+                    self.render(user_dir, {name: npz[name] for name in npz.files})
+                status = "rendered"
+        else:
+            metrics, arrays = self.evaluate(user)
+            self.write_atomic(arrays_path, lambda f: np.savez(f, **arrays))
+            state = {"signature": signature, "metrics": metrics, "figures": self.render(user_dir, arrays)}
+            self.write_atomic(state_path, lambda f: f.write(json.dumps(state, indent=2).encode()))
+            status = "computed"
+        return dict({"status": status, "seconds": time.perf_counter() - start}, **state["metrics"])
+
+    def run(self, users: List[int], workers: int = 1, force: bool = False) -> pd.DataFrame:
+        """
+        Write the reports of the users over a process pool and their summary (output_dir/summary.csv).
+
+        :param users: List of the users.
+        :param workers: Integer number of processes.
+        :param force: Whether to compute every report again.
+        :return: DataFrame of the status, the elapsed time and the metrics of each user.
+        """
+        tasks = [(user, force) for user in users]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,)) as executor:
+                rows = list(executor.map(_run_user, tasks))
+        else:
+            _init_worker(self)
+            rows = [_run_user(task) for task in tasks]
+        summary = pd.DataFrame(rows)
+        BatchGaze.write_csv(os.path.join(self.output_dir, "summary.csv"), summary)
+        return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the analysis report of each user.")
+    parser.add_argument("data_dir", help="Directory of the notebooks (data and param)")
+    parser.add_argument("output_dir", help="Directory of the reports")
+    parser.add_argument("--users", type=int, nargs="+", default=list(range(1, 23)), help="Users")
+    parser.add_argument("--scenes", nargs="+", default=["office", "supermarket"], help="Scenes of the gaze data")
+    parser.add_argument("--methods", nargs="+", default=[], help="Methods of param/{method}/param_{scene}.csv")
+    parser.add_argument("--cache-dir", help="Directory of the fixation cache")
+    parser.add_argument("--eval-points", type=int, default=9, choices=[9, 16, 25], help="Markers of the evaluation")
+    parser.add_argument("--param-opt", type=float, nargs=2, default=[-1.021, -3.306], help="Optical axis parameters")
+    parser.add_argument("--detector", default="ivt", choices=list(FixationCache.detectors), help="Fixation detector")
+    parser.add_argument("--dig-per-sec", type=float, default=100, help="Velocity threshold (degrees per second)")
+    parser.add_argument("--duration", type=float, default=0.2, help="Duration threshold (sec)")
+    parser.add_argument("--dispersion", type=float, default=0.00015, help="Dispersion threshold of idt and ivdt")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes")
+    parser.add_argument("--force", action="store_true", help="Compute every report again")
+    args = parser.parse_args()
+
+    report = ReportGaze(args.data_dir, args.output_dir, tuple(args.scenes), tuple(args.methods), args.cache_dir,
+                        args.eval_points, tuple(args.param_opt), args.detector, args.dig_per_sec, args.duration,
+                        args.dispersion)
+    start = time.perf_counter()
+    summary = report.run(args.users, args.workers, args.force)
+    print(summary.to_string(index=False, float_format="%.3f"))
+    counts = summary["status"].value_counts()
+    print(f"{len(summary)} users in {time.perf_counter() - start:.2f} s "
+          + ", ".join(f"{count} {status}" for status, count in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+from typing import Optional, Tuple
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class TriangleMesh:
+    """
+    Triangle mesh of the scene exported once from Unity, with a bounding volume hierarchy (BVH) for ray queries.
+
+    It replaces Physics.Raycast against the MeshColliders of the scene.
+    """
+
+    def __init__(self, vertices: np.ndarray, faces: np.ndarray, leaf_size: int = 8, two_sided: bool = True):
+        """
+        :param vertices: Numpy array (V, 3) representing the vertex positions in world coordinate.
+        :param faces: Numpy array (F, 3) representing the vertex indices of the triangles.
+        :param leaf_size: Maximum number of triangles in a leaf of the BVH.
+        :param two_sided: Whether rays hit the back faces of the triangles.
+        """
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        self.faces = np.asarray(faces, dtype=np.int64)
+        self.leaf_size = leaf_size
+        self.two_sided = two_sided
+
+        # Triangle corners and edges
+        self.v0 = self.vertices[self.faces[:, 0]]
+        self.e1 = self.vertices[self.faces[:, 1]] - self.v0
+        self.e2 = self.vertices[self.faces[:, 2]] - self.v0
+
+        # BVH nodes (children are -1 for leaves)
+        self.node_min = None
+        self.node_max = None
+        self.node_left = None
+        self.node_right = None
+        self.node_start = None  # First triangle of a leaf in tri_index
+        self.node_count = None  # Number of triangles of a leaf
+        self.tri_index = None  # Triangle indices ordered by leaf
+        self.build()
+
+    @staticmethod
+    def from_obj(path: str, **kwargs) -> "TriangleMesh":
+        """
+        Load a mesh from a Wavefront OBJ file. Polygons are triangulated as fans.
+
+        :param path: String path to the OBJ file.
+        :return: TriangleMesh of the file.
+        """
+        vertices = []
+        faces = []
+        with open(path) as f:
+            for line in f:
+                items = line.split()
+                if not items:
+                    continue
+                if items[0] == "v":
+                    vertices.append([float(v) for v in items[1:4]])
+                elif items[0] == "f":
+                    index = [int(item.split("/")[0]) for item in items[1:]]
+                    # OBJ indices are 1-based and negative indices count from the end
+                    index = [i - 1 if i > 0 else len(vertices) + i for i in index]
+                    for k in range(1, len(index) - 1):
+                        faces.append([index[0], index[k], index[k + 1]])
+        return TriangleMesh(np.array(vertices).reshape(-1, 3), np.array(faces, dtype=np.int64).reshape(-1, 3), **kwargs)
+
+    @staticmethod
+    def load(path: str, **kwargs) -> "TriangleMesh":
+        """
+        Load a mesh saved by TriangleMesh.save.
+
+        :param path: String path to the npz file.
+        :return: TriangleMesh of the file.
+        """
+        with np.load(path) as data:
+            return TriangleMesh(data["vertices"], data["faces"], **kwargs)
+
+    def save(self, path: str) -> None:
+        """
+        Save the mesh as a npz file.
+
+        :param path: String path to the npz file.
+        :return: None
+        """
+        np.savez(path, vertices=self.vertices, faces=self.faces)
+
+    def build(self) -> None:
+        """
+        Build the BVH by splitting the triangles at the median of their centroids along the longest axis.
+
+        :return: None
+        """
+        corners = self.vertices[self.faces]
+        tri_min = corners.min(axis=1)
+        tri_max = corners.max(axis=1)
+        centroid = corners.mean(axis=1)
+
+        node_min, node_max, node_left, node_right, node_start, node_count = [], [], [], [], [], []
+        tri_index = np.arange(self.faces.shape[0])
+        stack = [(0, tri_index.shape[0], -1, False)]  # (start, stop, parent, right child)
+        while stack:
+            start, stop, parent, right = stack.pop()
+            node = len(node_min)
+            if parent >= 0:
+                (node_right if right else node_left)[parent] = node
+            index = tri_index[start:stop]
+            node_min.append(tri_min[index].min(axis=0))
+            node_max.append(tri_max[index].max(axis=0))
+            node_left.append(-1)
+            node_right.append(-1)
+            node_start.append(start)
+            node_count.append(stop - start)
+            if stop - start <= self.leaf_size:
+                continue
+
+            # Median split along the longest axis of the centroids
+            axis = np.argmax(centroid[index].max(axis=0) - centroid[index].min(axis=0))
+            half = (stop - start) // 2
+            order = np.argpartition(centroid[index, axis], half)
+            tri_index[start:stop] = index[order]
+            node_count[node] = 0
+            stack.append((start + half, stop, node, True))
+            stack.append((start, start + half, node, False))
+
+        self.node_min = np.array(node_min).reshape(-1, 3)
+        self.node_max = np.array(node_max).reshape(-1, 3)
+        self.node_left = np.array(node_left, dtype=np.int64)
+        self.node_right = np.array(node_right, dtype=np.int64)
+        self.node_start = np.array(node_start, dtype=np.int64)
+        self.node_count = np.array(node_count, dtype=np.int64)
+        self.tri_index = tri_index
+
+    def intersect(self, origin: np.ndarray, direction: np.ndarray, tri: np.ndarray) -> np.ndarray:
+        """
+        Intersect rays with triangles (Moller-Trumbore).
+
+        :param origin: Numpy array (K, 3) representing the ray origins.
+        :param direction: Numpy array (K, 3) representing the ray directions.
+        :param tri: Numpy array (K,) representing the triangle indices.
+        :return: Numpy array (K,) representing the ray parameters of the hits (inf for misses).
+        """
+        e1 = self.e1[tri]
+        e2 = self.e2[tri]
+        p = np.cross(direction, e2)
+        det = np.einsum("ij,ij->i", e1, p)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            inv_det = 1.0 / det
+            s = origin - self.v0[tri]
+            u = np.einsum("ij,ij->i", s, p) * inv_det
+            q = np.cross(s, e1)
+            v = np.einsum("ij,ij->i", direction, q) * inv_det
+            t = np.einsum("ij,ij->i", e2, q) * inv_det
+        front = np.abs(det) > 1e-12 if self.two_sided else det > 1e-12
+        hit = front & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t >= 0.0)
+        return np.where(hit, t, np.inf)
+
+    def raycast(self, origin: np.ndarray, direction: np.ndarray, frame: Optional[np.ndarray] = None,
+                max_distance: float = 100.0, return_index: bool = False):
+        """
+        Cast rays against the mesh (Physics.Raycast).
+
+        The BVH is traversed breadth-first for all rays at once, so every step is one array operation
+        over the active (ray, node) pairs.
+
+        :param origin: Numpy array (N, 3) representing the ray origins in world coordinate.
+        :param direction: Numpy array (N, 3) representing the ray directions in world coordinate.
+        :param frame: Unused, for the same signature as HitPointProxy.raycast.
+        :param max_distance: Maximum distance of the hits.
+        :param return_index: Whether to return the indices of the hit triangles (-1 for misses).
+        :return: Numpy array (N, 3) representing the hit points (nan for misses).
+        """
+        origin = np.asarray(origin, dtype=np.float64)
+        direction = np.asarray(direction, dtype=np.float64)
+        n = origin.shape[0]
+        direction = direction / np.sqrt(np.einsum("ij,ij->i", direction, direction))[:, np.newaxis]
+        with np.errstate(divide="ignore"):
+            inv_direction = 1.0 / direction
+
+        best_t = np.full(n, max_distance)
+        best_tri = np.full(n, -1, dtype=np.int64)
+        ray = np.flatnonzero(~np.isnan(direction).any(axis=1) & ~np.isnan(origin).any(axis=1))
+        node = np.zeros(ray.shape[0], dtype=np.int64)
+        while ray.shape[0] > 0 and self.faces.shape[0] > 0:
+            # Slab test of the node boxes
+            with np.errstate(invalid="ignore"):
+                t0 = (self.node_min[node] - origin[ray]) * inv_direction[ray]
+                t1 = (self.node_max[node] - origin[ray]) * inv_direction[ray]
+            t_near = np.nanmax(np.minimum(t0, t1), axis=1)
+            t_far = np.nanmin(np.maximum(t0, t1), axis=1)
+            hit = (t_far >= np.maximum(t_near, 0.0)) & (t_near <= best_t[ray])
+            ray = ray[hit]
+            node = node[hit]
+
+            # Intersect the triangles of the leaves
+            leaf = self.node_left[node] < 0
+            leaf_ray = ray[leaf]
+            leaf_node = node[leaf]
+            count = self.node_count[leaf_node]
+            if leaf_ray.shape[0] > 0:
+                pair_ray = np.repeat(leaf_ray, count)
+                offset = np.arange(pair_ray.shape[0]) - np.repeat(np.cumsum(count) - count, count)
+                pair_tri = self.tri_index[np.repeat(self.node_start[leaf_node], count) + offset]
+                t = self.intersect(origin[pair_ray], direction[pair_ray], pair_tri)
+
+                # Keep the nearest hit of each ray
+                order = np.lexsort((t, pair_ray))
+                first = np.ones(order.shape[0], dtype=bool)
+                first[1:] = pair_ray[order][1:] != pair_ray[order][:-1]
+                nearest = order[first]
+                closer = t[nearest] < best_t[pair_ray[nearest]]
+                best_t[pair_ray[nearest[closer]]] = t[nearest[closer]]
+                best_tri[pair_ray[nearest[closer]]] = pair_tri[nearest[closer]]
+
+            # Descend to the children of the inner nodes
+            inner_ray = ray[~leaf]
+            inner_node = node[~leaf]
+            ray = np.concatenate([inner_ray, inner_ray])
+            node = np.concatenate([self.node_left[inner_node], self.node_right[inner_node]])
+
+        point = origin + best_t[:, np.newaxis] * direction
+        point[best_tri < 0] = np.nan
+        if return_index:
+            return point, best_tri
+        return point
+
+    def plane(self, index: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the planes hit by raycast.
+
+        :param index: Numpy array representing the triangles returned by raycast.
+        :return: Tuple containing a point on each plane and its unit normal.
+        """
+        normal = np.cross(self.e1[index], self.e2[index])
+        return self.v0[index], normal / np.linalg.norm(normal, axis=-1, keepdims=True)
+
+
+class HitPointProxy:
+    """
+    Depth proxy of the scene built from the recorded points of regard (xc, yc, zc).
+
+    Around each frame the scene is approximated by the plane through the recorded hit point, with the normal
+    estimated from the neighbouring hit points of the session. Calibrated rays are a few degrees apart from the
+    recorded ones, so the plane is a close local approximation of the surface that was hit.
+    """
+
+    def __init__(self, por: np.ndarray, ray_world: Optional[np.ndarray] = None, k: int = 16,
+                 planarity: float = 1e-3):
+        """
+        :param por: Numpy array (N, 3) representing the recorded points of regard (nan when not recorded).
+        :param ray_world: Numpy array (N, 3) representing the recorded gaze directions in world coordinate.
+                          The plane faces the gaze direction where the neighbourhood is not planar.
+        :param k: Number of neighbouring hit points used to estimate the normal.
+        :param planarity: Minimum ratio of the second to the first eigenvalue of the neighbourhood covariance.
+        """
+        self.por = np.asarray(por, dtype=np.float64)
+        self.normal = np.full_like(self.por, np.nan)
+
+        valid = np.flatnonzero(~np.isnan(self.por).any(axis=1))
+        points = self.por[valid]
+        k = min(k, points.shape[0])
+        if k >= 3:
+            # Normal of the plane fitted to the neighbouring hit points
+            _, neighbor = cKDTree(points).query(points, k=k)
+            local = points[neighbor] - points[neighbor].mean(axis=1, keepdims=True)
+            eigval, eigvec = np.linalg.eigh(np.einsum("nki,nkj->nij", local, local))
+            self.normal[valid] = eigvec[:, :, 0]
+            degenerate = eigval[:, 1] < planarity * eigval[:, 2]
+        else:
+            degenerate = np.ones(valid.shape[0], dtype=bool)
+
+        # Fronto-parallel plane where the neighbourhood is degenerate (e.g. a single gaze trace)
+        if ray_world is not None:
+            self.normal[valid[degenerate]] = ray_world[valid[degenerate]]
+        else:
+            self.normal[valid[degenerate]] = np.nan
+        self.normal /= np.linalg.norm(self.normal, axis=1, keepdims=True)
+
+    def raycast(self, origin: np.ndarray, direction: np.ndarray, frame: Optional[np.ndarray] = None,
+                max_distance: float = 100.0, return_index: bool = False):
+        """
+        Cast rays against the local planes of their frames.
+
+        :param origin: Numpy array (N, 3) representing the ray origins in world coordinate.
+        :param direction: Numpy array (N, 3) representing the ray directions in world coordinate.
+        :param frame: Numpy array (N,) representing the frame of each ray.
+        :param max_distance: Maximum distance of the hits.
+        :param return_index: Whether to return the frames of the hit planes (-1 for misses).
+        :return: Numpy array (N, 3) representing the hit points (nan for misses).
+        """
+        if frame is None:
+            raise ValueError("HitPointProxy.raycast requires the frame of each ray")
+        frame = np.asarray(frame, dtype=np.int64)
+        direction = direction / np.sqrt(np.einsum("ij,ij->i", direction, direction))[:, np.newaxis]
+        normal = self.normal[frame]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.einsum("ij,ij->i", self.por[frame] - origin, normal) / np.einsum("ij,ij->i", direction, normal)
+            hit = (t >= 0.0) & (t <= max_distance)
+        point = origin + t[:, np.newaxis] * direction
+        point[~hit] = np.nan
+        if return_index:
+            return point, np.where(hit, frame, -1)
+        return point
+
+    def plane(self, index: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the planes hit by raycast.
+
+        :param index: Numpy array representing the frames returned by raycast.
+        :return: Tuple containing a point on each plane and its unit normal.
+        """
+        return self.por[index], self.normal[index]
@@ -0,0 +1,511 @@
+import argparse
+import os
+from time import perf_counter
+from typing import Dict, Generator, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+import instrumentation
+from extract_fixation import ExtractFixation
+
+
+class SweepFixation:
+    """
+    Fixation detection (ExtractFixation) over a grid of (velocity, dispersion, duration) thresholds sharing the work
+    between the thresholds.
+
+    The angular velocities of the frames are computed once per session. For I-VT the velocity thresholds are sorted
+    and the level of each frame pair is the first threshold it is below: the runs of a threshold are those of the
+    previous one merged over the pairs of its level, and every duration threshold only filters the runs.
+    For I-DT and I-VDT the state machines of get_fixation_by_idt / get_fixation_by_ivdt are followed for each
+    threshold set, but the windows they visit do not depend on the dispersion threshold, which only decides where a
+    slide or an expansion ends:
+    - the dispersions of the windows of duration consecutive frames (the initial windows and the slides over frames
+      below the velocity threshold) are computed once per duration threshold,
+    - the other windows of a slide or an expansion are kept as a profile of the phase, which every threshold set
+      searches for the end of the phase,
+    - the threshold sets of a velocity threshold advance together, and the profiles they miss in a round are
+      calculated at once.
+    The window of I-VDT is always its first frame and the frames below the velocity threshold up to the current frame,
+    so the window of an expansion only depends on its first frame and the frame added.
+    """
+
+    detectors = ["ivt", "ivt_world", "idt", "ivdt"]
+
+    def __init__(self, fix: ExtractFixation, por: Optional[np.ndarray] = None, chunk: int = 8,
+                 cells: int = 1 << 18):
+        """
+        :param fix: ExtractFixation holding the formatted gaze data.
+        :param por: Numpy array (N, 3) representing the points of regard of I-DT and I-VDT (fix.PoR if None).
+        :param chunk: Integer number of windows of the first profile chunk of a phase (doubled as needed).
+        :param cells: Integer number of frames of the windows whose dispersions are calculated at once.
+        """
+        self.fix = fix
+        self.por = por
+        self.chunk = chunk
+        self.cells = cells
+        self.n = fix.ray.shape[0]
+        # Angle between the gaze directions of consecutive frames (degrees per frame, nan with eyes closed)
+        self.angles = {"ivt": fix.calculate_angles(fix.ray)}
+        self.velocity = np.concatenate([[0.0], self.angles["ivt"]])
+        self.dispersion = None  # Arrays of the dispersion-based detectors (prepared on first use)
+        self.next_valid = None  # First valid frame from each frame
+        self.full = {}  # Dispersions of the full windows of each duration threshold
+        self.passed = None  # Frames below the current velocity threshold (all frames for I-DT)
+        self.frames_below = None
+        self.stops = None  # First frame invalid or above the current velocity threshold from each frame
+        self.profiles = {}  # Dispersions of the phases of the current velocity threshold
+        self.evaluations = 0  # Number of window dispersions calculated
+        self.rounds = 0  # Number of rounds of the threshold sets
+
+    def frames(self, seconds: float) -> int:
+        # Duration threshold in frames (ExtractFixation.calculate_th)
+        return int(np.ceil(self.fix.fs * seconds))
+
+    def velocity_windows(self, detector: str, dig_per_sec: List[float],
+                         durations: List[float]) -> Dict[Tuple[float, float], np.ndarray]:
+        """
+        Detect the fixations by I-VT (or I-VT in world coordinate) for every velocity and duration threshold.
+
+        :param detector: "ivt" or "ivt_world".
+        :param dig_per_sec: List of the velocity thresholds (degrees per second).
+        :param durations: List of the duration thresholds (sec).
+        :return: Dictionary of the windows (M, 2) keyed on (velocity, duration).
+        """
+        if detector not in self.angles:
+            ray_world = np.matmul(self.fix.CamToWorldMat, self.fix.ray[:, :, np.newaxis])[:, :, 0]
+            self.angles[detector] = self.fix.calculate_angles(ray_world)
+        angles = self.angles[detector]
+        m = angles.shape[0]
+
+        # Level of each frame pair: index of the first sorted threshold above its angle (never below if nan)
+        thresholds = sorted(set(dig_per_sec))
+        dig_per_frame = np.array(thresholds) / self.fix.fs
+        level = np.searchsorted(dig_per_frame, angles, side="right")
+        level[np.isnan(angles)] = len(thresholds)
+
+        # Pairs that are not below the threshold end the runs (with the ends of the data as sentinels)
+        boundary = np.concatenate([[-1], np.flatnonzero(level > 0), [m]])
+        windows = {}
+        for index, velocity in enumerate(thresholds):
+            # Runs of the previous threshold merge over the pairs of this level
+            inner = boundary[1:-1]
+            boundary = np.concatenate([[-1], inner[level[inner] > index], [m]])
+            start = boundary[:-1] + 1
+            stop = boundary[1:]
+            run = stop > start
+            start, stop = start[run], stop[run]
+            closed = stop < m  # A run reaching the end of the data is not closed
+            for duration in durations:
+                keep = closed & (stop - start >= self.frames(duration))
+                windows[velocity, duration] = np.stack([start[keep], stop[keep]], axis=1).astype(np.float64)
+        return windows
+
+    def prepare_dispersion(self):
+        # Gaze directions in world coordinate, points of regard and valid frames (ExtractFixation.prepare_dispersion)
+        window, valid = self.fix.prepare_dispersion(self.por)
+        # Coordinates first, so the frames of the windows are gathered per coordinate
+        self.dispersion = {"direction": np.ascontiguousarray(window.ray_world.T),
+                           "point": np.ascontiguousarray(window.por.T), "rot": window.rot,
+                           "position": np.ascontiguousarray(window.pos.T),
+                           "valid": np.concatenate([valid, [False]])}  # Frame n is the end of the data
+        self.next_valid = self.next_frames(np.concatenate([valid, [True]]))
+
+    @staticmethod
+    def next_frames(flag: np.ndarray) -> List[int]:
+        # First flagged frame from each frame (the length of flag if none)
+        index = np.where(flag, np.arange(flag.shape[0]), flag.shape[0])
+        return np.minimum.accumulate(index[::-1])[::-1].tolist()
+
+    def window_dispersions(self, index: np.ndarray, size: np.ndarray) -> np.ndarray:
+        """
+        Calculate the dispersions of windows (OptimizeUtil.CalculateDispersion).
+
+        :param index: Numpy array (J, L) representing the frames of each window (padded after its size).
+        :param size: Numpy array (J,) representing the number of frames of each window.
+        :return: Numpy array (J,) representing the dispersions.
+        """
+        data = self.dispersion
+        self.evaluations += index.shape[0]
+        mask = np.arange(index.shape[1]) < size[:, np.newaxis]
+
+        # Representative camera: the gaze direction closest to the mean (the first one on ties)
+        direction = data["direction"][:, index] * mask
+        direction -= (direction.sum(axis=2) / size)[:, :, np.newaxis]
+        dis = np.where(mask, np.einsum("ijl,ijl->jl", direction, direction), np.inf)
+        center = index[np.arange(index.shape[0]), np.argmin(dis, axis=1)]
+
+        # Maximum squared distance of the reprojected points of regard from their mean
+        point = data["point"][:, index] - data["position"][:, center][:, :, np.newaxis]
+        rot = data["rot"][center][:, :, :, np.newaxis]
+        ray_eye = [rot[:, m, 0] * point[0] + rot[:, m, 1] * point[1] + rot[:, m, 2] * point[2] for m in range(3)]
+        gaze = np.stack([ray_eye[0] / ray_eye[2], ray_eye[1] / ray_eye[2]]) * mask
+        gaze -= (gaze.sum(axis=2) / size)[:, :, np.newaxis]
+        return np.where(mask, np.einsum("ijl,ijl->jl", gaze, gaze), -np.inf).max(axis=1)
+
+    def evaluate(self, groups: List[Tuple[np.ndarray, np.ndarray, np.ndarray]]) -> List[np.ndarray]:
+        """
+        Calculate the dispersions of windows over sequences of frames in batches of similar sizes.
+
+        :param groups: List of tuples containing a sequence of frames and the positions of the first frame and after
+            the last frame of each window in the sequence.
+        :return: List of numpy arrays representing the dispersions of the windows of each group.
+        """
+        sequence = np.concatenate([group[0] for group in groups])
+        offset = np.cumsum([0] + [group[0].shape[0] for group in groups[:-1]])
+        head = np.concatenate([group[1] + lo for group, lo in zip(groups, offset)]).astype(np.int64)
+        size = np.concatenate([group[2] - group[1] for group in groups]).astype(np.int64)
+
+        order = np.argsort(size, kind="stable")
+        value = np.empty(size.shape[0])
+        lo = 0
+        while lo < order.shape[0]:
+            # Windows padded to the size of the last one of the batch
+            rest = size[order[lo:]]
+            count = max(int(np.searchsorted(np.arange(1, rest.shape[0] + 1) * rest, self.cells, side="right")), 1)
+            rows = order[lo:lo + count]
+            index = sequence[np.minimum(head[rows, np.newaxis] + np.arange(rest[count - 1]), sequence.shape[0] - 1)]
+            value[rows] = self.window_dispersions(index, size[rows])
+            lo += count
+        return np.split(value, np.cumsum([group[1].shape[0] for group in groups[:-1]]))
+
+    def full_dispersions(self, duration: int) -> np.ndarray:
+        """
+        Calculate the dispersion of every window of duration consecutive valid frames, which are the initial windows
+        and the windows of the slides over frames below the velocity threshold of every threshold set.
+
+        :param duration: Duration threshold (frames).
+        :return: Numpy array (N,) representing the dispersion of the window starting at each frame (inf if invalid).
+        """
+        if duration not in self.full:
+            count = np.concatenate([[0], np.cumsum(self.dispersion["valid"][:self.n])])
+            start = np.flatnonzero(count[duration:] - count[:-duration] == duration)
+            value = np.full(self.n, np.inf)
+            value[start] = self.evaluate([(np.arange(self.n), start, start + duration)])[0]
+            self.full[duration] = value
+        return self.full[duration]
+
+    def set_velocity(self, dig_per_frame: Optional[float]):
+        # Frames below the velocity threshold (all frames for I-DT) and the phases depending on them
+        if dig_per_frame is None:
+            self.passed = np.ones(self.n, dtype=bool)
+        else:
+            self.passed = self.velocity < dig_per_frame
+        self.frames_below = np.flatnonzero(self.passed)
+        self.stops = self.next_frames(~(self.dispersion["valid"] & np.concatenate([self.passed, [False]])))
+        self.profiles = {}
+
+    def window_frames(self, first: int, current: int) -> np.ndarray:
+        # Frames of the window of a first frame up to the current frame
+        frames = self.frames_below
+        return np.concatenate([[first], frames[np.searchsorted(frames, first, side="right"):
+                                               np.searchsorted(frames, current)]]).astype(np.int64)
+
+    def init_window(self, i: int, duration: int) -> Optional[int]:
+        # First frame of the initial window from frame i (None if the data ends before it is complete)
+        while True:
+            i = self.next_valid[i]
+            if i + duration > self.n:
+                return None
+            # Frames after the first one must be valid and below the velocity threshold
+            stop = self.stops[i + 1]
+            if stop >= i + duration:
+                return i
+            i = stop + 1
+
+    def slide(self, first: int, current: int, duration: int, below: List[int], th: float) -> Generator:
+        """
+        Slide a window of duration consecutive frames until its dispersion is not above the threshold.
+
+        :return: Tuple containing the number of steps, the first frame and the current frame after the slide, and
+            whether the dispersion is still above the threshold (the slide reached an invalid frame or the end).
+        """
+        # While the added frames are valid and below the velocity threshold the windows are full windows
+        stop = self.stops[current]
+        if below[first + 1] + duration <= stop:
+            return below[first + 1] - first, below[first + 1], below[first + 1] + duration, False
+        steps = stop - current
+        if not self.dispersion["valid"][stop]:
+            return steps + 1, None, stop, True
+
+        # A frame above the velocity threshold (I-VDT) is not added, so the following windows are not full windows
+        first, current = first + steps, stop
+        length = self.chunk
+        while True:
+            profile = self.profiles.get(("slide", first, current))
+            if profile is None or (profile["size"] < length and not profile["end"]):
+                yield "slide", first, current, length
+                continue
+            passed = profile["value"] <= th
+            if passed.any():
+                step = int(np.argmax(passed))
+                return steps + step + 1, int(profile["first"][step]), int(profile["checked"][step]) + 1, False
+            if profile["end"]:
+                return steps + profile["size"] + 1, None, current + profile["size"], True
+            length = 2 * profile["size"]
+
+    def slide_phase(self, first: int, current: int, steps: int) -> Tuple[dict, tuple]:
+        # Steps of the slide from a window lacking frames above the velocity threshold: the first frame is removed and
+        # the current frame is added if it is below the velocity threshold or the window is empty
+        valid = self.dispersion["valid"]
+        passed = self.passed
+        sequence = self.window_frames(first, current).tolist()
+        checked, head, tail = [], [], []
+        end = False
+        for frame in range(current, current + steps):
+            if not valid[frame]:
+                end = True
+                break
+            if len(head) + 1 == len(sequence) or passed[frame]:
+                sequence.append(frame)
+            checked.append(frame)
+            head.append(len(head) + 1)
+            tail.append(len(sequence))
+        sequence = np.array(sequence, dtype=np.int64)
+        checked, head, tail = np.array(checked, dtype=np.int64), np.array(head, dtype=np.int64), np.array(tail)
+        # The dispersion changes only when a frame is added (inf otherwise)
+        added = np.flatnonzero(sequence[tail - 1] == checked)
+        profile = {"size": checked.shape[0], "end": end, "value": np.full(checked.shape[0], np.inf),
+                   "first": sequence[head], "checked": checked, "added": added}
+        return profile, (sequence, head[added], tail[added])
+
+    def expand(self, first: int, current: int, th: float) -> Generator:
+        """
+        Expand a window while its dispersion is not above the threshold.
+
+        :return: Tuple containing the number of frames added before the expansion ended and the frame that ended it,
+            and whether the dispersion ended it (otherwise an invalid frame, the end of the data or a frame above the
+            velocity threshold).
+        """
+        stop = self.stops[current]
+        profile = self.profiles.setdefault(("expand", first), {"lo": current, "value": np.empty(0)})
+        length = self.chunk
+        while True:
+            hi = min(current + length, stop)
+            end = profile["lo"] + profile["value"].shape[0]
+            if current < profile["lo"] or end < hi:
+                # The profile grows at least twice as long at its end
+                yield "expand", first, current, hi if end >= hi else min(max(hi, end + profile["value"].shape[0]), stop)
+                continue
+            above = profile["value"][current - profile["lo"]:hi - profile["lo"]] > th
+            if above.any():
+                added = int(np.argmax(above))
+                return added, current + added, True
+            if hi == stop:
+                return stop - current, stop, False
+            length *= 2
+
+    def expand_phase(self, first: int, lo: int, hi: int) -> Tuple[np.ndarray, tuple]:
+        # Frames missing from the expansion profile of a first frame up to hi (from lo) and their windows
+        profile = self.profiles["expand", first]
+        end = profile["lo"] + profile["value"].shape[0]
+        frame = np.concatenate([np.arange(lo, profile["lo"]), np.arange(end, hi)]).astype(np.int64)
+        sequence = self.window_frames(first, max(hi, profile["lo"]))
+        frames = self.frames_below
+        tail = 1 + np.searchsorted(frames, frame, side="right") - np.searchsorted(frames, first, side="right")
+        return frame, (sequence, np.zeros_like(tail), tail)
+
+    def serve(self, requests: List[tuple]):
+        """
+        Calculate the dispersions of the phases requested by the threshold sets in a round at once.
+
+        :param requests: List of tuples containing the kind of the phase ("slide" or "expand"), the first frame, the
+            current frame and the length of the slide or the frame the expansion is needed to.
+        """
+        slides, expansions = {}, {}
+        for kind, first, current, length in requests:
+            if kind == "slide":
+                key = first, current
+                profile = self.profiles.get(("slide",) + key)
+                slides[key] = max(slides.get(key, 0), length, 0 if profile is None else 2 * profile["size"])
+            else:
+                lo, hi = expansions.get(first, (current, length))
+                expansions[first] = min(lo, current), max(hi, length)
+
+        groups, phases = [], []
+        for (first, current), steps in slides.items():
+            profile, group = self.slide_phase(first, current, steps)
+            groups.append(group)
+            phases.append(("slide", first, current, profile))
+        for first, (lo, hi) in expansions.items():
+            frame, group = self.expand_phase(first, lo, hi)
+            groups.append(group)
+            phases.append(("expand", first, frame, None))
+
+        for (kind, first, current, profile), value in zip(phases, self.evaluate(groups)):
+            if kind == "slide":
+                profile["value"][profile.pop("added")] = value
+                self.profiles["slide", first, current] = profile
+            else:
+                profile = self.profiles["expand", first]
+                before = np.count_nonzero(current < profile["lo"])
+                profile["value"] = np.concatenate([value[:before], profile["value"], value[before:]])
+                profile["lo"] -= before
+
+    def walk(self, ivdt: bool, duration: int, th: float) -> Generator:
+        """
+        Detect the fixations by I-DT or I-VDT (get_fixation_by_idt / get_fixation_by_ivdt) for a threshold set of the
+        current velocity threshold. This is a generator yielding the phases whose dispersions are missing (see serve).
+
+        :param ivdt: Whether to detect by I-VDT.
+        :param duration: Duration threshold (frames).
+        :param th: Dispersion threshold.
+        :return: Numpy array (M, 2) representing the start and end frames of the fixations.
+        """
+        n = self.n
+        valid = self.dispersion["valid"]
+        below = self.next_frames(np.concatenate([self.full_dispersions(duration) <= th, [True]]))
+        fix = []
+        i = 0
+        while i + duration < n:
+            top = i
+            start = self.init_window(i, duration)
+            if start is None:  # No frame left
+                break
+            first, i = start, start + duration
+            exceeds = below[first] != first
+            stop = top
+
+            # Slide the window if the dispersion is larger than the threshold
+            if exceeds:
+                steps, first, i, exceeds = yield from self.slide(first, i, duration, below, th)
+                start += steps
+
+            # Expand the window while the dispersion is smaller than the threshold
+            if not exceeds:
+                added, frame, dispersion = yield from self.expand(first, i, th)
+                if not dispersion and not valid[frame]:
+                    stop, i = frame, frame
+                elif ivdt:
+                    # The frame above the dispersion or the velocity threshold ends the fixation
+                    stop, i = frame, frame + 1
+                else:
+                    stop = frame - 1 if added > 0 else stop
+                    i = frame
+
+            if stop - start >= duration:  # Duration threshold
+                fix.append([start, stop])
+            if i >= n:  # End of the data
+                break
+        return np.array(fix, dtype=np.float64).reshape(-1, 2)
+
+    def dispersion_windows(self, ivdt: bool, durations: List[int],
+                           dispersions: List[float]) -> Dict[Tuple[int, float], np.ndarray]:
+        """
+        Detect the fixations by I-DT or I-VDT for every duration and dispersion threshold of the current velocity
+        threshold, advancing the threshold sets together.
+
+        :param ivdt: Whether to detect by I-VDT.
+        :param durations: List of the duration thresholds (frames).
+        :param dispersions: List of the dispersion thresholds.
+        :return: Dictionary of the windows (M, 2) keyed on (duration, dispersion).
+        """
+        walks = {(duration, th): self.walk(ivdt, duration, th) for duration in durations for th in dispersions}
+        requests = {key: None for key in walks}
+        windows = {}
+        while requests:
+            if any(request is not None for request in requests.values()):
+                self.serve([request for request in requests.values() if request is not None])
+                self.rounds += 1
+            for key in list(requests):
+                try:
+                    requests[key] = next(walks[key])
+                except StopIteration as result:
+                    windows[key] = result.value
+                    del requests[key]
+        return windows
+
+    @instrumentation.timed("SweepFixation.sweep")
+    def sweep(self, detector: str, dig_per_sec: List[float], durations: List[float],
+              dispersions: Optional[List[float]] = None) -> Dict[Tuple[Optional[float], Optional[float], float],
+                                                                 np.ndarray]:
+        """
+        Detect the fixations for every threshold set of a grid.
+
+        :param detector: Name of the detector (ivt, ivt_world, idt or ivdt).
+        :param dig_per_sec: List of the velocity thresholds (degrees per second, unused by idt).
+        :param durations: List of the duration thresholds (sec).
+        :param dispersions: List of the dispersion thresholds (idt and ivdt).
+        :return: Dictionary of the windows (M, 2) keyed on (velocity, dispersion, duration).
+        """
+        if detector not in self.detectors:
+            raise ValueError("unknown detector: %s" % detector)
+        if detector in ("ivt", "ivt_world"):
+            windows = self.velocity_windows(detector, dig_per_sec, durations)
+            return {(velocity, None, duration): window for (velocity, duration), window in windows.items()}
+
+        if not dispersions:
+            raise ValueError("dispersion thresholds are required by %s" % detector)
+        if self.dispersion is None:
+            self.prepare_dispersion()
+        frames = {duration: self.frames(duration) for duration in durations}
+        windows = {}
+        for velocity in (sorted(set(dig_per_sec)) if detector == "ivdt" else [None]):
+            self.set_velocity(None if velocity is None else velocity / self.fix.fs)
+            result = self.dispersion_windows(detector == "ivdt", sorted(set(frames.values())), sorted(set(dispersions)))
+            for duration in durations:
+                for dispersion in dispersions:
+                    windows[velocity, dispersion, duration] = result[frames[duration], dispersion]
+        self.profiles = {}
+        return windows
+
+    @staticmethod
+    def name(detector: str, velocity: Optional[float], dispersion: Optional[float], duration: float) -> str:
+        # Name of a threshold set as the method directories (e.g. ivdt_80deg_0.701749deg_160ms), with the dispersion
+        # in degrees to 6 significant digits so that the thresholds of fine grids keep their own names
+        parts = [detector]
+        if velocity is not None and detector != "idt":
+            parts.append("%gdeg" % velocity)
+        if dispersion is not None:
+            parts.append("%gdeg" % np.rad2deg(np.arctan(np.sqrt(dispersion))))
+        parts.append("%gms" % round(duration * 1000, 6))
+        return "_".join(parts)
+
+    def summary(self, detector: str, windows: Dict[Tuple[float, Optional[float], float], np.ndarray]) -> pd.DataFrame:
+        """
+        Summarize the fixations of each threshold set.
+
+        :param detector: Name of the detector.
+        :param windows: Dictionary returned by sweep.
+        :return: DataFrame of the number of fixations, their mean duration and the fraction of the frames in them.
+        """
+        rows = []
+        for (velocity, dispersion, duration), window in windows.items():
+            length = window[:, 1] - window[:, 0]
+            rows.append({"name": self.name(detector, velocity, dispersion, duration), "dig_per_sec": velocity,
+                         "dispersion": dispersion, "duration": duration, "fixations": window.shape[0],
+                         "mean_duration": length.mean() / self.fix.fs if length.shape[0] > 0 else np.nan,
+                         "coverage": length.sum() / self.n})
+        return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect the fixations of a session over a grid of thresholds.")
+    parser.add_argument("input", help="Gaze data of the session (CSV or gaze session file)")
+    parser.add_argument("output_dir", help="Directory of the windows (one CSV per threshold set) and summary.csv")
+    parser.add_argument("--detector", default="ivt", choices=SweepFixation.detectors, help="Fixation detector")
+    parser.add_argument("--dig-per-sec", type=float, nargs="+", default=[100], help="Velocity thresholds (deg/s)")
+    parser.add_argument("--duration", type=float, nargs="+", default=[0.2], help="Duration thresholds (sec)")
+    parser.add_argument("--dispersion", type=float, nargs="+", default=[0.00015],
+                        help="Dispersion thresholds of idt and ivdt")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    fix = ExtractFixation()
+    fix.formatting(args.input)
+    fix.calculate_th()
+    sweep = SweepFixation(fix)
+    windows = sweep.sweep(args.detector, args.dig_per_sec, args.duration, args.dispersion)
+    summary = sweep.summary(args.detector, windows)
+    duplicated = summary["name"][summary["name"].duplicated()].unique()
+    if duplicated.shape[0] > 0:
+        raise SystemExit("threshold sets with the same name: %s" % ", ".join(duplicated))
+    os.makedirs(args.output_dir, exist_ok=True)
+    for name, window in zip(summary["name"], windows.values()):
+        np.savetxt(os.path.join(args.output_dir, name + ".csv"), window, fmt="%d", delimiter=",")
+    summary.to_csv(os.path.join(args.output_dir, "summary.csv"), index=False)
+    print(summary.to_string(index=False, float_format="%.4g"))
+    print(f"{len(windows)} threshold sets in {perf_counter() - start:.2f} s ({sweep.evaluations} window dispersions)")
+
+
+if __name__ == "__main__":
+    main()
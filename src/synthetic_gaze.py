@@ -0,0 +1,326 @@
+import argparse
+import json
+import math
+import os
+from typing import Dict, Optional, Tuple
+import numpy as np
+from evaluate_gaze import EvaluateGaze
+from gaze_session import write_columns
+from scene_geometry import TriangleMesh
+
+
+class SyntheticGaze:
+    """
+    Generator of synthetic gaze sessions in the schema of the recorded data, with known calibration parameters.
+
+    The user walks through a box-shaped room while turning the head slowly. The gaze alternates fixations on points
+    of the walls (held by the eye against the head motion) and saccades between them, interrupted by blinks.
+    The recorded gaze direction is the true one rotated by the inverse of the ground-truth rotation
+    (alpha, beta), so that EvaluateGaze.get_rotation(param) calibrates it back up to the angular noise.
+    The points of regard (xc, yc, zc) are the hits of the recorded gaze direction on the room, as recorded by Unity.
+    """
+
+    # Columns of the recorded data in order (the evaluation data adds u and v)
+    columns = (["flag", "xl", "yl", "zl", "xr", "yr", "zr", "xc", "yc", "zc"]
+               + ["mat_%d%d" % (r, c) for c in range(4) for r in range(4)]
+               + ["ctw_%d%d" % (r, c) for c in range(4) for r in range(4)]
+               + ["opennessl", "opennessr", "ray_x", "ray_y", "ray_z", "eye_x", "eye_y", "eye_z", "time", "frame"])
+    room = np.array([[-5.0, 0.0, -5.0], [5.0, 3.0, 5.0]])  # Corners of the room
+    eye = np.array([-0.003, -0.002, -0.026])  # Eye position in HMD coordinate
+    marker_grid = np.linspace(-0.175, 0.175, 5)  # Marker positions on the calibration plane at z=1
+
+    def __init__(self, param: Tuple[float, float] = (2.0, -1.5), fs: float = 90.0, seed: int = 0,
+                 noise: float = 0.1, fixation_duration: Tuple[float, float] = (0.15, 0.6),
+                 eccentricity: float = 15.0, saccade_amplitude: Tuple[float, float] = (5.0, 15.0),
+                 blink_rate: float = 0.2,
+                 blink_duration: float = 0.15):
+        """
+        :param param: Ground-truth parameters (alpha, beta) in degrees.
+        :param fs: Frame rate.
+        :param seed: Random seed.
+        :param noise: Standard deviation of the angular noise of the recorded gaze direction (degrees).
+        :param fixation_duration: Range of the fixation durations (sec).
+        :param eccentricity: Maximum angle between the fixation targets and the head direction (degrees).
+        :param saccade_amplitude: Range of the saccade amplitudes (degrees).
+        :param blink_rate: Mean number of blinks per second.
+        :param blink_duration: Duration of a blink (sec).
+        """
+        self.param = np.asarray(param, dtype=np.float64)
+        self.fs = fs
+        self.seed = seed
+        self.noise = noise
+        self.fixation_duration = fixation_duration
+        self.eccentricity = eccentricity
+        self.saccade_amplitude = saccade_amplitude
+        self.blink_rate = blink_rate
+        self.blink_duration = blink_duration
+
+    def mesh(self) -> TriangleMesh:
+        """
+        Get the room as a triangle mesh (a raycaster of OptimizeGaze).
+
+        :return: TriangleMesh of the walls, the floor and the ceiling.
+        """
+        vertices = np.array([[self.room[i >> 2 & 1, 0], self.room[i >> 1 & 1, 1], self.room[i & 1, 2]]
+                             for i in range(8)])
+        faces = []
+        for axis in range(3):
+            for side in range(2):
+                quad = [i for i in range(8) if (i >> (2 - axis) & 1) == side]
+                faces += [[quad[0], quad[1], quad[3]], [quad[0], quad[3], quad[2]]]
+        return TriangleMesh(vertices, np.array(faces))
+
+    def hit_room(self, origin: np.ndarray, direction: np.ndarray) -> np.ndarray:
+        """
+        Intersect rays starting inside the room with its walls.
+
+        :param origin: Numpy array (N, 3) representing the ray origins.
+        :param direction: Numpy array (N, 3) representing the ray directions.
+        :return: Numpy array (N, 3) representing the hit points.
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            bound = np.where(direction > 0, self.room[1], self.room[0])
+            t = np.nanmin(np.where(direction != 0, (bound - origin) / direction, np.inf), axis=1)
+        return origin + t[:, np.newaxis] * direction
+
+    @staticmethod
+    def normalize(vec: np.ndarray) -> np.ndarray:
+        return vec / np.linalg.norm(vec, axis=-1, keepdims=True)
+
+    def head_motion(self, rng: np.random.Generator, time: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Generate a smooth head trajectory as sums of slow sinusoids.
+
+        :return: Tuple containing the HMD positions (N, 3) and the CameraToWorld rotations (N, 3, 3).
+        """
+        def wave(amplitude, freq_range, count=3):
+            freq = rng.uniform(*freq_range, count)
+            phase = rng.uniform(0.0, 2.0 * np.pi, count)
+            return amplitude / count * np.sin(2.0 * np.pi * freq * time[:, np.newaxis] + phase).sum(axis=1)
+
+        # Walking around the centre of the room at eye height
+        pos = np.stack([wave(3.0, (0.005, 0.02)), 1.6 + wave(0.02, (1.0, 2.0)), wave(3.0, (0.005, 0.02))], axis=1)
+        # Yaw and pitch of the head (the forward direction is the z axis of the camera)
+        yaw = rng.uniform(-180.0, 180.0) + wave(120.0, (0.01, 0.04)) + wave(15.0, (0.2, 0.5))
+        pitch = -5.0 + wave(10.0, (0.02, 0.08)) + wave(15.0, (0.2, 0.5))
+        return pos, EvaluateGaze.get_rotations(np.stack([yaw, pitch], axis=1))
+
+    def gaze_targets(self, rng: np.random.Generator, rot: np.ndarray, eye_world: np.ndarray, onset: np.ndarray,
+                     offset: np.ndarray, amplitude: np.ndarray) -> np.ndarray:
+        """
+        Generate the fixated points. Each saccade starts from the previous target as seen from the head at the end
+        of the fixation and is turned towards the head direction when it would leave the eccentricity.
+
+        :param rot: Numpy array (N, 3, 3) representing the CameraToWorld rotations.
+        :param eye_world: Numpy array (N, 3) representing the eye positions in world coordinate.
+        :param onset: Numpy array (M,) representing the first frames of the fixations.
+        :param offset: Numpy array (M,) representing the end frames of the fixations.
+        :param amplitude: Numpy array (M,) representing the saccade amplitudes before the fixations (degrees).
+        :return: Numpy array (M, 3) representing the fixated points in world coordinate.
+        """
+        count = onset.shape[0]
+        angle = rng.uniform(0.0, 2.0 * np.pi, count)
+        turn = rng.uniform(-np.pi / 3.0, np.pi / 3.0, count)
+        target = np.empty([count, 3])
+        x = y = 0.0  # Horizontal and vertical angles of the gaze in HMD coordinate (degrees)
+        for k in range(count):
+            if k > 0:
+                # Previous target seen from the head at the end of the fixation
+                gaze = np.dot(rot[offset[k - 1] - 1].T, target[k - 1] - eye_world[offset[k - 1] - 1])
+                x = math.degrees(math.atan2(gaze[0], gaze[2]))
+                y = math.degrees(math.atan2(gaze[1], gaze[2]))
+            direction = angle[k]
+            if math.hypot(x + amplitude[k] * math.cos(direction), y + amplitude[k] * math.sin(direction)) > \
+                    self.eccentricity:
+                # Turn within 60 degrees of the direction towards the head direction
+                direction = math.atan2(-y, -x) + turn[k]
+            x += amplitude[k] * math.cos(direction)
+            y += amplitude[k] * math.sin(direction)
+            head_dir = np.array([math.tan(math.radians(x)), math.tan(math.radians(y)), 1.0])
+            target[k] = self.hit_room(eye_world[onset[k]][np.newaxis], np.dot(rot[onset[k]], head_dir)[np.newaxis])[0]
+        return target
+
+    def unity_matrices(self, pos: np.ndarray, rot: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the matrices recorded by Unity (the camera looks along -z, see ExtractFixation.formatting).
+
+        :param pos: Numpy array (N, 3) representing the HMD positions.
+        :param rot: Numpy array (N, 3, 3) representing the CameraToWorld rotations.
+        :return: Tuple containing the WorldToCamera matrices (N, 4, 4) and the CameraToWorld matrices (N, 4, 4).
+        """
+        n = pos.shape[0]
+        ctw = np.zeros([n, 4, 4])
+        ctw[:, :3, :3] = rot
+        ctw[:, :3, 2] *= -1.0
+        ctw[:, :3, 3] = pos
+        ctw[:, 3, 3] = 1.0
+        mat = np.zeros([n, 4, 4])
+        mat[:, :3, :3] = np.swapaxes(ctw[:, :3, :3], 1, 2)
+        mat[:, :3, 3] = -np.matmul(mat[:, :3, :3], pos[:, :, np.newaxis])[:, :, 0]
+        mat[:, 3, 3] = 1.0
+        return mat, ctw
+
+    def record(self, rng: np.random.Generator, direction: np.ndarray) -> np.ndarray:
+        """
+        Get the recorded gaze directions from the true ones (HMD coordinate).
+
+        :param direction: Numpy array (N, 3) representing the true gaze directions.
+        :return: Numpy array (N, 3) representing the recorded gaze directions with noise.
+        """
+        ray = np.matmul(direction, EvaluateGaze.get_rotation(self.param))  # get_rotation(param).T @ direction
+        ray[:, :2] += rng.normal(0.0, np.deg2rad(self.noise), [ray.shape[0], 2]) * ray[:, 2:]
+        return self.normalize(ray)
+
+    def columns_of(self, frames: int, mat: np.ndarray, ctw: np.ndarray, ray: np.ndarray, openness: np.ndarray,
+                   eye: np.ndarray, por: np.ndarray, flag: np.ndarray) -> Dict[str, np.ndarray]:
+        data = {"flag": flag.astype(np.float64)}
+        for side in "lrc":
+            for axis, name in enumerate("xyz"):
+                data[name + side] = por[:, axis]
+        for c in range(4):
+            for r in range(4):
+                data["mat_%d%d" % (r, c)] = mat[:, r, c]
+        for c in range(4):
+            for r in range(4):
+                data["ctw_%d%d" % (r, c)] = ctw[:, r, c]
+        data["opennessl"] = openness
+        data["opennessr"] = openness.copy()
+        for axis, name in enumerate("xyz"):
+            data["ray_" + name] = ray[:, axis]
+        for axis, name in enumerate("xyz"):
+            data["eye_" + name] = eye[:, axis]
+        data["frame"] = np.arange(1, frames + 1, dtype=np.int64)
+        data["time"] = data["frame"] / self.fs
+        return {column: data[column] for column in self.columns}
+
+    def session(self, frames: int) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+        """
+        Generate a session of the recorded data (office_data, supermarket_data).
+
+        :param frames: Integer number of frames.
+        :return: Tuple containing the dictionary of the columns and the dictionary of the ground truth: param,
+            fixation (M, 2) (start and end frames of the fixations), blink (B, 2) and target (M, 3) (fixated points).
+        """
+        rng = np.random.default_rng(self.seed)
+        time = np.arange(1, frames + 1) / self.fs
+        pos, rot = self.head_motion(rng, time)
+        eye = self.eye + rng.normal(0.0, 1e-4, [frames, 3])
+        eye_world = pos + np.matmul(rot, eye[:, :, np.newaxis])[:, :, 0]
+
+        # Durations of the fixations and of the saccades between them by the main sequence (21 ms + 2.2 ms per degree)
+        count = int(frames / (self.fixation_duration[0] * self.fs)) + 2
+        amplitude = rng.uniform(*self.saccade_amplitude, count)
+        saccade = np.maximum(2, np.ceil((0.021 + 0.0022 * amplitude) * self.fs)).astype(np.int64)
+        saccade[0] = 0
+        fixation = np.round(rng.uniform(*self.fixation_duration, count) * self.fs).astype(np.int64)
+        onset = np.cumsum(saccade) + np.concatenate([[0], np.cumsum(fixation)[:-1]])
+        count = int(np.searchsorted(onset, frames))
+        onset = onset[:count]
+        offset = np.minimum(onset + fixation[:count], frames)
+        saccade = saccade[:count]
+        target = self.gaze_targets(rng, rot, eye_world, onset, offset, amplitude[:count])
+
+        # Point looked at in each frame (moving from the previous target during a saccade)
+        segment = np.repeat(np.arange(count), np.diff(np.concatenate([onset, [frames]])))
+        point = target[segment].copy()
+        moving = np.arange(frames) >= offset[segment]
+        following = np.minimum(segment[moving] + 1, count - 1)
+        s = (np.arange(frames)[moving] - offset[segment[moving]] + 1) / (saccade[following] + 1)
+        s = s * s * s * (10.0 - 15.0 * s + 6.0 * s * s)  # Minimum-jerk profile
+        point[moving] += s[:, np.newaxis] * (target[following] - point[moving])
+
+        # Recorded gaze directions and points of regard
+        direction = self.normalize(np.matmul(np.swapaxes(rot, 1, 2), (point - eye_world)[:, :, np.newaxis])[:, :, 0])
+        ray = self.record(rng, direction)
+        por = self.hit_room(eye_world, np.matmul(rot, ray[:, :, np.newaxis])[:, :, 0])
+
+        # Blinks at random frames
+        blink_count = rng.poisson(self.blink_rate * frames / self.fs)
+        blink_start = np.sort(rng.integers(0, frames, blink_count))
+        blink = np.stack([blink_start, np.minimum(blink_start + int(round(self.blink_duration * self.fs)), frames)],
+                         axis=1).reshape(-1, 2)
+        closed = np.zeros(frames + 1, dtype=np.int64)
+        np.add.at(closed, blink[:, 0], 1)
+        np.add.at(closed, blink[:, 1], -1)
+        openness = np.where(np.cumsum(closed[:-1]) > 0, 0.0, 1.0)
+        por[openness < 0.5] = np.nan
+
+        mat, ctw = self.unity_matrices(pos, rot)
+        data = self.columns_of(frames, mat, ctw, ray, openness, eye, por, np.zeros(frames))
+        truth = {"param": self.param.copy(), "fixation": np.stack([onset, offset], axis=1), "blink": blink,
+                 "target": target}
+        return data, truth
+
+    def evaluation(self, frames: int) -> Dict[str, np.ndarray]:
+        """
+        Generate a session of the evaluation data (eval_data): the markers of a 5 x 5 grid on the calibration plane
+        at 1m away are gazed in turn with the head still.
+
+        :param frames: Integer number of frames.
+        :return: Dictionary of the columns (with the marker positions u and v).
+        """
+        rng = np.random.default_rng(self.seed + 1)
+        marker = np.stack(np.meshgrid(self.marker_grid, self.marker_grid[::-1]), axis=2).reshape(-1, 2)
+        flag = np.arange(frames) * marker.shape[0] // frames
+        u, v = marker[flag, 0], marker[flag, 1]
+
+        pos = np.tile([0.0, 1.6, 0.0], (frames, 1))
+        rot = np.tile(np.eye(3), (frames, 1, 1))
+        eye = self.eye + rng.normal(0.0, 1e-4, [frames, 3])
+        direction = self.normalize(np.stack([u, v, np.ones(frames)], axis=1) - eye)
+        ray = self.record(rng, direction)
+        por = self.hit_room(pos + eye, ray)
+
+        mat, ctw = self.unity_matrices(pos, rot)
+        data = self.columns_of(frames, mat, ctw, ray, np.ones(frames), eye, por, flag + 1)
+        data["u"] = u
+        data["v"] = v
+        return data
+
+    def write(self, path: str, frames: int, evaluation: bool = False) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Generate a session and write it to a CSV file or a gaze session file (.gaze).
+
+        :param path: Path of the output file.
+        :param frames: Integer number of frames.
+        :param evaluation: Whether to generate the evaluation data.
+        :return: Dictionary of the ground truth (None for the evaluation data).
+        """
+        if evaluation:
+            write_columns(path, self.evaluation(frames))
+            return None
+        data, truth = self.session(frames)
+        write_columns(path, data)
+        return truth
+
+    def truth_json(self, truth: Optional[Dict[str, np.ndarray]]) -> dict:
+        desc = {"param": self.param.tolist(), "fs": self.fs, "seed": self.seed, "noise": self.noise}
+        if truth is not None:
+            desc["fixation"] = truth["fixation"].tolist()
+            desc["blink"] = truth["blink"].tolist()
+        return desc
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic gaze sessions with known calibration parameters.")
+    parser.add_argument("outputs", nargs="+", help="Output files (.csv or .gaze)")
+    parser.add_argument("--frames", type=int, default=100000, help="Number of frames of each session")
+    parser.add_argument("--param", type=float, nargs=2, default=[2.0, -1.5], metavar=("ALPHA", "BETA"),
+                        help="Ground-truth parameters (degrees)")
+    parser.add_argument("--fs", type=float, default=90.0, help="Frame rate")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the first session")
+    parser.add_argument("--eval", action="store_true", help="Generate the evaluation data (marker positions u, v)")
+    args = parser.parse_args()
+
+    for number, path in enumerate(args.outputs):
+        generator = SyntheticGaze(tuple(args.param), fs=args.fs, seed=args.seed + number)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        truth = generator.write(path, args.frames, args.eval)
+        # Ground truth next to the session
+        with open(os.path.splitext(path)[0] + "_truth.json", "w") as f:
+            json.dump(generator.truth_json(truth), f)
+        print(f"{path}: {args.frames} frames, param {args.param}")
+
+
+if __name__ == "__main__":
+    main()